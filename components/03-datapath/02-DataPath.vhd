@@ -6,6 +6,10 @@ use ieee.numeric_std.all;
 use work.constants.all;
 use work.control_word.all;
 
+-- synthesis translate_off
+use std.textio.all;
+-- synthesis translate_on
+
 -- Acronyms:
 --  if = instruction fetch
 --  id = instruction decode
@@ -16,6 +20,18 @@ use work.control_word.all;
 --  dc = data cache
 entity DataPath is
     generic (
+        -- synthesis translate_off
+        -- If not 0, a "State hash" of the register and memory writes is
+        -- reported every STATE_HASH_INTERVAL writes after the first
+        -- STATE_HASH_START ones, and once more when the program ends
+        STATE_HASH_INTERVAL: integer := 0;
+        STATE_HASH_START: integer := 0;
+
+        -- If not empty, the file where to write what's in every stage of
+        -- the pipeline, one cycle per line
+        PIPELINE_LOG: string := "";
+        -- synthesis translate_on
+
         NBIT: integer := 32;
         ADDR_WIDTH: integer := 32;
         BTB_LINES_WIDTH: integer := 4;
@@ -264,6 +280,44 @@ architecture Structural of DataPath is
     --       signals that would trigger them, if they ever get
     --       implemented.
     signal s_trap_wb_misaligned_data: std_logic;
+
+    -- synthesis translate_off
+    subtype StateHashType is unsigned(31 downto 0);
+
+    -- 32 bit FNV-1a, folding a word at a time
+    constant STATE_HASH_OFFSET: StateHashType := x"811C9DC5";
+    constant STATE_HASH_PRIME: StateHashType := x"01000193";
+
+    function to_hex(value: std_logic_vector(31 downto 0)) return string is
+        constant DIGITS: string(1 to 16) := "0123456789ABCDEF";
+        variable text: string(1 to 8);
+    begin
+        for i in 0 to 7 loop
+            text(8 - i) := DIGITS(to_integer(unsigned(value(i*4+3 downto i*4))) + 1);
+        end loop;
+        return text;
+    end function;
+
+    -- The pc of the instruction in a stage given its npc, or "-" for a bubble,
+    -- which has the npc of the reset
+    function stage_pc(npc: std_logic_vector(31 downto 0)) return string is
+    begin
+        if npc = RESET_ADDR then
+            return "-";
+        end if;
+        return to_hex(std_logic_vector(unsigned(npc) - 4));
+    end function;
+
+    function stage_flags(stall, flush: std_logic) return character is
+    begin
+        if flush = '1' then
+            return 'F';
+        elsif stall = '1' then
+            return 'S';
+        end if;
+        return '.';
+    end function;
+    -- synthesis translate_on
 begin
 
     -- Fetch Stage
@@ -653,4 +707,127 @@ begin
     reg_wb_rd;
 
     o_wb_ir_rd <= reg_wb_rd;
+
+    -- synthesis translate_off
+    -- Rolling hash of the architectural writes in program order: the
+    -- registers written in write back and the stores done in memory. The two
+    -- stages always stall together, and the instruction in write back is older
+    -- than the one in memory, so its write is hashed first. The scripts
+    -- compute the same hash with the emulator, to find the first write where
+    -- the cpu diverges from it.
+    StateHash: process (i_clk)
+        variable hash: StateHashType := STATE_HASH_OFFSET;
+        variable writes: integer := 0;
+        variable data_size: integer;
+        variable data_mask: std_logic_vector(NBIT-1 downto 0);
+        variable last_write: line;
+        variable ended: boolean := false;
+
+        procedure fold(word: in std_logic_vector(31 downto 0)) is
+            variable product: unsigned(63 downto 0);
+        begin
+            product := (hash xor unsigned(word)) * STATE_HASH_PRIME;
+            hash := product(31 downto 0);
+        end procedure;
+
+        -- Reports the hash of the register and memory writes folded so far,
+        -- with how many they are and the last one of them
+        procedure report_hash is
+        begin
+            report "State hash: " & integer'image(writes) & " "
+            & to_hex(std_logic_vector(hash)) & " " & last_write.all;
+        end procedure;
+
+        -- Counts a write just folded in the hash, and reports the hash every
+        -- STATE_HASH_INTERVAL writes after the first STATE_HASH_START ones
+        procedure count_write(description: in string) is
+        begin
+            writes := writes + 1;
+            deallocate(last_write);
+            last_write := new string'(description);
+            if writes > STATE_HASH_START and (writes - STATE_HASH_START) mod STATE_HASH_INTERVAL = 0 then
+                report_hash;
+            end if;
+        end procedure;
+    begin
+        if rising_edge(i_clk) and i_rst_n = '1' and STATE_HASH_INTERVAL > 0 then
+            if i_wb_cw.rf_wr_enable = '1' and i_wb_stall = '0' and unsigned(s_wb_rf_rd) /= 0 then
+                fold(std_logic_vector(to_unsigned(16#100# + to_integer(unsigned(s_wb_rf_rd)), 32)));
+                fold(s_wb_rf_input);
+                count_write("r" & integer'image(to_integer(unsigned(s_wb_rf_rd))) & "=" & to_hex(s_wb_rf_input));
+            end if;
+
+            -- The store to the termination address isn't hashed, as the
+            -- testbench stops at it like the emulator does. The hash is
+            -- reported once more when it gets to memory instead, so that the
+            -- writes after the last report are checked too.
+            if i_mm_cw.wr_request = '1' and reg_mm_arith_out(31 downto 16) = x"FFFF" then
+                if not ended and writes > STATE_HASH_START then
+                    report_hash;
+                end if;
+                ended := true;
+            elsif i_mm_cw.wr_request = '1' and i_mm_stall = '0' then
+                case i_mm_cw.data_type is
+                    when Word =>
+                        data_size := 4;
+                        data_mask := x"FFFFFFFF";
+                    when Halfword | HalfwordSigned =>
+                        data_size := 2;
+                        data_mask := x"0000FFFF";
+                    when others =>
+                        data_size := 1;
+                        data_mask := x"000000FF";
+                end case;
+
+                fold(std_logic_vector(to_unsigned(16#200# + data_size, 32)));
+                fold(reg_mm_arith_out);
+                fold(reg_mm_b and data_mask);
+                count_write("m" & integer'image(data_size) & "[" & to_hex(reg_mm_arith_out) & "]="
+                & to_hex(reg_mm_b and data_mask));
+            end if;
+        end if;
+    end process StateHash;
+
+    -- Writes a line for every cycle, with the cycle, the cause of the stall or
+    -- flush (D for a data cache miss, I for an instruction cache miss, B for a
+    -- branch misprediction, L for a load-use stall, M for the multicycle unit
+    -- and . for none, checked in the same order as the control unit), whether
+    -- each stage from fetch to write back is stalled (S) or flushed (F), and
+    -- the pc in each of them (- for a bubble). Without PIPELINE_LOG, it isn't
+    -- even elaborated.
+    PipelineLogGen: if PIPELINE_LOG'length > 0 generate
+        PipelineLog: process (i_clk)
+            file log_file: text open write_mode is PIPELINE_LOG;
+            variable log_line: line;
+            variable cycle: integer := 0;
+            variable cause: character;
+        begin
+            if rising_edge(i_clk) and i_rst_n = '1' then
+                if (i_mm_cw.rd_request = '1' or i_mm_cw.wr_request = '1') and i_dc_hit = '0' then
+                    cause := 'D';
+                elsif i_ic_hit = '0' then
+                    cause := 'I';
+                elsif i_ex_flush = '1' and i_mm_flush = '1' then
+                    cause := 'B';
+                elsif i_ex_stall = '1' and i_mm_flush = '1' then
+                    cause := 'L';
+                elsif ex_multicycle_busy = '1' then
+                    cause := 'M';
+                else
+                    cause := '.';
+                end if;
+
+                write(log_line, integer'image(cycle) & " " & cause & " "
+                & stage_flags(i_if_stall, i_if_flush) & stage_flags(i_id_stall, i_id_flush)
+                & stage_flags(i_ex_stall, i_ex_flush) & stage_flags(i_mm_stall, i_mm_flush)
+                & stage_flags(i_wb_stall, i_wb_flush));
+                write(log_line, " " & to_hex(reg_if_pc) & " " & stage_pc(reg_id_npc) & " " & stage_pc(reg_ex_npc)
+                & " " & stage_pc(reg_mm_npc) & " " & stage_pc(reg_wb_npc));
+                writeline(log_file, log_line);
+
+                cycle := cycle + 1;
+            end if;
+        end process PipelineLog;
+    end generate PipelineLogGen;
+    -- synthesis translate_on
 end Structural;
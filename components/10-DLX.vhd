@@ -7,6 +7,12 @@ use work.control_word.all;
 
 entity DLX is
     generic (
+        -- synthesis translate_off
+        STATE_HASH_INTERVAL: integer := 0;
+        STATE_HASH_START: integer := 0;
+        PIPELINE_LOG: string := "";
+        -- synthesis translate_on
+
         NBIT: integer := 32;
         ADDR_WIDTH: integer := 32;
         RESET_ADDR: std_logic_vector(31 downto 0) := (others => '0');
@@ -102,6 +108,12 @@ architecture Structural of DLX is
 
     component DataPath is
         generic (
+            -- synthesis translate_off
+            STATE_HASH_INTERVAL: integer := 0;
+            STATE_HASH_START: integer := 0;
+            PIPELINE_LOG: string := "";
+            -- synthesis translate_on
+
             NBIT: integer := 32;
             ADDR_WIDTH: integer := 32;
             BTB_LINES_WIDTH: integer := 4;
@@ -381,6 +393,12 @@ begin
 
     DP_Instance: DataPath
         generic map (
+            -- synthesis translate_off
+            STATE_HASH_INTERVAL => STATE_HASH_INTERVAL,
+            STATE_HASH_START => STATE_HASH_START,
+            PIPELINE_LOG => PIPELINE_LOG,
+            -- synthesis translate_on
+
             NBIT => NBIT,
             ADDR_WIDTH => ADDR_WIDTH,
             BTB_LINES_WIDTH => BTB_LINES_WIDTH,
@@ -509,4 +527,98 @@ begin
             o_dc_hit => s_dc_hit
         );
 
+    -- synthesis translate_off
+    -- Counts what the cycles of the cpu went into, and reports it when the
+    -- memory gets dumped. A cache miss is counted when the cache starts
+    -- missing, and an access when it hits and the stage that made it goes on.
+    -- Stall cycles are given to the first of their causes, in the order the
+    -- control unit checks them. Bus waits are the cycles where both caches
+    -- miss, so that one of them waits for the arbiter to give it the bus.
+    PerformanceCounters: process (i_wb_clk, i_debug_dump)
+        variable icache_accesses, icache_misses: integer := 0;
+        variable dcache_accesses, dcache_misses: integer := 0;
+        variable icache_missing, dcache_missing: boolean := false;
+
+        variable btb_hits, btb_mispredictions: integer := 0;
+
+        variable dcache_stall_cycles: integer := 0;
+        variable icache_stall_cycles: integer := 0;
+        variable load_stall_cycles: integer := 0;
+        variable multicycle_stall_cycles: integer := 0;
+
+        variable multicycle_busy_cycles: integer := 0;
+        variable bus_wait_cycles: integer := 0;
+
+        variable icache_miss, dcache_miss, dcache_request: boolean;
+    begin
+        if rising_edge(i_wb_clk) and rst_n = '1' then
+            icache_miss := s_ic_rd_request = '1' and s_ic_hit = '0';
+            dcache_request := s_dc_rd_request = '1' or s_dc_wr_request = '1';
+            dcache_miss := dcache_request and s_dc_hit = '0';
+
+            if icache_miss and not icache_missing then
+                icache_misses := icache_misses + 1;
+            end if;
+            icache_missing := icache_miss;
+
+            if s_ic_rd_request = '1' and s_ic_hit = '1' and s_if_stall = '0' then
+                icache_accesses := icache_accesses + 1;
+            end if;
+
+            if dcache_miss and not dcache_missing then
+                dcache_misses := dcache_misses + 1;
+            end if;
+            dcache_missing := dcache_miss;
+
+            if dcache_request and s_dc_hit = '1' and s_mm_stall = '0' then
+                dcache_accesses := dcache_accesses + 1;
+            end if;
+
+            if s_if_btb_predict_will_branch = '1' and s_if_stall = '0' then
+                btb_hits := btb_hits + 1;
+            end if;
+
+            if s_mm_btb_mispredict = '1' and s_mm_stall = '0' then
+                btb_mispredictions := btb_mispredictions + 1;
+            end if;
+
+            if s_mm_dc_stall = '1' then
+                dcache_stall_cycles := dcache_stall_cycles + 1;
+            elsif s_if_ic_hit = '0' then
+                icache_stall_cycles := icache_stall_cycles + 1;
+            elsif s_mm_btb_mispredict = '1' then
+                -- Flushes, which are counted as mispredictions
+                null;
+            elsif s_ex_stall = '1' and s_mm_flush = '1' then
+                load_stall_cycles := load_stall_cycles + 1;
+            elsif s_ex_multicycle_busy = '1' then
+                multicycle_stall_cycles := multicycle_stall_cycles + 1;
+            end if;
+
+            if s_ex_multicycle_busy = '1' then
+                multicycle_busy_cycles := multicycle_busy_cycles + 1;
+            end if;
+
+            if icache_miss and dcache_miss then
+                bus_wait_cycles := bus_wait_cycles + 1;
+            end if;
+        end if;
+
+        if rising_edge(i_debug_dump) then
+            report "Performance counters:"
+            & " icache_hits=" & integer'image(icache_accesses - icache_misses)
+            & " icache_misses=" & integer'image(icache_misses)
+            & " dcache_hits=" & integer'image(dcache_accesses - dcache_misses)
+            & " dcache_misses=" & integer'image(dcache_misses)
+            & " btb_hits=" & integer'image(btb_hits)
+            & " btb_mispredictions=" & integer'image(btb_mispredictions)
+            & " dcache_stall_cycles=" & integer'image(dcache_stall_cycles)
+            & " icache_stall_cycles=" & integer'image(icache_stall_cycles)
+            & " load_stall_cycles=" & integer'image(load_stall_cycles)
+            & " multicycle_stall_cycles=" & integer'image(multicycle_stall_cycles)
+            & " multicycle_busy_cycles=" & integer'image(multicycle_busy_cycles)
+            & " bus_wait_cycles=" & integer'image(bus_wait_cycles);
+        end if;
+    end process PerformanceCounters;
+    -- synthesis translate_on
 end Structural;
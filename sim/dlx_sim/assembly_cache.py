@@ -0,0 +1,76 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+from pathlib import Path
+
+# Where the assembler output gets saved in every entry, so that it can be
+# printed again on a hit
+OUTPUT_FILE = "assembler.out"
+
+# Saves the artifacts of every program assembled, keyed by a hash of the
+# program's name, its source and the assembler, so that a program that didn't
+# change doesn't get assembled again.
+#
+# Every entry is a folder named after its key. Entries are written to a
+# temporary folder and then renamed, so that more processes can share the
+# cache: an entry either exists whole or doesn't exist.
+class AssemblyCache:
+    def __init__(self, path, assembler_path):
+        self.path = Path(path)
+        self.assembler_path = Path(assembler_path)
+
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, program_path):
+        digest = hashlib.sha256()
+        digest.update(program_path.stem.encode())
+        digest.update(b"\0")
+        digest.update(program_path.read_bytes())
+        digest.update(b"\0")
+        digest.update(self.assembler_path.read_bytes())
+
+        return digest.hexdigest()
+
+    # Puts the cached artifacts in outdir and returns the assembler output, or
+    # returns None if the key isn't cached
+    def restore(self, key, outdir):
+        path_entry = self.path / key
+        if not path_entry.is_dir():
+            self.misses += 1
+            return None
+
+        for artifact in path_entry.iterdir():
+            if artifact.name != OUTPUT_FILE:
+                link_or_copy(artifact, outdir / artifact.name)
+
+        self.hits += 1
+        return (path_entry / OUTPUT_FILE).read_text()
+
+    def store(self, key, artifacts, output):
+        path_entry = self.path / key
+        if path_entry.exists():
+            return
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        path_temp = Path(tempfile.mkdtemp(prefix=".tmp-", dir=self.path))
+
+        for artifact in artifacts:
+            shutil.copy2(artifact, path_temp / artifact.name)
+        (path_temp / OUTPUT_FILE).write_text(output)
+
+        try:
+            os.rename(path_temp, path_entry)
+        except OSError:
+            # Another process stored the same entry first
+            shutil.rmtree(path_temp)
+
+# Hard links are much cheaper than copies, but they only work inside the same
+# filesystem
+def link_or_copy(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
@@ -0,0 +1,126 @@
+import csv
+import sys
+
+from array import array
+
+import numpy as np
+
+# Geometries swept, all powers of two as the cache generics need: the sets,
+# the ways and the words per line
+SETS = [1, 2, 4, 8, 16, 32, 64]
+WAYS = [2, 4, 8, 16]
+LINE_SIZES = [2, 4, 8, 16, 32, 64]
+
+TABLE_COLUMNS = ["cache", "sets", "ways", "line_size", "size_words", "accesses", "misses", "hit_rate"]
+
+# Records the addresses of every fetch and of every load and store, in order.
+# It goes in place of a MemorySystemModel in PipelineTimingModel, without
+# adding any stall.
+class AccessRecorder:
+    def __init__(self):
+        self.fetches = array("I")
+        self.data = array("I")
+
+    def fetch(self, address, now):
+        self.fetches.append(address)
+        return 0
+
+    def load(self, address, now):
+        self.data.append(address)
+        return 0
+
+    def store(self, address, now):
+        self.data.append(address)
+        return 0
+
+# Mattson's stack algorithm, run on each set on its own. Returns hits, where
+# hits[w] is the number of accesses that hit in a LRU cache with w+1 ways, for
+# up to max_ways ways.
+#
+# An access hits with w ways if less than w other lines of its set were used
+# since the last access to its line, that is if its depth in the LRU stack of
+# the set is less than w. Lines deeper than max_ways miss with any number of
+# ways, so the stacks only need to be max_ways deep.
+def lru_hits(lines, sets, max_ways):
+    set_indexes = lines & (sets - 1)
+    order = np.argsort(set_indexes, kind="stable")
+    set_ends = np.cumsum(np.bincount(set_indexes, minlength=sets))
+
+    lines_by_set = lines[order].tolist()
+    depths = []
+
+    start = 0
+    for end in set_ends.tolist():
+        stack = []
+        for line in lines_by_set[start:end]:
+            try:
+                depth = stack.index(line)
+                del stack[depth]
+                depths.append(depth)
+            except ValueError:
+                if len(stack) == max_ways:
+                    stack.pop()
+
+            stack.insert(0, line)
+        start = end
+
+    histogram = np.bincount(np.array(depths, dtype=np.int64), minlength=max_ways)
+    return np.cumsum(histogram[:max_ways])
+
+# Returns a row for every geometry, with the hit rate of the given address
+# stream. The replacement is true LRU, which is what the RTL's pseudo-LRU does
+# with 2 ways, and close to it with more.
+def sweep_cache(name, addresses):
+    addresses = np.frombuffer(addresses, dtype=np.uint32).astype(np.int64)
+    accesses = len(addresses)
+    max_ways = WAYS[-1]
+
+    rows = []
+    for line_size in LINE_SIZES:
+        lines = addresses >> (2 + line_size.bit_length() - 1)
+
+        for sets in SETS:
+            hits = lru_hits(lines, sets, max_ways) if accesses > 0 else np.zeros(max_ways, dtype=np.int64)
+
+            for ways in WAYS:
+                way_hits = int(hits[ways - 1])
+                rows.append({
+                    "cache": name,
+                    "sets": sets,
+                    "ways": ways,
+                    "line_size": line_size,
+                    "size_words": sets * ways * line_size,
+                    "accesses": accesses,
+                    "misses": accesses - way_hits,
+                    "hit_rate": float(way_hits) / float(accesses) * 100.0 if accesses > 0 else 0.0,
+                })
+
+    return rows
+
+def sweep(recorder):
+    return sweep_cache("icache", recorder.fetches) + sweep_cache("dcache", recorder.data)
+
+def write_csv(rows, outfile):
+    writer = csv.DictWriter(outfile, fieldnames=TABLE_COLUMNS, lineterminator="\n")
+    writer.writeheader()
+    for row in rows:
+        writer.writerow({**row, "hit_rate": f"{row['hit_rate']:.2f}"})
+
+def write_markdown(rows, outfile):
+    outfile.write("| Cache | Sets | Ways | Line size | Size (words) | Accesses | Misses | Hit rate |\n")
+    outfile.write("|---|---:|---:|---:|---:|---:|---:|---:|\n")
+    for row in rows:
+        outfile.write(
+            f"| {row['cache']} | {row['sets']} | {row['ways']} | {row['line_size']} | {row['size_words']} "
+            f"| {row['accesses']} | {row['misses']} | {row['hit_rate']:.2f} % |\n"
+        )
+
+# Writes the table to path, or prints it if path is None
+def write_table(rows, table_format, path=None):
+    write = write_csv if table_format == "csv" else write_markdown
+
+    if path is None:
+        write(rows, sys.stdout)
+    else:
+        with open(path, "w", newline="") as outfile:
+            write(rows, outfile)
@@ -2,7 +2,7 @@
 
 import re
 
-from common import error, success, load_symbols, load_memory
+from common import error, success, load_memory
 
 def check_memory(args, line, memory, symbols):
     val_hex  = False
@@ -93,8 +93,7 @@ def check_output(filename, memory, symbols):
 
 
 
-def check(testrom_path, dump_path, path_symbols):
+def check(testrom_path, dump_path, symbols):
     memory = load_memory(dump_path)
-    symbols = load_symbols(path_symbols)
     check_output(testrom_path, memory, symbols)
 
@@ -115,31 +115,35 @@ def instruction_reverse_lookup(instruction_name):
 
 def write_trace_to_file(trace, path):
     with open(path, "w") as trace_file:
-        for instruction in trace:
-            opname = instruction.get_name()
-            opcode = instruction.opcode
-
-            trace_file.write(f"[{instruction.instruction_index}]: {opname:<5} ")
-
-            if instruction.registers is not None:
-                if opcode == inst.JTYPE_J or opcode == inst.JTYPE_JAL:
-                    trace_file.write(f"jmp_imm = {instruction.jtype_info[0]:08X}")
-                elif opcode == inst.RTYPE_OP:
-                    rd, rs1, rs2 = instruction.rtype_info
-                    rd_val = instruction.registers[rd]
-                    rs1_val = instruction.registers[rs1]
-                    rs2_val = instruction.registers[rs2]
-                    trace_file.write(f"r{rd}[{rd_val:08X}], r{rs1}[{rs1_val:08X}], r{rs2}[{rs2_val:08X}]")
-                else:
-                    rd, rs1, imm = instruction.itype_info
-                    rd_val = instruction.registers[rd]
-                    rs1_val = instruction.registers[rs1]
-                    trace_file.write(f"r{rd}[{rd_val:08X}], r{rs1}[{rs1_val:08X}], {imm:08X}")
-
-            if instruction.pc is not None:
-                trace_file.write(f" (pc = {instruction.pc:08X})")
-
-            trace_file.write("\n")
+        write_trace(trace, trace_file)
+
+# Writes the trace in text form to an already open file
+def write_trace(trace, trace_file):
+    for instruction in trace:
+        opname = instruction.get_name()
+        opcode = instruction.opcode
+
+        trace_file.write(f"[{instruction.instruction_index}]: {opname:<5} ")
+
+        if instruction.registers is not None:
+            if opcode == inst.JTYPE_J or opcode == inst.JTYPE_JAL:
+                trace_file.write(f"jmp_imm = {instruction.jtype_info[0]:08X}")
+            elif opcode == inst.RTYPE_OP:
+                rd, rs1, rs2 = instruction.rtype_info
+                rd_val = instruction.registers[rd]
+                rs1_val = instruction.registers[rs1]
+                rs2_val = instruction.registers[rs2]
+                trace_file.write(f"r{rd}[{rd_val:08X}], r{rs1}[{rs1_val:08X}], r{rs2}[{rs2_val:08X}]")
+            else:
+                rd, rs1, imm = instruction.itype_info
+                rd_val = instruction.registers[rd]
+                rs1_val = instruction.registers[rs1]
+                trace_file.write(f"r{rd}[{rd_val:08X}], r{rs1}[{rs1_val:08X}], {imm:08X}")
+
+        if instruction.pc is not None:
+            trace_file.write(f" (pc = {instruction.pc:08X})")
+
+        trace_file.write("\n")
 
 def load_symbols(path_symbols):
     symbols = {}
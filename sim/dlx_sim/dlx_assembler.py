@@ -0,0 +1,847 @@
+import re
+import struct
+
+from array import array
+
+# In-process port of assembler/dlxasm.pl. It gives the same .bin, .bin.hdr,
+# .sym and .list files, byte for byte, including the quirks of the original:
+#  - a label ends its line, so anything after it on the same line is ignored;
+#  - .data and .text without an address start from 0, and the sections share
+#    the same address space;
+#  - immediates are Perl expressions, where symbols are replaced by their value
+#    and undefined ones by 0;
+#  - registers are any character followed by a number (r1, f1, x1...), or the
+#    names of the special registers.
+# The -X assembly output of dlxasm.pl isn't supported, since nothing uses it.
+
+# Magic number at the start of the .bin.hdr file
+EXE_MAGIC = 0x444C5821
+
+START_LABEL = "_main"
+
+MASK64 = (1 << 64) - 1
+
+# Range of Perl's integers: past it, results become floating point
+IV_MIN = -(1 << 63)
+UV_MAX = MASK64
+
+INSTRUCTIONS = {
+    # Register-register instructions
+    "sll": ("r", 0x04),
+    "srl": ("r", 0x06),
+    "sra": ("r", 0x07),
+    "add": ("r", 0x20),
+    "addu": ("r", 0x21),
+    "sub": ("r", 0x22),
+    "subu": ("r", 0x23),
+    "and": ("r", 0x24),
+    "or": ("r", 0x25),
+    "xor": ("r", 0x26),
+    "seq": ("r", 0x28),
+    "sne": ("r", 0x29),
+    "slt": ("r", 0x2a),
+    "sgt": ("r", 0x2b),
+    "sle": ("r", 0x2c),
+    "sge": ("r", 0x2d),
+    "movi2s": ("r2", 0x30),
+    "movs2i": ("r2", 0x31),
+    "movf": ("r2", 0x32),
+    "movd": ("r2", 0x33),
+    "movfp2i": ("r2", 0x34),
+    "movi2fp": ("r2", 0x35),
+    "movi2t": ("r", 0x36),
+    "movt2i": ("r", 0x37),
+    "idiv": ("r", 0x38),
+    "imod": ("r", 0x39),
+    "imul": ("r", 0x3f),
+    "sltu": ("r", 0x3a),
+    "sgtu": ("r", 0x3b),
+    "sleu": ("r", 0x3c),
+    "sgeu": ("r", 0x3d),
+    # Floating-point instructions
+    "addf": ("f", 0x00),
+    "subf": ("f", 0x01),
+    "multf": ("f", 0x02),
+    "divf": ("f", 0x03),
+    "addd": ("f", 0x04),
+    "subd": ("f", 0x05),
+    "multd": ("f", 0x06),
+    "divd": ("f", 0x07),
+    "cvtf2d": ("fd", 0x08),
+    "cvtf2i": ("fd", 0x09),
+    "cvtd2f": ("fd", 0x0a),
+    "cvtd2i": ("fd", 0x0b),
+    "cvti2f": ("fd", 0x0c),
+    "cvti2d": ("fd", 0x0d),
+    "mult": ("f", 0x0e),
+    "div": ("f", 0x0f),
+    "eqf": ("f2", 0x10),
+    "nef": ("f2", 0x11),
+    "ltf": ("f2", 0x12),
+    "gtf": ("f2", 0x13),
+    "lef": ("f2", 0x14),
+    "gef": ("f2", 0x15),
+    "multu": ("f", 0x16),
+    "divu": ("f", 0x17),
+    "eqd": ("f2", 0x18),
+    "ned": ("f2", 0x19),
+    "ltd": ("f2", 0x1a),
+    "gtd": ("f2", 0x1b),
+    "led": ("f2", 0x1c),
+    "ged": ("f2", 0x1d),
+    # General instructions
+    "j": ("j", 0x02),
+    "jal": ("j", 0x03),
+    "beqz": ("b", 0x04),
+    "bnez": ("b", 0x05),
+    "bfpt": ("b0", 0x06),
+    "bfpf": ("b0", 0x07),
+    "addi": ("i", 0x08),
+    "addui": ("i", 0x09),
+    "subi": ("i", 0x0a),
+    "subui": ("i", 0x0b),
+    "andi": ("i", 0x0c),
+    "ori": ("i", 0x0d),
+    "xori": ("i", 0x0e),
+    "lhi": ("i1", 0x0f),
+    "rfe": ("n", 0x10),
+    "trap": ("t", 0x11),
+    "jr": ("jr", 0x12),
+    "jalr": ("jr", 0x13),
+    "slli": ("i", 0x14),
+    "nop": ("n", 0x15),
+    "srli": ("i", 0x16),
+    "srai": ("i", 0x17),
+    "seqi": ("i", 0x18),
+    "snei": ("i", 0x19),
+    "slti": ("i", 0x1a),
+    "sgti": ("i", 0x1b),
+    "slei": ("i", 0x1c),
+    "sgei": ("i", 0x1d),
+    "lb": ("l", 0x20),
+    "lh": ("l", 0x21),
+    "lw": ("l", 0x23),
+    "lbu": ("l", 0x24),
+    "lhu": ("l", 0x25),
+    "lf": ("l", 0x26),
+    "ld": ("l", 0x27),
+    "sb": ("s", 0x28),
+    "sh": ("s", 0x29),
+    "sw": ("s", 0x2b),
+    "sf": ("s", 0x2e),
+    "sd": ("s", 0x2f),
+    "itlb": ("n", 0x38),
+    "sltui": ("i", 0x3a),
+    "sgtui": ("i", 0x3b),
+    "sleui": ("i", 0x3c),
+    "sgeui": ("i", 0x3d),
+}
+
+SPECIAL_REGISTERS = {
+    "pc": 0,
+    "ir31": 2,
+    "isr": 3,
+    "iar": 4,
+    "status": 5,
+    "cause": 6,
+    "intrvec": 8,
+    "fault": 9,
+    "ptbase": 16,
+    "ptsize": 17,
+    "ptbits": 18,
+    "tlbentry": 20,
+    "tlbvaddr": 21,
+    "tlbpaddr": 22,
+}
+
+# Perl's \s, which unlike Python's doesn't match any non-ASCII character
+LEADING_SPACE_RE = re.compile(r"^[ \t\n\r\f\v]+")
+
+OP_RE = re.compile(r"^([a-zA-Z0-9:_.]+)")
+LABEL_RE = re.compile(r"^([a-zA-Z0-9_]+):$")
+COMMENT_RE = re.compile(r";.*")
+MEMORY_OPERAND_RE = re.compile(r"(.*)\((r[0-9]+)\)$")
+REGISTER_RE = re.compile(r"^.([0-9]+)", re.DOTALL)
+
+NUMBER_PREFIX_RE = re.compile(r"^[ \t\n\r\f\v]*([+-]?(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+)(?:[eE][+-]?[0-9]+)?)")
+
+EXPRESSION_TOKEN_RE = re.compile(
+    r"[ \t\n\r\f\v]*(?:"
+    r"(0[xX][0-9a-fA-F_]*|0[bB][01_]*|(?:[0-9][0-9_]*(?:\.[0-9_]*)?|\.[0-9][0-9_]*)(?:[eE][+-]?[0-9]+)?)"
+    r"|(\*\*|<<|>>|[-+*/%&|^~!()])"
+    r")"
+)
+
+class AssemblerError(Exception):
+    pass
+
+# Perl's conversion of a string to a number: the longest prefix that looks like
+# a decimal number, or 0
+def perl_number(text):
+    match = NUMBER_PREFIX_RE.match(text)
+    if match is None:
+        return 0
+
+    number = match.group(1)
+    if "." in number or "e" in number or "E" in number:
+        return float(number)
+    return int(number)
+
+# Perl's oct(), which also takes hexadecimal and binary numbers
+def perl_oct(text):
+    text = text.lstrip(" \t\n\r\f\v").replace("_", "")
+    lowered = text.lower()
+
+    if lowered.startswith("0x") or lowered.startswith("x"):
+        digits = re.match(r"^0?x([0-9a-f]*)", lowered).group(1)
+        return int(digits, 16) if digits != "" else 0
+    elif lowered.startswith("0b") or lowered.startswith("b"):
+        digits = re.match(r"^0?b([01]*)", lowered).group(1)
+        return int(digits, 2) if digits != "" else 0
+
+    digits = re.match(r"^([0-7]*)", text).group(1)
+    return int(digits, 8) if digits != "" else 0
+
+# Integer results that don't fit in Perl's integers become floating point
+def perl_value(value):
+    if isinstance(value, int) and not IV_MIN <= value <= UV_MAX:
+        return float(value)
+    return value
+
+# Perl's conversion to an unsigned integer, for bitwise operators and pack:
+# floating point numbers saturate, negative ones go through a signed integer
+def to_unsigned(value):
+    if isinstance(value, float):
+        if value != value:
+            return 0
+        elif value >= UV_MAX:
+            return UV_MAX
+        elif value <= IV_MIN:
+            return -IV_MIN
+        value = int(value)
+
+    return value & MASK64
+
+def format_hex(value, width):
+    return f"{to_unsigned(value):0{width}x}"
+
+# Evaluates the arithmetic subset of Perl expressions that immediates can use,
+# with Perl's semantics: bitwise operators and shifts work on 64 bit unsigned
+# integers, and / only gives an integer for exact divisions. Returns None if
+# the expression isn't valid, like Perl's eval does.
+class ExpressionEvaluator:
+    def __init__(self, text):
+        self.tokens = []
+
+        position = 0
+        text = text.rstrip(" \t\n\r\f\v")
+        while position < len(text):
+            match = EXPRESSION_TOKEN_RE.match(text, position)
+            if match is None or match.end() == position:
+                raise AssemblerError(f"invalid expression {text}")
+
+            if match.group(1) is not None:
+                self.tokens.append(("number", self.parse_number(match.group(1))))
+            else:
+                self.tokens.append(("op", match.group(2)))
+            position = match.end()
+
+        self.position = 0
+
+    @staticmethod
+    def parse_number(literal):
+        literal = literal.replace("_", "")
+        lowered = literal.lower()
+
+        if lowered.startswith("0x"):
+            return perl_value(int(literal[2:], 16))
+        elif lowered.startswith("0b"):
+            return perl_value(int(literal[2:], 2))
+        elif "." in literal or "e" in lowered:
+            return float(literal)
+        elif len(literal) > 1 and literal.startswith("0"):
+            return perl_value(int(literal, 8))
+        return perl_value(int(literal))
+
+    @staticmethod
+    def evaluate(text):
+        try:
+            evaluator = ExpressionEvaluator(text)
+            if len(evaluator.tokens) == 0:
+                return None
+
+            value = evaluator.parse_bitwise_or()
+            if evaluator.position != len(evaluator.tokens):
+                return None
+            return value
+        except (AssemblerError, ValueError, ZeroDivisionError, OverflowError, TypeError):
+            return None
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def accept(self, *ops):
+        kind, value = self.peek()
+        if kind == "op" and value in ops:
+            self.position += 1
+            return value
+        return None
+
+    def parse_bitwise_or(self):
+        value = self.parse_bitwise_and()
+        while True:
+            op = self.accept("|", "^")
+            if op is None:
+                return value
+
+            right = self.parse_bitwise_and()
+            if op == "|":
+                value = to_unsigned(value) | to_unsigned(right)
+            else:
+                value = to_unsigned(value) ^ to_unsigned(right)
+
+    def parse_bitwise_and(self):
+        value = self.parse_shift()
+        while self.accept("&") is not None:
+            value = to_unsigned(value) & to_unsigned(self.parse_shift())
+        return value
+
+    def parse_shift(self):
+        value = self.parse_additive()
+        while True:
+            op = self.accept("<<", ">>")
+            if op is None:
+                return value
+
+            amount = self.parse_additive()
+            amount = max(-64, min(64, amount)) if amount == amount else 0
+            amount = int(amount)
+            if op == ">>":
+                amount = -amount
+
+            if amount >= 64 or amount <= -64:
+                value = 0
+            elif amount >= 0:
+                value = (to_unsigned(value) << amount) & MASK64
+            else:
+                value = to_unsigned(value) >> -amount
+
+    def parse_additive(self):
+        value = self.parse_multiplicative()
+        while True:
+            op = self.accept("+", "-")
+            if op is None:
+                return value
+
+            right = self.parse_multiplicative()
+            value = perl_value(value + right if op == "+" else value - right)
+
+    def parse_multiplicative(self):
+        value = self.parse_unary()
+        while True:
+            op = self.accept("*", "/", "%")
+            if op is None:
+                return value
+
+            right = self.parse_unary()
+            if op == "*":
+                value = perl_value(value * right)
+            elif op == "/":
+                if isinstance(value, int) and isinstance(right, int) and value % right == 0:
+                    value = value // right
+                else:
+                    value = value / right
+            else:
+                value = perl_value(int(value) % int(right))
+
+    def parse_unary(self):
+        op = self.accept("!", "~", "-", "+")
+        if op is None:
+            return self.parse_power()
+
+        value = self.parse_unary()
+        if op == "!":
+            return 0 if value else 1
+        elif op == "~":
+            return ~to_unsigned(value) & MASK64
+        elif op == "-":
+            return perl_value(-value)
+        return value
+
+    def parse_power(self):
+        value = self.parse_term()
+        if self.accept("**") is not None:
+            value = perl_value(value ** self.parse_unary())
+        return value
+
+    def parse_term(self):
+        kind, value = self.peek()
+        if kind == "number":
+            self.position += 1
+            return value
+
+        if self.accept("(") is not None:
+            value = self.parse_bitwise_or()
+            if self.accept(")") is None:
+                raise AssemblerError("missing )")
+            return value
+
+        raise AssemblerError("expected a number")
+
+# The value of a string literal, as in Perl's eval of a single quoted or double
+# quoted string, or None if it isn't one. Without strict, barewords and
+# integers are strings too.
+def parse_string_literal(text):
+    text = text.rstrip(" \t\n\r\f\v")
+
+    bareword = re.match(r"^([A-Za-z_][A-Za-z0-9_]*|[0-9]+)[ \t\n\r\f\v]*(;.*)?$", text, re.ASCII | re.DOTALL)
+    if bareword is not None:
+        word = bareword.group(1)
+        return str(int(word)) if word[0].isdigit() else word
+
+    if len(text) < 2 or text[0] not in "\"'":
+        return None
+
+    quote = text[0]
+    value = []
+    i = 1
+    while i < len(text):
+        char = text[i]
+        if char == quote:
+            rest = text[i + 1:].lstrip(" \t\n\r\f\v")
+            if rest != "" and not rest.startswith(";"):
+                return None
+            return "".join(value)
+
+        if char == "\\" and i + 1 < len(text):
+            escaped = text[i + 1]
+            i += 2
+            if quote == "'":
+                value.append(escaped if escaped in "\\'" else "\\" + escaped)
+            elif escaped in DOUBLE_QUOTE_ESCAPES:
+                value.append(DOUBLE_QUOTE_ESCAPES[escaped])
+            elif escaped == "x":
+                digits = re.match(r"\{([0-9a-fA-F]*)\}|([0-9a-fA-F]{0,2})", text[i:])
+                hex_digits = digits.group(1) if digits.group(1) is not None else digits.group(2)
+                value.append(chr(int(hex_digits, 16) if hex_digits != "" else 0))
+                i += digits.end()
+            elif escaped in "01234567":
+                digits = re.match(r"[0-7]{0,2}", text[i:]).group(0)
+                value.append(chr(int(escaped + digits, 8) & 0xFF))
+                i += len(digits)
+            else:
+                value.append(escaped)
+            continue
+
+        value.append(char)
+        i += 1
+
+    return None
+
+DOUBLE_QUOTE_ESCAPES = {
+    "n": "\n",
+    "t": "\t",
+    "r": "\r",
+    "f": "\f",
+    "a": "\a",
+    "e": "\x1b",
+}
+
+# Splits like Perl's split, which drops the trailing empty fields
+def perl_split(pattern, text, maxsplit=0):
+    fields = re.split(pattern, text, maxsplit=maxsplit)
+    if maxsplit == 0:
+        while len(fields) > 0 and fields[-1] == "":
+            fields.pop()
+    return fields
+
+# Like Perl's <FILE>, every line keeps its newline
+def split_lines(source):
+    lines = source.split("\n")
+    last = lines.pop()
+
+    lines = [line + "\n" for line in lines]
+    if last != "":
+        lines.append(last)
+
+    return lines
+
+# Reads a .bin as big endian 32 bit words, dropping a trailing partial word
+def binary_to_words(binary):
+    words = array("I", binary[:len(binary) // 4 * 4])
+    if array("I", [1]).tobytes()[0] == 1:
+        words.byteswap()
+    return words
+
+# The .mem format read by the testbench and the emulator: a word per line, in
+# hex
+def mem_text(words):
+    return "".join(f"{word:08X}\n" for word in words)
+
+class AssembledProgram:
+    def __init__(self, binary, header, symbols, listing, text_end, data_end, output, warnings):
+        # The .bin and .bin.hdr files
+        self.binary = binary
+        self.header = header
+
+        # Label name -> address
+        self.symbols = symbols
+        self.listing = listing
+
+        # Addresses past the end of the text and data sections
+        self.text_end = text_end
+        self.data_end = data_end
+
+        # What dlxasm.pl prints to stdout and stderr
+        self.output = output
+        self.warnings = warnings
+
+    # The program as big endian 32 bit words, as loaded in memory
+    def words(self):
+        return binary_to_words(self.binary)
+
+    def mem_text(self):
+        return mem_text(self.words())
+
+    def symbols_text(self):
+        return "".join(f"{name:<20} {format_hex(self.symbols[name], 8)}\n" for name in sorted(self.symbols))
+
+    # Saves all the files dlxasm.pl would, and the .mem memory initialization
+    # file, as <outdir>/<progname>.*
+    def save(self, outdir, progname):
+        with open(outdir / f"{progname}.bin", "wb") as outfile:
+            outfile.write(self.binary)
+        with open(outdir / f"{progname}.bin.hdr", "wb") as outfile:
+            outfile.write(self.header)
+        with open(outdir / f"{progname}.list", "w", encoding="latin-1", newline="") as outfile:
+            outfile.write(self.listing)
+        with open(outdir / f"{progname}.sym", "w", encoding="latin-1", newline="") as outfile:
+            outfile.write(self.symbols_text())
+        with open(outdir / f"{progname}.mem", "w", newline="") as outfile:
+            outfile.write(self.mem_text())
+
+class Assembler:
+    def __init__(self, source, start_label=START_LABEL):
+        self.lines = split_lines(source)
+        self.start_label = start_label
+
+        self.symbols = {}
+        self.addresses = {"t": 0, "d": 0}
+
+        # dlxasm.pl keeps the start address of a section as written, until
+        # something gets added to it, and labels defined there get the text
+        # too, which is what ends up in their expressions
+        self.address_texts = {}
+        self.symbol_texts = {}
+        self.starts = {"t": -1, "d": -1}
+        self.section = "t"
+
+        self.passno = 1
+        self.lineno = 0
+
+        self.errors = []
+        self.warnings = []
+
+    def warn(self, message):
+        self.warnings.append(message)
+
+    def get_register(self, name):
+        name = (name or "").lower()
+
+        match = REGISTER_RE.match(name)
+        if match is not None:
+            return int(match.group(1))
+        elif name in SPECIAL_REGISTERS:
+            return SPECIAL_REGISTERS[name]
+
+        self.warn(f"Illegal register number ({name}) at line {self.lineno}.")
+        return 0
+
+    def get_immediate(self, text):
+        parts = re.split(r"\b", (text or "").replace("#", ""), flags=re.ASCII)
+
+        for i, part in enumerate(parts):
+            if re.match(r"^[_a-zA-Z]", part):
+                if part in self.symbols:
+                    parts[i] = self.symbol_texts.get(part, str(self.symbols[part]))
+                else:
+                    if self.passno != 1:
+                        self.warn(f"Undefined symbol: {part} at line {self.lineno}")
+                    parts[i] = "0"
+
+        value = ExpressionEvaluator.evaluate("".join(parts))
+        return 0 if value is None else value
+
+    def form_instruction(self, line):
+        line = COMMENT_RE.sub("", line.rstrip("\n") if line.endswith("\n") else line, count=1)
+        args = perl_split(r"[ \t\n\r\f\v,]+", line)
+        args += [None] * (4 - len(args))
+
+        itype, op = INSTRUCTIONS.get(args[0], ("", 0))
+        if itype == "":
+            self.warn(f"Illegal instruction ({args[0]}) at line {self.lineno}")
+            return 0
+
+        get_register = self.get_register
+        get_immediate = self.get_immediate
+
+        if itype.startswith("r"):
+            src1 = get_register(args[2])
+            src2 = get_register(args[3]) if itype == "r" else 0
+            dst = get_register(args[1])
+            return (src1 << 21) | (src2 << 16) | (dst << 11) | op
+        elif itype == "i":
+            src1 = get_register(args[2])
+            dst = get_register(args[1])
+            imm = get_immediate(args[3])
+            return (op << 26) | (src1 << 21) | (dst << 16) | (to_unsigned(imm) & 0xFFFF)
+        elif itype == "i1":
+            dst = get_register(args[1])
+            imm = get_immediate(args[2])
+            return (op << 26) | (dst << 16) | (to_unsigned(imm) & 0xFFFF)
+        elif itype == "n":
+            return op << 26
+        elif itype == "s" or itype == "l":
+            if itype == "s":
+                operand = args[1]
+                dst = get_register(args[2])
+            else:
+                operand = args[2]
+                dst = get_register(args[1])
+
+            match = MEMORY_OPERAND_RE.search(operand) if operand is not None else None
+            if match is not None and match.group(1) != "":
+                imm = get_immediate(match.group(1))
+            else:
+                imm = 0
+            src1 = get_register(match.group(2) if match is not None else None)
+            return (op << 26) | (src1 << 21) | (dst << 16) | (to_unsigned(imm) & 0xFFFF)
+        elif itype.startswith("f"):
+            if itype == "f":
+                dst = get_register(args[1])
+                src1 = get_register(args[2])
+                src2 = get_register(args[3])
+            elif itype == "f2":
+                src1 = get_register(args[1])
+                src2 = get_register(args[2])
+                dst = 0
+            else:
+                dst = get_register(args[1])
+                src1 = get_register(args[2])
+                src2 = 0
+            return 0x04000000 | (src1 << 21) | (src2 << 16) | (dst << 11) | op
+        elif itype.startswith("b"):
+            if itype == "b":
+                src1 = get_register(args[1])
+                dst = get_immediate(args[2])
+            else:
+                src1 = 0
+                dst = get_immediate(args[1])
+            # Like dlxasm.pl, the offset is always from the text section
+            dst = perl_value(dst - (self.addresses["t"] + 4))
+            return (op << 26) | (src1 << 21) | (to_unsigned(dst) & 0xFFFF)
+        elif itype == "j":
+            dst = perl_value(get_immediate(args[1]) - (self.addresses["t"] + 4))
+            return (op << 26) | (to_unsigned(dst) & 0x3FFFFFF)
+        elif itype == "jr":
+            dst = get_register(args[1])
+            return (op << 26) | (dst << 21)
+        elif itype == "t":
+            dst = get_immediate(args[1])
+            return (op << 26) | (to_unsigned(dst) & 0x3FFFFFF)
+
+        return 0
+
+    def get_ascii(self, line, zero_terminated):
+        text = re.sub(r"^\.ascii(z?)[ \t\n\r\f\v]+", "", line, count=1)
+        value = parse_string_literal(text)
+        data = (value or "").encode("latin-1", errors="replace")
+        if zero_terminated:
+            data += b"\0"
+        return data
+
+    def get_data(self, line, data_type):
+        line = COMMENT_RE.sub("", line, count=1)
+        args = perl_split(r"[ \t\n\r\f\v]*,[ \t\n\r\f\v]*", line)
+        args[0] = re.sub(r"\.[a-z]+[ \t\n\r\f\v]+", "", args[0], count=1)
+
+        if data_type == "byte":
+            return bytes(to_unsigned(self.get_immediate(arg)) & 0xFF for arg in args)
+        elif data_type == "word":
+            return b"".join(struct.pack(">I", to_unsigned(self.get_immediate(arg)) & 0xFFFFFFFF) for arg in args)
+        elif data_type == "float":
+            return b"".join(struct.pack("<f", perl_number(arg)) for arg in args)
+        return b"".join(struct.pack("<d", perl_number(arg)) for arg in args)
+
+    # Runs one pass over the source. Returns the listing on the second pass.
+    def run_pass(self, executable=None):
+        addresses = self.addresses
+        addresses["t"] = 0
+        addresses["d"] = 0
+        address_texts = self.address_texts
+        address_texts.clear()
+
+        listing = []
+
+        # dlxasm.pl takes the first word of every line from $1, which keeps
+        # the first group of the last successful match when the line doesn't
+        # start with one. Such lines still end up in the listing, unless that
+        # group is empty.
+        last_group = None
+
+        self.lineno = 0
+        for line in self.lines:
+            self.lineno += 1
+            address = addresses[self.section]
+            out = b""
+
+            stripped = LEADING_SPACE_RE.sub("", line)
+            if stripped != line:
+                last_group = None
+            line = stripped
+            current_line = line[:-1] if line.endswith("\n") else line
+
+            if line.startswith(";"):
+                last_group = None
+                if self.passno == 2:
+                    listing.append(f"{self.lineno:5d}  {'':20s}{current_line}\n")
+                continue
+
+            match = OP_RE.match(line)
+            if match is not None:
+                last_group = match.group(1)
+            if last_group is None or last_group == "":
+                continue
+            op = last_group
+
+            label = LABEL_RE.match(op)
+            directive = re.match(r"^\.(text|data|proc|endproc|global|ascii(z?)|byte|word|float|double)", line)
+            if label is not None:
+                last_group = label.group(1)
+            elif re.match(r"^[a-zA-Z]+", line) or line.startswith(".space") or line.startswith(".align"):
+                last_group = None
+            elif directive is not None:
+                last_group = directive.group(2) if directive.group(1).startswith("ascii") else directive.group(1)
+
+            if label is not None:
+                if self.passno == 1:
+                    self.symbols[label.group(1)] = addresses[self.section]
+                    if self.section in address_texts:
+                        self.symbol_texts[label.group(1)] = address_texts[self.section]
+                    else:
+                        self.symbol_texts.pop(label.group(1), None)
+            elif re.match(r"^[a-zA-Z]+", line):
+                if self.passno == 1:
+                    if self.section == "d":
+                        self.errors.append(f"Instructions not allowed in data segment (at line {self.lineno})")
+                else:
+                    out = struct.pack(">I", self.form_instruction(line) & 0xFFFFFFFF)
+                addresses[self.section] += 4
+                address_texts.pop(self.section, None)
+            elif re.match(r"^\.(text|data)", line):
+                fields = perl_split(r"[ \t\n\r\f\v]+", COMMENT_RE.sub("", line, count=1), 2)
+                self.section = fields[0][1:2]
+                start = fields[1] if len(fields) > 1 else ""
+                if start != "":
+                    if start.startswith("0"):
+                        addresses[self.section] = perl_oct(start)
+                        address_texts.pop(self.section, None)
+                    else:
+                        addresses[self.section] = perl_number(start)
+                        address_texts[self.section] = start
+                    if self.starts.get(self.section, -1) == -1:
+                        self.starts[self.section] = addresses[self.section]
+            elif re.match(r"^\.(proc|endproc|global)", line):
+                pass
+            elif line.startswith(".space"):
+                fields = perl_split(r"[ \t\n\r\f\v]+", line, 2)
+                if self.section == "t":
+                    self.errors.append(f".space can't be used in the text segment (at line {self.lineno})!")
+                addresses[self.section] += perl_number(fields[1] if len(fields) > 1 else "")
+                address_texts.pop(self.section, None)
+            elif line.startswith(".ascii"):
+                out = self.get_ascii(line, line.startswith(".asciiz"))
+                addresses[self.section] += len(out)
+                address_texts.pop(self.section, None)
+            elif re.match(r"^\.(byte|word|float|double)", line):
+                data_type = re.match(r"^\.(byte|word|float|double)", line).group(1)
+                out = self.get_data(line, data_type)
+                addresses[self.section] += len(out)
+                address_texts.pop(self.section, None)
+            elif line.startswith(".align"):
+                fields = perl_split(r"[ \t\n\r\f\v]+", line, 2)
+                mask = (1 << int(perl_number(fields[1] if len(fields) > 1 else ""))) - 1
+                if int(addresses[self.section]) & mask != 0:
+                    addresses[self.section] = (int(addresses[self.section]) + mask) & ~mask & MASK64
+                    address_texts.pop(self.section, None)
+
+            if self.passno == 2:
+                if len(out) > 0:
+                    start = int(address)
+                    if start > len(executable):
+                        raise AssemblerError(f"substr outside of string at line {self.lineno}")
+                    executable[start:start + len(out)] = out
+
+                data = out.hex() if len(out) > 0 else " "
+                for i in range(0, len(data), 8):
+                    listing.append(f"{self.lineno:5d}  {format_hex(address, 8)}  {data[i:i + 8]:<8s}\t{current_line}\n")
+                    address += 4
+                    current_line = ""
+
+        return "".join(listing)
+
+    def assemble(self):
+        output = ["Starting pass 1.\n"]
+        self.passno = 1
+        self.run_pass()
+
+        if len(self.errors) > 0:
+            raise AssemblerError("\n".join(self.errors + ["Errors occurred during assembly."]))
+
+        max_data_address = self.addresses["d"]
+        max_text_address = self.addresses["t"]
+        start_location = self.symbols.get(self.start_label, 0)
+        end_address = int(max(max_text_address, max_data_address))
+
+        for section in ("t", "d"):
+            if self.starts[section] == -1:
+                self.starts[section] = 0
+
+        header = struct.pack(
+            "<9I",
+            *(to_unsigned(value) & 0xFFFFFFFF for value in (
+                EXE_MAGIC, end_address, start_location,
+                self.starts["t"], max_text_address - self.starts["t"],
+                self.starts["d"], max_data_address - self.starts["d"],
+                0, 0
+            ))
+        )
+        executable = bytearray(end_address)
+
+        output.append("Starting pass 2.\n")
+        self.passno = 2
+        listing = f"{'line':>5s}  {'address':>8s}\t{'contents':>8s}\n" + self.run_pass(executable)
+
+        output.append(f"Last text address: 0x{to_unsigned(self.addresses['t']):x}\n")
+        output.append(f"Last data address: 0x{to_unsigned(self.addresses['d']):x}\n")
+
+        return AssembledProgram(
+            binary=bytes(executable),
+            header=header,
+            symbols=dict(self.symbols),
+            listing=listing,
+            text_end=self.addresses["t"],
+            data_end=self.addresses["d"],
+            output="".join(output),
+            warnings=self.warnings,
+        )
+
+# Assembles the source of a program. Raises AssemblerError if it has errors.
+def assemble(source, start_label=START_LABEL):
+    return Assembler(source, start_label).assemble()
+
+def assemble_file(path, start_label=START_LABEL):
+    with open(path, "r", encoding="latin-1", newline="") as infile:
+        return assemble(infile.read(), start_label)
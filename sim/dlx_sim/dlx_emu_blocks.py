@@ -0,0 +1,334 @@
+from array import array
+
+from dlx_emu_cpu import DLXCpu, DECODED_DEST, DECODED_INSTRUCTION, DECODED_OPCODE, DECODED_PC, MASK, SIGN, LINK_REGISTER, NO_DEST, STOP_FINISHED
+from dlx_instructions import *
+
+# Upper bound on the number of instructions translated in a single block
+MAX_BLOCK_LENGTH = 256
+
+# Number of times a block gets interpreted before being compiled
+COMPILE_THRESHOLD = 8
+
+# Python statements for the instructions that get translated inline. They're
+# formatted with the a, b and c operands of the decoded instruction (see
+# dlx_emu_cpu.py for their meaning). Instructions not listed here call their
+# DLXCpu handler instead.
+ITYPE_TEMPLATES = {
+    ITYPE_ADDI: "regs[{a}] = (regs[{b}] + {c}) & MASK",
+    ITYPE_ADDUI: "regs[{a}] = (regs[{b}] + {c}) & MASK",
+    ITYPE_SUBI: "regs[{a}] = (regs[{b}] - {c}) & MASK",
+    ITYPE_SUBUI: "regs[{a}] = (regs[{b}] - {c}) & MASK",
+    ITYPE_SEQI: "regs[{a}] = int(regs[{b}] == {c})",
+    ITYPE_SGEI: "regs[{a}] = int((regs[{b}] ^ SIGN) - SIGN >= {c})",
+    ITYPE_SGEUI: "regs[{a}] = int(regs[{b}] >= {c})",
+    ITYPE_SGTI: "regs[{a}] = int((regs[{b}] ^ SIGN) - SIGN > {c})",
+    ITYPE_SGTUI: "regs[{a}] = int((regs[{b}] ^ SIGN) - SIGN > {c})",
+    ITYPE_SLEI: "regs[{a}] = int((regs[{b}] ^ SIGN) - SIGN <= {c})",
+    ITYPE_SLEUI: "regs[{a}] = int(regs[{b}] <= {c})",
+    ITYPE_SLTI: "regs[{a}] = int((regs[{b}] ^ SIGN) - SIGN < {c})",
+    ITYPE_SLTUI: "regs[{a}] = int(regs[{b}] < {c})",
+    ITYPE_SNEI: "regs[{a}] = int(regs[{b}] != {c})",
+    ITYPE_ANDI: "regs[{a}] = regs[{b}] & {c}",
+    ITYPE_ORI: "regs[{a}] = regs[{b}] | {c}",
+    ITYPE_XORI: "regs[{a}] = regs[{b}] ^ {c}",
+    ITYPE_LW: "regs[{a}] = read(regs[{b}] + {c}) & MASK",
+    ITYPE_SW: "write(regs[{b}] + {c}, regs[{a}])",
+    ITYPE_LHI: "regs[{a}] = {c}",
+    ITYPE_NOP: None,
+    ITYPE_SLLI: "regs[{a}] = (regs[{b}] << {c}) & MASK",
+    ITYPE_SRLI: "regs[{a}] = regs[{b}] >> {c}",
+}
+
+RTYPE_TEMPLATES = {
+    FUNC_ADD: "regs[{a}] = (regs[{b}] + regs[{c}]) & MASK",
+    FUNC_ADDU: "regs[{a}] = (regs[{b}] + regs[{c}]) & MASK",
+    FUNC_SUB: "regs[{a}] = (regs[{b}] - regs[{c}]) & MASK",
+    FUNC_SUBU: "regs[{a}] = (regs[{b}] - regs[{c}]) & MASK",
+    FUNC_SEQ: "regs[{a}] = int(regs[{b}] == regs[{c}])",
+    FUNC_SGE: "regs[{a}] = int((regs[{b}] ^ SIGN) >= (regs[{c}] ^ SIGN))",
+    FUNC_SGEU: "regs[{a}] = int(regs[{b}] >= regs[{c}])",
+    FUNC_SGT: "regs[{a}] = int((regs[{b}] ^ SIGN) > (regs[{c}] ^ SIGN))",
+    FUNC_SGTU: "regs[{a}] = int(regs[{b}] > regs[{c}])",
+    FUNC_SLE: "regs[{a}] = int((regs[{b}] ^ SIGN) <= (regs[{c}] ^ SIGN))",
+    FUNC_SLEU: "regs[{a}] = int(regs[{b}] <= regs[{c}])",
+    FUNC_SLT: "regs[{a}] = int((regs[{b}] ^ SIGN) < (regs[{c}] ^ SIGN))",
+    FUNC_SLTU: "regs[{a}] = int(regs[{b}] < regs[{c}])",
+    FUNC_SNE: "regs[{a}] = int(regs[{b}] != regs[{c}])",
+    FUNC_AND: "regs[{a}] = regs[{b}] & regs[{c}]",
+    FUNC_OR: "regs[{a}] = regs[{b}] | regs[{c}]",
+    FUNC_XOR: "regs[{a}] = regs[{b}] ^ regs[{c}]",
+    FUNC_SLL: "regs[{a}] = (regs[{b}] << (regs[{c}] & 0x1F)) & MASK",
+    FUNC_SRL: "regs[{a}] = regs[{b}] >> (regs[{c}] & 0x1F)",
+    FUNC_IMUL: "regs[{a}] = (regs[{b}] * regs[{c}]) & MASK",
+}
+
+# Instructions that end a block. {fall} is the address of the next instruction.
+TERMINATOR_TEMPLATES = {
+    ITYPE_BEQZ: "if regs[{a}] == 0:\n    return {b}\nreturn {fall}",
+    ITYPE_BNEZ: "if regs[{a}] != 0:\n    return {b}\nreturn {fall}",
+    ITYPE_JR: "return regs[{a}]",
+    ITYPE_JALR: f"regs[{LINK_REGISTER}] = {{b}}\nreturn regs[{{a}}]",
+    JTYPE_J: "return {a}",
+    JTYPE_JAL: f"regs[{LINK_REGISTER}] = {{b}}\nreturn {{a}}",
+}
+
+# Stores also end a block: they can terminate the program or overwrite the
+# instructions that follow them.
+STORE_OPS = {ITYPE_SB, ITYPE_SH, ITYPE_SW}
+
+class TranslatedBlock:
+    __slots__ = (
+        "start", "end", "instructions", "length", "counted",
+        "trace_pcs", "trace_instructions", "trace_dests",
+        "successors", "valid", "runs", "function", "traced_function",
+    )
+
+    def __init__(self, start, end, instructions):
+        self.start = start
+        self.end = end
+
+        # Decoded instructions in the block, nops included
+        self.instructions = instructions
+        self.length = len(instructions)
+
+        # The columns of the trace that don't depend on the register values,
+        # for the instructions that get recorded (all but nops)
+        traced = [decoded for decoded in instructions if decoded[DECODED_OPCODE] != ITYPE_NOP]
+        self.counted = len(traced)
+        self.trace_pcs = array("I", [decoded[DECODED_PC] for decoded in traced])
+        self.trace_instructions = array("I", [decoded[DECODED_INSTRUCTION] for decoded in traced])
+        self.trace_dests = array("b", [decoded[DECODED_DEST] for decoded in traced])
+
+        # Maps the pcs that the block jumped to to their block
+        self.successors = {}
+        self.valid = True
+
+        # Both functions take the values column of the trace (None if not
+        # tracing), and return the next pc. function is used when not tracing,
+        # and traced_function when tracing. The block is interpreted until it
+        # has run COMPILE_THRESHOLD times, so that code that only runs a few
+        # times doesn't pay for compiling it.
+        self.runs = 0
+        self.function = None
+        self.traced_function = None
+
+# A DLXCpu that translates each basic block to a Python function, and then runs
+# whole blocks at a time.
+class DLXBlockCpu(DLXCpu):
+    def __init__(self, bus, start_pc):
+        super().__init__(bus, start_pc)
+
+        self.blocks = {}
+        # Maps the address of every instruction word to the blocks including it
+        self.blocks_by_word = {}
+
+        self.namespace = {
+            "regs": self.registers,
+            "read": bus.read,
+            "write": bus.write,
+            "MASK": MASK,
+            "SIGN": SIGN,
+        }
+
+    def invalidate(self, addr):
+        super().invalidate(addr)
+
+        for block in self.blocks_by_word.pop(addr, ()):
+            block.valid = False
+            if self.blocks.get(block.start) is block:
+                del self.blocks[block.start]
+
+            # The other words of the block don't need to keep it anymore
+            for word in range(block.start, block.end, 4):
+                others = self.blocks_by_word.get(word)
+                if others is None:
+                    continue
+                others = [other for other in others if other is not block]
+                if len(others) > 0:
+                    self.blocks_by_word[word] = others
+                else:
+                    del self.blocks_by_word[word]
+
+    # Returns the block starting at start, or None if the instruction at start
+    # is not valid.
+    def find_block(self, start):
+        pc = start
+        instructions = []
+
+        while len(instructions) < MAX_BLOCK_LENGTH:
+            try:
+                decoded = self.decoded[pc]
+            except KeyError:
+                decoded = self.decode(pc)
+
+            handler, opcode = decoded[0], decoded[DECODED_OPCODE]
+
+            # Invalid instructions are left to the interpreter
+            if handler is None:
+                break
+
+            instructions.append(decoded)
+            pc += 4
+
+            if opcode in TERMINATOR_TEMPLATES or opcode in STORE_OPS:
+                break
+
+        if len(instructions) == 0:
+            return None
+
+        block = TranslatedBlock(start, pc, instructions)
+        block.function = self.make_interpreted_function(block)
+        block.traced_function = block.function
+        self.blocks[start] = block
+
+        for addr in range(start, pc, 4):
+            self.blocks_by_word.setdefault(addr & ~3, []).append(block)
+
+        return block
+
+    def make_interpreted_function(self, block):
+        regs = self.registers
+        steps = [
+            (decoded[0], decoded[1], decoded[2], decoded[3], decoded[DECODED_DEST], decoded[DECODED_OPCODE] != ITYPE_NOP)
+            for decoded in block.instructions
+        ]
+        end = block.end
+
+        def run_interpreted(values):
+            block.runs += 1
+            if block.runs >= COMPILE_THRESHOLD:
+                if values is None:
+                    block.function = self.compile_block(block, traced=False)
+                else:
+                    block.traced_function = self.compile_block(block, traced=True)
+
+            next_pc = None
+            for handler, a, b, c, dest, recorded in steps:
+                next_pc = handler(a, b, c)
+                if values is not None and recorded:
+                    values.append(regs[dest] if dest != NO_DEST else 0)
+
+            return end if next_pc is None else next_pc
+
+        return run_interpreted
+
+    # If traced is True, the function also appends the value written by each
+    # instruction to the values column of the trace.
+    def compile_block(self, block, traced):
+        lines = []
+        terminator = None
+        written_values = []
+
+        for decoded in block.instructions:
+            handler, a, b, c, opcode, func = decoded[:6]
+            pc, dest = decoded[DECODED_PC], decoded[DECODED_DEST]
+
+            if opcode in TERMINATOR_TEMPLATES:
+                terminator = TERMINATOR_TEMPLATES[opcode].format(a=a, b=b, fall=pc+4)
+                # jal and jalr write the link register, which is known already
+                written_values.append(str(b) if dest != NO_DEST else "0")
+                continue
+
+            if opcode == RTYPE_OP and func in RTYPE_TEMPLATES:
+                template = RTYPE_TEMPLATES[func]
+            elif opcode != RTYPE_OP and opcode in ITYPE_TEMPLATES:
+                template = ITYPE_TEMPLATES[opcode]
+            else:
+                handler_name = f"handler_{pc:08x}"
+                self.namespace[handler_name] = handler
+                template = handler_name + "({a}, {b}, {c})"
+
+            if template is None:
+                continue
+
+            lines.append(template.format(a=a, b=b, c=c))
+
+            if traced and dest != NO_DEST:
+                lines.append(f"v{len(written_values)} = regs[{dest}]")
+                written_values.append(f"v{len(written_values)}")
+            else:
+                written_values.append("0")
+
+        if traced and len(written_values) > 0:
+            lines.append(f"values.extend(({', '.join(written_values)},))")
+
+        if terminator is not None:
+            lines.extend(terminator.split("\n"))
+        else:
+            lines.append(f"return {block.end}")
+
+        name = f"block_{block.start:08x}"
+        source = f"def {name}(values):\n" + "".join(f"    {line}\n" for line in lines)
+        exec(source, self.namespace)
+
+        return self.namespace.pop(name)
+
+    # Same as DLXCpu.run, but runs whole blocks at a time. Whatever can't run
+    # as a block (invalid instructions, or a block longer than the instructions
+    # left) is left to the interpreter. With a profile, whole blocks get counted.
+    def run(self, max_instructions, trace=None, profile=None):
+        bus = self.bus
+        blocks = self.blocks
+
+        tracing = trace is not None
+        values = trace.values if tracing else None
+
+        profiling = profile is not None
+        if profiling:
+            block_runs = profile.block_runs
+            stack_ops = profile.STACK_OPS
+
+        pc = self.pc
+        remaining = max_instructions
+        instructions_run = self.instructions_run
+
+        block = None
+        stop_reason = None
+
+        try:
+            while True:
+                next_block = None if block is None else block.successors.get(pc)
+
+                if next_block is None or not next_block.valid:
+                    next_block = blocks.get(pc)
+                    if next_block is None:
+                        next_block = self.find_block(pc)
+                        if next_block is None:
+                            break
+
+                    if block is not None:
+                        block.successors[pc] = next_block
+
+                block = next_block
+                if block.length > remaining:
+                    break
+
+                if tracing:
+                    trace.pcs.extend(block.trace_pcs)
+                    trace.instructions.extend(block.trace_instructions)
+                    trace.dests.extend(block.trace_dests)
+                    pc = block.traced_function(values)
+                else:
+                    pc = block.function(None)
+
+                remaining -= block.length
+                instructions_run += block.counted
+
+                if profiling:
+                    block_runs[block] = block_runs.get(block, 0) + 1
+                    last = block.instructions[-1]
+                    if last[4] in stack_ops:
+                        profile.control(last[4], last[1], pc, self.cycle + max_instructions - remaining)
+
+                if bus.finished:
+                    stop_reason = STOP_FINISHED
+                    break
+        finally:
+            self.pc = pc
+            self.cycle += max_instructions - remaining
+            self.instructions_run = instructions_run
+
+        if stop_reason is None:
+            return DLXCpu.run(self, remaining, trace, profile)
+
+        return stop_reason, self.instructions_run, self.cycle
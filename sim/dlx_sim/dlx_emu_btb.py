@@ -0,0 +1,135 @@
+from array import array
+
+# BTB_LINES_WIDTH of the DLX entity
+DEFAULT_BTB_LINES_WIDTH = 4
+
+# Instructions flushed when a branch gets mispredicted
+MISPREDICT_PENALTY = 3
+
+# Model of the branch target buffer in 01-BTB.vhd, with 2**lines_width lines.
+#
+# Every line holds the pc after a taken branch (the key the fetch stage looks
+# it up with) and the branch target. Branches are resolved in the memory
+# stage, where:
+#  - a taken branch that wasn't in the BTB goes in the first invalid line, or,
+#    if they're all valid, replaces the first line whose replace bit is clear,
+#    setting it. Once all replace bits are set, they're cleared and line 0 is
+#    replaced;
+#  - a not taken branch that was in the BTB gets invalidated;
+#  - a taken branch whose target changed gets the new target.
+# All three are mispredictions, and flush the pipeline. Since the BTB is only
+# written on mispredictions, which also flush every instruction fetched after
+# the branch, each branch sees the BTB as left by all the previous ones.
+class BTBModel:
+    def __init__(self, lines_width=DEFAULT_BTB_LINES_WIDTH):
+        self.lines_width = lines_width
+        self.lines = 2 ** lines_width
+
+        self.keys = [0] * self.lines
+        self.targets = [0] * self.lines
+        self.valid = [False] * self.lines
+        self.replaced = [False] * self.lines
+
+        self.branches = 0
+        self.mispredictions = 0
+
+    def find(self, key):
+        for i in range(self.lines):
+            if self.valid[i] and self.keys[i] == key:
+                return i
+        return None
+
+    # Returns whether the branch at pc was mispredicted, updating the BTB
+    def resolve(self, pc, taken, target):
+        self.branches += 1
+
+        key = pc + 4
+        line = self.find(key)
+
+        if not taken:
+            if line is None:
+                return False
+            self.valid[line] = False
+        elif line is None:
+            self.insert(key, target)
+        elif self.targets[line] != target:
+            # Like the RTL, this looks for the first line with the same key,
+            # valid or not
+            self.targets[self.keys.index(key)] = target
+        else:
+            return False
+
+        self.mispredictions += 1
+        return True
+
+    def insert(self, key, target):
+        if False in self.valid:
+            line = self.valid.index(False)
+        elif False in self.replaced:
+            line = self.replaced.index(False)
+            self.replaced[line] = True
+        else:
+            line = 0
+            self.replaced = [False] * self.lines
+            self.replaced[0] = True
+
+        self.keys[line] = key
+        self.targets[line] = target
+        self.valid[line] = True
+
+    def accuracy(self):
+        if self.branches == 0:
+            return 0
+        return float(self.branches - self.mispredictions) / float(self.branches) * 100.0
+
+# Goes in place of the predictor of a PipelineTimingModel, recording every
+# branch and jump, and passing it on to the given predictor.
+class BranchRecorder:
+    def __init__(self, predictor):
+        self.predictor = predictor
+
+        self.pcs = array("I")
+        self.taken = array("B")
+        self.targets = array("I")
+
+    def resolve(self, pc, taken, target):
+        self.pcs.append(pc)
+        self.taken.append(taken)
+        self.targets.append(target)
+
+        return self.predictor.resolve(pc, taken, target)
+
+# Replays the recorded branches on a BTB of every given width. timing is the
+# model the branches were recorded with, and is used to estimate the CPI with
+# each BTB. Returns a row for each width.
+def sweep_btb(recorder, timing, widths):
+    base_cycles = timing.estimated_cycles() - timing.branch_flush_cycles()
+    instructions = timing.instructions
+
+    rows = []
+    for lines_width in widths:
+        btb = BTBModel(lines_width)
+        for pc, taken, target in zip(recorder.pcs, recorder.taken, recorder.targets):
+            btb.resolve(pc, taken, target)
+
+        flush_cycles = btb.mispredictions * MISPREDICT_PENALTY
+        rows.append({
+            "lines_width": lines_width,
+            "lines": btb.lines,
+            "branches": btb.branches,
+            "mispredictions": btb.mispredictions,
+            "accuracy": btb.accuracy(),
+            "mpki": float(btb.mispredictions) * 1000.0 / float(instructions) if instructions > 0 else 0.0,
+            "flush_cycles": flush_cycles,
+            "cpi": float(base_cycles + flush_cycles) / float(instructions) if instructions > 0 else 0.0,
+        })
+
+    return rows
+
+def print_btb_table(rows):
+    print(f"{'Width':>5} {'Lines':>6} {'Branches':>9} {'Mispred.':>9} {'Accuracy':>9} {'MPKI':>8} {'Flush cycles':>13} {'CPI':>6}")
+    for row in rows:
+        print(
+            f"{row['lines_width']:>5} {row['lines']:>6} {row['branches']:>9} {row['mispredictions']:>9} "
+            f"{row['accuracy']:>8.2f}% {row['mpki']:>8.2f} {row['flush_cycles']:>13} {row['cpi']:>6.2f}"
+        )
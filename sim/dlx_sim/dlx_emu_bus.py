@@ -1,43 +1,231 @@
+import sys
+
+from array import array
+
+MASK = 0xFFFF_FFFF
+
+# Memory is split in pages, which are only allocated the first time they're
+# written to. Reading a page that was never written returns zeros.
+PAGE_SHIFT = 12
+PAGE_SIZE = 1 << PAGE_SHIFT
+PAGE_BYTE_MASK = PAGE_SIZE - 1
+PAGE_WORD_MASK = (PAGE_SIZE // 4) - 1
+
+# Size of the memory that always gets dumped, even if it was never touched.
+# This was the whole memory of the emulator before it supported the full
+# address space.
+DUMP_SIZE = 2**14
+
+WORD_TYPECODE = "I" if array("I").itemsize == 4 else "L"
+
+# Byte 0 of a word is its least significant byte. The byte and halfword views
+# of a page follow the host's byte order, so on big endian hosts the index
+# inside each word has to be flipped.
+if sys.byteorder == "little":
+    BYTE_SWAP = 0
+    HALFWORD_SWAP = 0
+else:
+    BYTE_SWAP = 3
+    HALFWORD_SWAP = 1
+
 class MemoryBus:
     def __init__(self, memory):
-        self.memory = [0] * 2**12
+        # Maps page numbers to the page's words, and to byte and halfword
+        # views of the same memory
+        self.pages = {}
+        self.byte_pages = {}
+        self.halfword_pages = {}
 
-        for i, word in enumerate(memory):
-            self.memory[i] = word
+        words_per_page = PAGE_SIZE // 4
+        for start in range(0, len(memory), words_per_page):
+            page = self.allocate_page(start // words_per_page)
+            chunk = memory[start:start + words_per_page]
+            page[:len(chunk)] = array(WORD_TYPECODE, chunk)
 
         self.finished = False
 
+        # Addresses of the words that have been decoded as instructions, and
+        # the functions to call when one of them gets overwritten
+        self.code_words = set()
+        self.code_write_listeners = []
+
+    def allocate_page(self, page_number):
+        page = array(WORD_TYPECODE, bytes(PAGE_SIZE))
+        view = memoryview(page).cast("B")
+
+        self.pages[page_number] = page
+        self.byte_pages[page_number] = view
+        self.halfword_pages[page_number] = view.cast("H")
+
+        return page
+
+    def watch_code(self, addr):
+        self.code_words.add(addr & ~3)
+
+    def add_code_write_listener(self, listener):
+        self.code_write_listeners.append(listener)
+
+    def invalidate_code(self, addr):
+        self.code_words.discard(addr)
+        for listener in self.code_write_listeners:
+            listener(addr)
+
     def is_finished(self):
         return self.finished
 
     def read(self, addr):
-        if addr/4 > len(self.memory) or addr//4 < 0:
-            print(f"Invalid memory address {addr:08X}")
+        page = self.pages.get((addr & MASK) >> PAGE_SHIFT)
+        if page is None:
             return 0
-        return self.memory[addr//4]
+
+        return page[(addr >> 2) & PAGE_WORD_MASK]
+
+    # Instruction fetches go through here instead of read, so that they aren't
+    # taken for loads by a RecordingMemoryBus
+    def fetch(self, addr):
+        return MemoryBus.read(self, addr)
 
     def read_byte(self, addr):
-        if addr//4 > len(self.memory) or addr//4 < 0:
-            print(f"Invalid memory address {addr:08X}")
+        page = self.byte_pages.get((addr & MASK) >> PAGE_SHIFT)
+        if page is None:
             return 0
 
-        return (self.memory[addr//4] >> ((addr % 4) * 8)) & 0xFF
+        return page[(addr & PAGE_BYTE_MASK) ^ BYTE_SWAP]
 
+    # As in the LoadStoreUnit, the lowest bit of the address is ignored
     def read_halfword(self, addr):
-        if addr//4 > len(self.memory) or addr//4 < 0:
-            print(f"Invalid memory address {addr:08X}")
+        page = self.halfword_pages.get((addr & MASK) >> PAGE_SHIFT)
+        if page is None:
             return 0
-        memval = self.memory[addr//4]
-        shift = (addr % 4) * 8
-        read_value = (memval >> shift) & 0xFFFF
 
-        return read_value
+        return page[((addr & PAGE_BYTE_MASK) >> 1) ^ HALFWORD_SWAP]
 
     def write(self, addr, value):
+        addr &= MASK
         if (addr & 0xFFFF0000) == 0xFFFF0000:
             self.finished = True
             return
 
-        if addr//4 > len(self.memory) or addr//4 < 0:
-            print(f"Invalid memory address {addr:08X}")
-        self.memory[addr//4] = value
+        page = self.pages.get(addr >> PAGE_SHIFT)
+        if page is None:
+            page = self.allocate_page(addr >> PAGE_SHIFT)
+
+        page[(addr >> 2) & PAGE_WORD_MASK] = value
+
+        if addr & ~3 in self.code_words:
+            self.invalidate_code(addr & ~3)
+
+    def write_byte(self, addr, value):
+        addr &= MASK
+        if (addr & 0xFFFF0000) == 0xFFFF0000:
+            self.finished = True
+            return
+
+        page = self.byte_pages.get(addr >> PAGE_SHIFT)
+        if page is None:
+            self.allocate_page(addr >> PAGE_SHIFT)
+            page = self.byte_pages[addr >> PAGE_SHIFT]
+
+        page[(addr & PAGE_BYTE_MASK) ^ BYTE_SWAP] = value & 0xFF
+
+        if addr & ~3 in self.code_words:
+            self.invalidate_code(addr & ~3)
+
+    # As in the LoadStoreUnit, the lowest bit of the address is ignored
+    def write_halfword(self, addr, value):
+        addr &= MASK
+        if (addr & 0xFFFF0000) == 0xFFFF0000:
+            self.finished = True
+            return
+
+        page = self.halfword_pages.get(addr >> PAGE_SHIFT)
+        if page is None:
+            self.allocate_page(addr >> PAGE_SHIFT)
+            page = self.halfword_pages[addr >> PAGE_SHIFT]
+
+        page[((addr & PAGE_BYTE_MASK) >> 1) ^ HALFWORD_SWAP] = value & 0xFFFF
+
+        if addr & ~3 in self.code_words:
+            self.invalidate_code(addr & ~3)
+
+    # Returns a list of (base_address, words) for every allocated page, sorted
+    # by address. The words are a view on the memory itself, so nothing is
+    # copied.
+    def page_views(self):
+        return [
+            (page_number << PAGE_SHIFT, memoryview(self.pages[page_number]))
+            for page_number in sorted(self.pages)
+        ]
+
+    # Writes every word in the first DUMP_SIZE bytes of memory, and in any
+    # other page that was written to.
+    def dump(self, dumpfile):
+        page_numbers = set(range(DUMP_SIZE // PAGE_SIZE)) | set(self.pages)
+        empty_page = array(WORD_TYPECODE, bytes(PAGE_SIZE))
+
+        with open(dumpfile, "w") as dump:
+            for page_number in sorted(page_numbers):
+                base = page_number << PAGE_SHIFT
+                words = self.pages.get(page_number, empty_page)
+                dump.write("".join(
+                    f"{base + i*4:08X}: {val:08X}\n" for i, val in enumerate(words)
+                ))
+
+# Set in the addresses recorded by RecordingMemoryBus for the stores
+WRITE_FLAG = 1 << 32
+
+# Number of accesses a RecordingMemoryBus keeps before passing them on
+ACCESS_CHUNK_SIZE = 1 << 20
+
+# A MemoryBus that appends the address of every load and store to an
+# array("Q"), in the order they happen, with WRITE_FLAG set for the stores. The
+# writes to the termination address are recorded too. Every chunk_size
+# accesses, and on flush, the array is passed to fold (like
+# MemoryAccessProfile.add) and emptied, so that each access only costs an
+# append and the memory used stays bounded.
+class RecordingMemoryBus(MemoryBus):
+    def __init__(self, memory, fold, chunk_size=ACCESS_CHUNK_SIZE):
+        super().__init__(memory)
+        self.fold = fold
+        self.chunk_size = chunk_size
+        self.accesses = array("Q")
+        self.append = self.accesses.append
+
+    def record(self, access):
+        self.append(access)
+        if len(self.accesses) >= self.chunk_size:
+            self.flush()
+
+    # Passes on the accesses recorded so far
+    def flush(self):
+        if len(self.accesses) > 0:
+            self.fold(self.accesses)
+            del self.accesses[:]
+
+    # Drops the accesses recorded so far
+    def discard(self):
+        del self.accesses[:]
+
+    def read(self, addr):
+        self.record(addr & MASK)
+        return MemoryBus.read(self, addr)
+
+    def read_byte(self, addr):
+        self.record(addr & MASK)
+        return MemoryBus.read_byte(self, addr)
+
+    def read_halfword(self, addr):
+        self.record(addr & MASK)
+        return MemoryBus.read_halfword(self, addr)
+
+    def write(self, addr, value):
+        self.record((addr & MASK) | WRITE_FLAG)
+        MemoryBus.write(self, addr, value)
+
+    def write_byte(self, addr, value):
+        self.record((addr & MASK) | WRITE_FLAG)
+        MemoryBus.write_byte(self, addr, value)
+
+    def write_halfword(self, addr, value):
+        self.record((addr & MASK) | WRITE_FLAG)
+        MemoryBus.write_halfword(self, addr, value)
@@ -0,0 +1,193 @@
+from common import CpuSimulationConfig
+
+# Cycles taken by the caches and the arbiter before a line fill gets to the
+# bus: the cache going into its Miss state, and the arbiter granting the bus
+MISS_START_CYCLES = 2
+
+# Cycles of every bus transfer on top of the memory's stall and wait cycles:
+# the bus interface going from Idle to BusRequest, and the ack
+BUS_TRANSFER_CYCLES = 2
+
+# Cycles a store stalls the memory stage even on a hit, since the write-through
+# cache only reports write hits a cycle later
+STORE_CYCLES = 1
+
+# Functional model of the set associative pseudo-LRU caches in
+# 01-ReadOnlyCache.vhd and 01-WriteThroughCache.vhd.
+#
+# Every line has an MRU bit, which gets set when the line is hit. When all the
+# bits of a set would be set, all the others get cleared instead. On a miss, the
+# victim is the last line of the set whose MRU bit is clear, whether it's valid
+# or not. After the line is loaded the access is repeated, and it hits.
+class CacheModel:
+    def __init__(self, size):
+        self.sets = size.sets
+        self.ways = size.ways
+        self.line_size = size.line_size
+
+        # Address: | tag | set | word | byte |
+        self.line_shift = 2 + (size.line_size.bit_length() - 1)
+        self.set_width = size.sets.bit_length() - 1
+
+        # None marks an invalid line
+        self.tags = [[None] * size.ways for _ in range(size.sets)]
+        self.mru_bits = [[False] * size.ways for _ in range(size.sets)]
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Returns whether the access hit
+    def access(self, address):
+        line = address >> self.line_shift
+        set_index = line & (self.sets - 1)
+        tag = line >> self.set_width
+
+        tags = self.tags[set_index]
+        mru_bits = self.mru_bits[set_index]
+
+        try:
+            way = tags.index(tag)
+            hit = True
+            self.hits += 1
+        except ValueError:
+            way = 0
+            for i in range(self.ways):
+                if not mru_bits[i]:
+                    way = i
+
+            if tags[way] is not None:
+                self.evictions += 1
+            tags[way] = tag
+
+            hit = False
+            self.misses += 1
+
+        mru_bits[way] = True
+        if all(mru_bits):
+            mru_bits[:] = [False] * self.ways
+            mru_bits[way] = True
+
+        return hit
+
+    def accesses(self):
+        return self.hits + self.misses
+
+    def hit_rate(self):
+        if self.accesses() == 0:
+            return 0
+        return float(self.hits) / float(self.accesses()) * 100.0
+
+# Writes allocate the line on a miss like reads do, and then go through to
+# memory one word at a time.
+class WriteThroughCacheModel(CacheModel):
+    def __init__(self, size):
+        super().__init__(size)
+        self.writes = 0
+
+    def write(self, address):
+        self.writes += 1
+        return self.access(address)
+
+# Model of the bus shared by the two caches through 02-BusArbiter.vhd. The
+# arbiter keeps the bus granted to a cache until its transfer is over, so a
+# cache that needs the bus while the other one has it waits for it to finish.
+# Memory stall and wait cycles are random in the testbench memory, so every
+# word is taken to cost the expected value.
+class BusArbiterModel:
+    def __init__(self, stall):
+        self.min_word_cycles = BUS_TRANSFER_CYCLES + stall.min_stall + stall.min_wait
+        self.max_word_cycles = BUS_TRANSFER_CYCLES + stall.max_stall + stall.max_wait
+        self.word_cycles = (self.min_word_cycles + self.max_word_cycles) / 2.0
+
+        self.free_at = 0
+        self.transfers = 0
+        self.contentions = 0
+        self.contention_cycles = 0
+
+    # Starts a transfer of the given number of words at cycle now, and returns
+    # the cycles until it's done
+    def transfer(self, now, words):
+        start = max(now, self.free_at)
+        if start > now:
+            self.contentions += 1
+            self.contention_cycles += start - now
+
+        self.transfers += 1
+        self.free_at = start + words * self.word_cycles
+
+        return self.free_at - now
+
+    # Cycles until the bus is free, if it was requested at cycle now
+    def wait(self, now):
+        return max(0, self.free_at - now)
+
+# The instruction cache, the data cache and the bus between them and memory, as
+# in 03-MemorySystem.vhd. Every method takes the cycle the access happens at,
+# and returns the cycles it stalls the pipeline for.
+class MemorySystemModel:
+    def __init__(self, config=None):
+        if config is None:
+            config = CpuSimulationConfig.default()
+
+        self.config = config
+        self.icache = CacheModel(config.icache)
+        self.dcache = WriteThroughCacheModel(config.dcache)
+        self.bus = BusArbiterModel(config.stall)
+
+        self.icache_stall_cycles = 0
+        self.dcache_stall_cycles = 0
+
+    def fill(self, cache, now):
+        return MISS_START_CYCLES + self.bus.transfer(now + MISS_START_CYCLES, cache.line_size)
+
+    def fetch(self, address, now):
+        if self.icache.access(address):
+            return 0
+
+        cycles = self.fill(self.icache, now)
+        self.icache_stall_cycles += cycles
+        return cycles
+
+    def load(self, address, now):
+        if self.dcache.access(address):
+            return 0
+
+        cycles = self.fill(self.dcache, now)
+        self.dcache_stall_cycles += cycles
+        return cycles
+
+    # The cache takes a new request only once the previous write-through is
+    # done, while the write-through of this store goes on in the background
+    def store(self, address, now):
+        cycles = self.bus.wait(now) + STORE_CYCLES
+        if not self.dcache.write(address):
+            cycles += self.fill(self.dcache, now + cycles)
+
+        self.bus.transfer(now + cycles, 1)
+
+        self.dcache_stall_cycles += cycles
+        return cycles
+
+    # (min, expected, max) cycles to load a line of the given cache, if the
+    # bus is free
+    def miss_penalty(self, cache):
+        return (
+            MISS_START_CYCLES + cache.line_size * self.bus.min_word_cycles,
+            MISS_START_CYCLES + cache.line_size * self.bus.word_cycles,
+            MISS_START_CYCLES + cache.line_size * self.bus.max_word_cycles
+        )
+
+    def print_cache_report(self, name, cache, size, stall_cycles):
+        min_penalty, penalty, max_penalty = self.miss_penalty(cache)
+        print(f"{name} ({size}):")
+        print(f"  Accesses: {cache.accesses()}, hits: {cache.hits}, misses: {cache.misses} (hit rate = {cache.hit_rate():.2f} %), evictions: {cache.evictions}")
+        print(f"  Miss penalty: {penalty:.1f} cycles (min = {min_penalty}, max = {max_penalty})")
+        print(f"  Estimated stall cycles: {stall_cycles:.0f}")
+
+    def print_report(self):
+        print(f"Memory: {self.config.stall}")
+        self.print_cache_report("Instruction cache", self.icache, self.config.icache, self.icache_stall_cycles)
+        self.print_cache_report("Data cache", self.dcache, self.config.dcache, self.dcache_stall_cycles)
+        print(f"  Write-throughs: {self.dcache.writes}")
+        print(f"Bus transfers: {self.bus.transfers}, waited for the other cache: {self.bus.contentions} times ({self.bus.contention_cycles:.0f} cycles)")
@@ -0,0 +1,104 @@
+import struct
+import sys
+import zlib
+
+from array import array
+
+from dlx_emu_bus import MemoryBus, PAGE_SIZE, WORD_TYPECODE
+
+# Checkpoint file format. All values are little endian.
+#
+# A header with magic, version, flags, pc, cycle, instructions run and number
+# of memory pages, followed by the register file and then by the allocated
+# memory pages, compressed with zlib. Each page is stored as its page number
+# followed by its words.
+CHECKPOINT_MAGIC = b"DLXC"
+CHECKPOINT_VERSION = 1
+
+FLAG_FINISHED = 1
+
+HEADER = struct.Struct("<4sHHIQQI")
+REGISTERS = struct.Struct("<32I")
+PAGE_NUMBER = struct.Struct("<I")
+
+def words_to_bytes(words):
+    if sys.byteorder != "little":
+        words = array(WORD_TYPECODE, words)
+        words.byteswap()
+    return bytes(words)
+
+def bytes_to_words(data):
+    words = array(WORD_TYPECODE, data)
+    if sys.byteorder != "little":
+        words.byteswap()
+    return words
+
+def save_checkpoint(cpu, path):
+    bus = cpu.bus
+    pages = bus.page_views()
+
+    header = HEADER.pack(
+        CHECKPOINT_MAGIC,
+        CHECKPOINT_VERSION,
+        FLAG_FINISHED if bus.finished else 0,
+        cpu.pc,
+        cpu.cycle,
+        cpu.instructions_run,
+        len(pages)
+    )
+
+    compressor = zlib.compressobj()
+    compressed = []
+    for address, words in pages:
+        compressed.append(compressor.compress(PAGE_NUMBER.pack(address // PAGE_SIZE)))
+        compressed.append(compressor.compress(words_to_bytes(words)))
+    compressed.append(compressor.flush())
+
+    with open(path, "wb") as checkpoint:
+        checkpoint.write(header)
+        checkpoint.write(REGISTERS.pack(*cpu.registers))
+        checkpoint.writelines(compressed)
+
+# Returns a new cpu of the given class, with the same state as when the
+# checkpoint was saved. Nothing of the program it was running is needed, as the
+# whole memory is in the checkpoint. Raises ValueError if the file isn't a
+# checkpoint, or is truncated or corrupted.
+def load_checkpoint(path, cpu_class, bus=None):
+    with open(path, "rb") as checkpoint:
+        data = checkpoint.read()
+
+    if len(data) < HEADER.size + REGISTERS.size:
+        raise ValueError(f"{path} is not a checkpoint file")
+
+    magic, version, flags, pc, cycle, instructions_run, page_count = HEADER.unpack_from(data)
+    if magic != CHECKPOINT_MAGIC or version != CHECKPOINT_VERSION:
+        raise ValueError(f"{path} is not a checkpoint file")
+
+    registers = REGISTERS.unpack_from(data, HEADER.size)
+    try:
+        pages = zlib.decompress(data[HEADER.size + REGISTERS.size:])
+    except zlib.error:
+        raise ValueError(f"{path} is corrupted")
+
+    if len(pages) != page_count * (PAGE_NUMBER.size + PAGE_SIZE):
+        raise ValueError(f"{path} is corrupted")
+
+    if bus is None:
+        bus = MemoryBus([])
+    offset = 0
+    for _ in range(page_count):
+        (page_number,) = PAGE_NUMBER.unpack_from(pages, offset)
+        offset += PAGE_NUMBER.size
+
+        bus.allocate_page(page_number)[:] = bytes_to_words(pages[offset:offset + PAGE_SIZE])
+        offset += PAGE_SIZE
+
+    bus.finished = (flags & FLAG_FINISHED) != 0
+
+    cpu = cpu_class(bus, pc)
+    # The instruction handlers hold the register file, so it's updated in place
+    cpu.registers[:] = registers
+    cpu.cycle = cycle
+    cpu.instructions_run = instructions_run
+
+    return cpu
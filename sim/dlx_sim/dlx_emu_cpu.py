@@ -1,13 +1,82 @@
 from common import warn, InstructionTrace
 from dlx_instructions import *
 
+MASK = 0xFFFF_FFFF # Used to do word-length ops
+LINK_REGISTER = 31
+NO_DEST = -1
+SIGN = 0x8000_0000
+
+# Reasons for DLXCpu.run to return
+STOP_FINISHED = "finished"
+STOP_MAX_INSTRUCTIONS = "max_instructions"
+STOP_INVALID_INSTRUCTION = "invalid_instruction"
+
 def sign_extend(value, bits):
     sign_bit = 1 << (bits-1)
     return (value & (sign_bit - 1)) - (value & sign_bit)
 
-def to_signed(n, byte_count=4): 
+def to_signed(n, byte_count=4):
     return int.from_bytes(n.to_bytes(byte_count, 'little', signed=False), 'little', signed=True)
 
+# Same as to_signed, but only valid for 32 bit values.
+def s32(n):
+    return (n ^ SIGN) - SIGN
+
+# Returns (opcode, itype, rtype, jtype), where:
+#  - itype = (rd, rs1, imm)
+#  - rtype = (rd, rs1, rs2)
+#  - jtype = (jmp, )
+def extract_fields(instruction):
+    opcode = (instruction & 0xFC000000) >> (32-6)
+
+    itype_rs1 = (instruction & 0x03E00000) >> (32-6-5)
+    itype_rd  = (instruction & 0x001F0000) >> (32-6-5-5)
+    itype_imm = (instruction & 0x0000FFFF)
+
+    rtype_rs1  = (instruction & 0x03E00000) >> (32-6-5)
+    rtype_rs2  = (instruction & 0x001F0000) >> (32-6-5-5)
+    rtype_rd   = (instruction & 0x0000FC00) >> (32-6-5-5-5)
+
+    jtype_jmp = (instruction & 0x03FFFFFF)
+
+    return (
+        opcode,
+        (itype_rd, itype_rs1, itype_imm),
+        (rtype_rd, rtype_rs1, rtype_rs2),
+        (jtype_jmp, )
+    )
+
+# Instructions that don't write any register
+NO_DEST_OPS = {
+    ITYPE_BEQZ, ITYPE_BNEZ, ITYPE_JR, JTYPE_J,
+    ITYPE_SB, ITYPE_SH, ITYPE_SW, ITYPE_NOP,
+}
+
+# Immediate instructions whose immediate gets sign extended
+SIGNED_IMM_OPS = {
+    ITYPE_ADDI, ITYPE_SUBI, ITYPE_SGEI, ITYPE_SGTI, ITYPE_SLEI, ITYPE_SLTI,
+    ITYPE_LB, ITYPE_LBU, ITYPE_LH, ITYPE_LHU, ITYPE_LW,
+    ITYPE_SB, ITYPE_SH, ITYPE_SW,
+}
+
+# Layout of a decoded instruction, as stored in DLXCpu.decoded:
+#  (handler, a, b, c, opcode, func, itype, rtype, jtype, instruction, pc, dest)
+# The handler gets called as handler(a, b, c), and returns the next pc if the
+# instruction is a taken branch or a jump, None otherwise.
+# a, b and c are the already sign-extended operands, and their meaning
+# depends on the instruction:
+#  - I-type: (rd, rs1, imm)
+#  - R-type: (rd, rs1, rs2)
+#  - beqz/bnez: (rs1, target, None)
+#  - jr/jalr: (rs1, link, None)
+#  - j/jal: (target, link, None)
+# dest is the register written by the instruction, or NO_DEST.
+
+# Indices of the fields of a decoded instruction used outside of the cpu
+DECODED_OPCODE = 4
+DECODED_INSTRUCTION = 9
+DECODED_PC = 10
+DECODED_DEST = 11
 
 class DLXCpu:
     def __init__(self, bus, start_pc):
@@ -19,228 +88,359 @@ class DLXCpu:
         self.cycle = 0
         self.instructions_run = 0
 
-    def run_one_instruction(self, verbose):
-        instruction = self.bus.read(self.pc)
+        # Maps every pc that has been fetched to its decoded instruction
+        self.decoded = {}
+        self.itype_handlers, self.rtype_handlers = self.build_handlers()
 
-        prev_pc = self.pc
-        self.pc += 4
+        bus.add_code_write_listener(self.invalidate)
 
-        opcode = (instruction & 0xFC000000) >> (32-6)
+    def invalidate(self, addr):
+        self.decoded.pop(addr, None)
 
+    # Handlers close over the register file and the bus, so that they don't
+    # have to go through self at every instruction.
+    # Since registers always hold 32 bit values, signed comparisons are done by
+    # flipping the sign bit, and add, sub and imul give the same result as their
+    # unsigned counterparts once masked.
+    def build_handlers(self):
+        regs = self.registers
+        bus = self.bus
 
-        itype_rs1 = (instruction & 0x03E00000) >> (32-6-5)
-        itype_rd  = (instruction & 0x001F0000) >> (32-6-5-5)
-        itype_imm = (instruction & 0x0000FFFF)
+        def addi(rd, rs1, imm):
+            regs[rd] = (regs[rs1] + imm) & MASK
 
-        rtype_rs1  = (instruction & 0x03E00000) >> (32-6-5)
-        rtype_rs2  = (instruction & 0x001F0000) >> (32-6-5-5)
-        rtype_rd   = (instruction & 0x0000FC00) >> (32-6-5-5-5)
-        rtype_func = (instruction & 0x000003FF)
+        def subi(rd, rs1, imm):
+            regs[rd] = (regs[rs1] - imm) & MASK
 
-        jtype_jmp = (instruction & 0x03FFFFFF)
+        def beqz(rs1, target, _):
+            if regs[rs1] == 0:
+                return target
 
+        def bnez(rs1, target, _):
+            if regs[rs1] != 0:
+                return target
 
-        regs = self.registers
-        MASK = 0xFFFF_FFFF # Used to do word-length ops
+        def jalr(rs1, link, _):
+            regs[LINK_REGISTER] = link
+            return regs[rs1]
 
-        unsigned_imm = (itype_imm) & MASK
-        signed_imm = sign_extend(itype_imm, 16)
+        def jr(rs1, _link, _):
+            return regs[rs1]
 
-        jmp_imm = sign_extend(jtype_jmp, 26) & MASK
+        def seqi(rd, rs1, imm):
+            regs[rd] = int(regs[rs1] == imm)
 
+        def sgei(rd, rs1, imm):
+            regs[rd] = int((regs[rs1] ^ SIGN) - SIGN >= imm)
 
-        LINK_REGISTER = 31
+        def sgeui(rd, rs1, imm):
+            regs[rd] = int(regs[rs1] >= imm)
 
-        if opcode != ITYPE_NOP:
-            self.instructions_run += 1
+        def sgti(rd, rs1, imm):
+            regs[rd] = int((regs[rs1] ^ SIGN) - SIGN > imm)
+
+        def slei(rd, rs1, imm):
+            regs[rd] = int((regs[rs1] ^ SIGN) - SIGN <= imm)
+
+        def sleui(rd, rs1, imm):
+            regs[rd] = int(regs[rs1] <= imm)
+
+        def slti(rd, rs1, imm):
+            regs[rd] = int((regs[rs1] ^ SIGN) - SIGN < imm)
+
+        def sltui(rd, rs1, imm):
+            regs[rd] = int(regs[rs1] < imm)
+
+        def snei(rd, rs1, imm):
+            regs[rd] = int(regs[rs1] != imm)
+
+        def andi(rd, rs1, imm):
+            regs[rd] = regs[rs1] & imm
+
+        def ori(rd, rs1, imm):
+            regs[rd] = regs[rs1] | imm
+
+        def xori(rd, rs1, imm):
+            regs[rd] = regs[rs1] ^ imm
+
+        def lb(rd, rs1, imm):
+            regs[rd] = sign_extend(bus.read_byte(regs[rs1] + imm), 8) & MASK
+
+        def lbu(rd, rs1, imm):
+            regs[rd] = bus.read_byte(regs[rs1] + imm) & MASK
+
+        def lh(rd, rs1, imm):
+            regs[rd] = sign_extend(bus.read_halfword(regs[rs1] + imm), 16) & MASK
+
+        def lhu(rd, rs1, imm):
+            regs[rd] = bus.read_halfword(regs[rs1] + imm) & MASK
+
+        def lw(rd, rs1, imm):
+            regs[rd] = bus.read(regs[rs1] + imm) & MASK
 
-        if opcode == ITYPE_ADDI:
-            regs[itype_rd] = (regs[itype_rs1] + signed_imm) & MASK
-        elif opcode == ITYPE_ADDUI:
-            regs[itype_rd] = (regs[itype_rs1] + unsigned_imm) & MASK
-        elif opcode == ITYPE_SUBI:
-            regs[itype_rd] = (regs[itype_rs1] - signed_imm) & MASK
-        elif opcode == ITYPE_SUBUI:
-            regs[itype_rd] = (regs[itype_rs1] - unsigned_imm) & MASK
-        elif opcode == ITYPE_BEQZ:
-            if regs[itype_rs1] == 0:
-                self.pc += signed_imm
-        elif opcode == ITYPE_BNEZ:
-            if regs[itype_rs1] != 0:
-                self.pc += signed_imm
-        elif opcode == ITYPE_JALR:
-            regs[LINK_REGISTER] = self.pc
-            self.pc = regs[itype_rs1]
-        elif opcode == ITYPE_JR:
-            self.pc = regs[itype_rs1]
-        elif opcode == ITYPE_SEQI:
-            regs[itype_rd] = int(regs[itype_rs1] == unsigned_imm)
-        elif opcode == ITYPE_SGEI:
-            regs[itype_rd] = int(to_signed(regs[itype_rs1]) >= signed_imm)
-        elif opcode == ITYPE_SGEUI:
-            regs[itype_rd] = int(regs[itype_rs1] >= unsigned_imm)
-        elif opcode == ITYPE_SGTI:
-            regs[itype_rd] = int(to_signed(regs[itype_rs1]) > signed_imm)
-        elif opcode == ITYPE_SGTUI:
-            regs[itype_rd] = int(to_signed(regs[itype_rs1]) > unsigned_imm)
-        elif opcode == ITYPE_SLEI:
-            regs[itype_rd] = int(to_signed(regs[itype_rs1]) <= signed_imm)
-        elif opcode == ITYPE_SLEUI:
-            regs[itype_rd] = int(regs[itype_rs1] <= unsigned_imm)
-        elif opcode == ITYPE_SLTI:
-            regs[itype_rd] = int(to_signed(regs[itype_rs1]) < signed_imm)
-        elif opcode == ITYPE_SLTUI:
-            regs[itype_rd] = int(regs[itype_rs1] < unsigned_imm)
-        elif opcode == ITYPE_SNEI:
-            regs[itype_rd] = int(regs[itype_rs1] != unsigned_imm)
-        elif opcode == ITYPE_ANDI:
-            regs[itype_rd] = regs[itype_rs1] & unsigned_imm
-        elif opcode == ITYPE_ORI:
-            regs[itype_rd] = regs[itype_rs1] | unsigned_imm
-        elif opcode == ITYPE_XORI:
-            regs[itype_rd] = regs[itype_rs1] ^ unsigned_imm
-        elif opcode == ITYPE_LB:
-            regs[itype_rd] = sign_extend(self.bus.read_byte(regs[itype_rs1] + signed_imm), 8) & MASK
-        elif opcode == ITYPE_LBU:
-            regs[itype_rd] = self.bus.read_byte(regs[itype_rs1] + signed_imm) & MASK
-        elif opcode == ITYPE_LH:
-            regs[itype_rd] = sign_extend(self.bus.read_halfword(regs[itype_rs1] + signed_imm), 16) & MASK
-        elif opcode == ITYPE_LHU:
-            regs[itype_rd] = self.bus.read_halfword(regs[itype_rs1] + signed_imm) & MASK
-        elif opcode == ITYPE_LW:
-            regs[itype_rd] = self.bus.read(regs[itype_rs1] + signed_imm) & MASK
-        elif opcode == ITYPE_SB:
-            addr = regs[itype_rs1] + signed_imm
-            byte_index = addr % 4
-            prev_value = self.bus.read(addr)
-            mask = 0xFF << (byte_index * 8)
-            new_value = (prev_value & ~mask) | ((regs[itype_rd] & 0xFF) << (byte_index * 8))
-            self.bus.write(addr, new_value)
-        elif opcode == ITYPE_SH:
-            addr = regs[itype_rs1] + signed_imm
-            halfword_index = addr % 2
-            prev_value = self.bus.read(addr)
-            mask = 0xFFFF << (halfword_index * 16)
-            new_value = (prev_value & ~mask) | ((regs[itype_rd] & 0xFFFF) << (halfword_index * 16))
-            self.bus.write(addr, new_value)
-        elif opcode == ITYPE_SW:
-            self.bus.write(regs[itype_rs1] + signed_imm, regs[itype_rd])
-        elif opcode == ITYPE_LHI:
-            regs[itype_rd] = (itype_imm << 16) & MASK
-        elif opcode == ITYPE_NOP:
+        def sb(rd, rs1, imm):
+            bus.write_byte(regs[rs1] + imm, regs[rd])
+
+        def sh(rd, rs1, imm):
+            bus.write_halfword(regs[rs1] + imm, regs[rd])
+
+        def sw(rd, rs1, imm):
+            bus.write(regs[rs1] + imm, regs[rd])
+
+        # The shifted immediate is computed at decode time
+        def lhi(rd, _rs1, value):
+            regs[rd] = value
+
+        def nop(_a, _b, _c):
             pass
-        elif opcode == ITYPE_SLLI:
-            regs[itype_rd] = (regs[itype_rs1] << (itype_imm & 0x1F)) & MASK
-        elif opcode == ITYPE_SRAI:
-            regs[itype_rd] = (to_signed(regs[itype_rs1]) >> (signed_imm & 0x1F)) & MASK
-        elif opcode == ITYPE_SRLI:
-            regs[itype_rd] = (regs[itype_rs1] >> (unsigned_imm & 0x1F)) & MASK
-        elif opcode == JTYPE_J:
-            self.pc = (self.pc + jmp_imm) & MASK
-        elif opcode == JTYPE_JAL:
-            regs[LINK_REGISTER] = self.pc
-            self.pc = (self.pc + jmp_imm) & MASK
-        elif opcode == 0: # Rtype
-            if rtype_func == FUNC_ADD:
-                regs[rtype_rd] = (to_signed(regs[rtype_rs1]) + to_signed(regs[rtype_rs2])) & MASK
-            elif rtype_func == FUNC_ADDU:
-                regs[rtype_rd] = (regs[rtype_rs1] + regs[rtype_rs2]) & MASK
-            elif rtype_func == FUNC_SUB:
-                regs[rtype_rd] = (to_signed(regs[rtype_rs1]) - to_signed(regs[rtype_rs2])) & MASK
-            elif rtype_func == FUNC_SUBU:
-                regs[rtype_rd] = (regs[rtype_rs1] - regs[rtype_rs2]) & MASK
-            elif rtype_func == FUNC_SEQ:
-                regs[rtype_rd] = int(regs[rtype_rs1] == regs[rtype_rs2])
-            elif rtype_func == FUNC_SGE:
-                regs[rtype_rd] = int(to_signed(regs[rtype_rs1]) >= to_signed(regs[rtype_rs2]))
-            elif rtype_func == FUNC_SGEU:
-                regs[rtype_rd] = int(regs[rtype_rs1] >= regs[rtype_rs2])
-            elif rtype_func == FUNC_SGT:
-                regs[rtype_rd] = int(to_signed(regs[rtype_rs1]) > to_signed(regs[rtype_rs2]))
-            elif rtype_func == FUNC_SGTU:
-                regs[rtype_rd] = int(regs[rtype_rs1] > regs[rtype_rs2])
-            elif rtype_func == FUNC_SLE:
-                regs[rtype_rd] = int(to_signed(regs[rtype_rs1]) <= to_signed(regs[rtype_rs2]))
-            elif rtype_func == FUNC_SLEU:
-                regs[rtype_rd] = int(regs[rtype_rs1] <= regs[rtype_rs2])
-            elif rtype_func == FUNC_SLT:
-                regs[rtype_rd] = int(to_signed(regs[rtype_rs1]) < to_signed(regs[rtype_rs2]))
-            elif rtype_func == FUNC_SLTU:
-                regs[rtype_rd] = int(regs[rtype_rs1] < regs[rtype_rs2])
-            elif rtype_func == FUNC_SNE:
-                regs[rtype_rd] = int(to_signed(regs[rtype_rs1]) != to_signed(regs[rtype_rs2]))
-            elif rtype_func == FUNC_AND:
-                regs[rtype_rd] = regs[rtype_rs1] & regs[rtype_rs2]
-            elif rtype_func == FUNC_OR:
-                regs[rtype_rd] = regs[rtype_rs1] | regs[rtype_rs2]
-            elif rtype_func == FUNC_XOR:
-                regs[rtype_rd] = regs[rtype_rs1] ^ regs[rtype_rs2]
-            elif rtype_func == FUNC_SLL:
-                regs[rtype_rd] = (regs[rtype_rs1] << (regs[rtype_rs2] & 0x1F )) & MASK
-            elif rtype_func == FUNC_SRA:
-                regs[rtype_rd] = (to_signed(regs[rtype_rs1]) >> to_signed(regs[rtype_rs2] & 0x1F)) & MASK
-            elif rtype_func == FUNC_SRL:
-                regs[rtype_rd] = (regs[rtype_rs1] >> (regs[rtype_rs2] & 0x1F)) & MASK
-            elif rtype_func == FUNC_IMUL:
-                regs[rtype_rd] = (to_signed(regs[rtype_rs1]) * to_signed(regs[rtype_rs2])) & MASK
-            elif rtype_func == FUNC_IDIV:
-                # Division by zero saturates
-                if regs[rtype_rs2] == 0:
-                    regs[rtype_rd] = 0xFFFF_FFFF
-                    warn("Division by zero detected, result is undefined")
-                else:
-                    regs[rtype_rd] = (to_signed(regs[rtype_rs1]) // to_signed(regs[rtype_rs2])) & MASK
-            elif rtype_func == FUNC_IMOD:
-                if regs[rtype_rs2] == 0:
-                    warn("Modulo by zero detected, result is undefined")
-                    regs[rtype_rd] = regs[rtype_rs1]
-                else:
-                    regs[rtype_rd] = abs(to_signed(regs[rtype_rs1]) % to_signed(regs[rtype_rs2])) & MASK
+
+        # The shift amount is masked at decode time
+        def slli(rd, rs1, amount):
+            regs[rd] = (regs[rs1] << amount) & MASK
+
+        def srai(rd, rs1, amount):
+            regs[rd] = (s32(regs[rs1]) >> amount) & MASK
+
+        def srli(rd, rs1, amount):
+            regs[rd] = (regs[rs1] >> amount) & MASK
+
+        def j(target, _link, _):
+            return target
+
+        def jal(target, link, _):
+            regs[LINK_REGISTER] = link
+            return target
+
+        def add(rd, rs1, rs2):
+            regs[rd] = (regs[rs1] + regs[rs2]) & MASK
+
+        def addu(rd, rs1, rs2):
+            regs[rd] = (regs[rs1] + regs[rs2]) & MASK
+
+        def sub(rd, rs1, rs2):
+            regs[rd] = (regs[rs1] - regs[rs2]) & MASK
+
+        def subu(rd, rs1, rs2):
+            regs[rd] = (regs[rs1] - regs[rs2]) & MASK
+
+        def seq(rd, rs1, rs2):
+            regs[rd] = int(regs[rs1] == regs[rs2])
+
+        def sge(rd, rs1, rs2):
+            regs[rd] = int((regs[rs1] ^ SIGN) >= (regs[rs2] ^ SIGN))
+
+        def sgeu(rd, rs1, rs2):
+            regs[rd] = int(regs[rs1] >= regs[rs2])
+
+        def sgt(rd, rs1, rs2):
+            regs[rd] = int((regs[rs1] ^ SIGN) > (regs[rs2] ^ SIGN))
+
+        def sgtu(rd, rs1, rs2):
+            regs[rd] = int(regs[rs1] > regs[rs2])
+
+        def sle(rd, rs1, rs2):
+            regs[rd] = int((regs[rs1] ^ SIGN) <= (regs[rs2] ^ SIGN))
+
+        def sleu(rd, rs1, rs2):
+            regs[rd] = int(regs[rs1] <= regs[rs2])
+
+        def slt(rd, rs1, rs2):
+            regs[rd] = int((regs[rs1] ^ SIGN) < (regs[rs2] ^ SIGN))
+
+        def sltu(rd, rs1, rs2):
+            regs[rd] = int(regs[rs1] < regs[rs2])
+
+        def sne(rd, rs1, rs2):
+            regs[rd] = int(regs[rs1] != regs[rs2])
+
+        def and_(rd, rs1, rs2):
+            regs[rd] = regs[rs1] & regs[rs2]
+
+        def or_(rd, rs1, rs2):
+            regs[rd] = regs[rs1] | regs[rs2]
+
+        def xor(rd, rs1, rs2):
+            regs[rd] = regs[rs1] ^ regs[rs2]
+
+        def sll(rd, rs1, rs2):
+            regs[rd] = (regs[rs1] << (regs[rs2] & 0x1F)) & MASK
+
+        def sra(rd, rs1, rs2):
+            regs[rd] = (s32(regs[rs1]) >> (regs[rs2] & 0x1F)) & MASK
+
+        def srl(rd, rs1, rs2):
+            regs[rd] = (regs[rs1] >> (regs[rs2] & 0x1F)) & MASK
+
+        def imul(rd, rs1, rs2):
+            regs[rd] = (regs[rs1] * regs[rs2]) & MASK
+
+        def idiv(rd, rs1, rs2):
+            # Division by zero saturates
+            if regs[rs2] == 0:
+                regs[rd] = 0xFFFF_FFFF
+                warn("Division by zero detected, result is undefined")
+            else:
+                regs[rd] = (s32(regs[rs1]) // s32(regs[rs2])) & MASK
+
+        def imod(rd, rs1, rs2):
+            if regs[rs2] == 0:
+                warn("Modulo by zero detected, result is undefined")
+                regs[rd] = regs[rs1]
             else:
-                print(f"[{self.pc:08X}] Unknown function {rtype_func:03X}")
-                return
+                regs[rd] = abs(s32(regs[rs1]) % s32(regs[rs2])) & MASK
+
+        itype_handlers = {
+            ITYPE_ADDI: addi,
+            ITYPE_ADDUI: addi,
+            ITYPE_SUBI: subi,
+            ITYPE_SUBUI: subi,
+            ITYPE_BEQZ: beqz,
+            ITYPE_BNEZ: bnez,
+            ITYPE_JALR: jalr,
+            ITYPE_JR: jr,
+            ITYPE_SEQI: seqi,
+            ITYPE_SGEI: sgei,
+            ITYPE_SGEUI: sgeui,
+            ITYPE_SGTI: sgti,
+            # NOTE: sgtui compares the signed register against the unsigned immediate
+            ITYPE_SGTUI: sgti,
+            ITYPE_SLEI: slei,
+            ITYPE_SLEUI: sleui,
+            ITYPE_SLTI: slti,
+            ITYPE_SLTUI: sltui,
+            ITYPE_SNEI: snei,
+            ITYPE_ANDI: andi,
+            ITYPE_ORI: ori,
+            ITYPE_XORI: xori,
+            ITYPE_LB: lb,
+            ITYPE_LBU: lbu,
+            ITYPE_LH: lh,
+            ITYPE_LHU: lhu,
+            ITYPE_LW: lw,
+            ITYPE_SB: sb,
+            ITYPE_SH: sh,
+            ITYPE_SW: sw,
+            ITYPE_LHI: lhi,
+            ITYPE_NOP: nop,
+            ITYPE_SLLI: slli,
+            ITYPE_SRAI: srai,
+            ITYPE_SRLI: srli,
+            JTYPE_J: j,
+            JTYPE_JAL: jal,
+        }
+
+        rtype_handlers = {
+            FUNC_ADD: add,
+            FUNC_ADDU: addu,
+            FUNC_SUB: sub,
+            FUNC_SUBU: subu,
+            FUNC_SEQ: seq,
+            FUNC_SGE: sge,
+            FUNC_SGEU: sgeu,
+            FUNC_SGT: sgt,
+            FUNC_SGTU: sgtu,
+            FUNC_SLE: sle,
+            FUNC_SLEU: sleu,
+            FUNC_SLT: slt,
+            FUNC_SLTU: sltu,
+            FUNC_SNE: sne,
+            FUNC_AND: and_,
+            FUNC_OR: or_,
+            FUNC_XOR: xor,
+            FUNC_SLL: sll,
+            FUNC_SRA: sra,
+            FUNC_SRL: srl,
+            FUNC_IMUL: imul,
+            FUNC_IDIV: idiv,
+            FUNC_IMOD: imod,
+        }
+
+        return itype_handlers, rtype_handlers
+
+    # Decodes the instruction at the given pc and stores it in the decode cache.
+    # The handler is None if the instruction is not valid.
+    def decode(self, pc):
+        instruction = self.bus.fetch(pc)
+        opcode, itype, rtype, jtype = extract_fields(instruction)
+
+        rtype_func = instruction & 0x000003FF
+        func = rtype_func if opcode == RTYPE_OP else 0
+
+        link = pc + 4
+
+        if opcode == RTYPE_OP:
+            handler = self.rtype_handlers.get(rtype_func)
+            a, b, c = rtype
         else:
-            print(f"[{self.pc:08X}] Unknown opcode {opcode:02X}")
+            handler = self.itype_handlers.get(opcode)
+            rd, rs1, imm = itype
+
+            if opcode == ITYPE_BEQZ or opcode == ITYPE_BNEZ:
+                a, b, c = rs1, link + sign_extend(imm, 16), None
+            elif opcode == ITYPE_JR or opcode == ITYPE_JALR:
+                a, b, c = rs1, link, None
+            elif opcode == JTYPE_J or opcode == JTYPE_JAL:
+                jmp_imm = sign_extend(jtype[0], 26) & MASK
+                a, b, c = (link + jmp_imm) & MASK, link, None
+            elif opcode == ITYPE_LHI:
+                a, b, c = rd, rs1, (imm << 16) & MASK
+            elif opcode == ITYPE_SLLI or opcode == ITYPE_SRAI or opcode == ITYPE_SRLI:
+                a, b, c = rd, rs1, imm & 0x1F
+            elif opcode in SIGNED_IMM_OPS:
+                a, b, c = rd, rs1, sign_extend(imm, 16)
+            else:
+                a, b, c = rd, rs1, imm
+
+        if opcode == RTYPE_OP:
+            dest = rtype[0]
+        elif opcode == JTYPE_JAL or opcode == ITYPE_JALR:
+            dest = LINK_REGISTER
+        elif opcode in NO_DEST_OPS or handler is None:
+            dest = NO_DEST
+        else:
+            dest = itype[0]
+
+        decoded = (handler, a, b, c, opcode, func, itype, rtype, jtype, instruction, pc, dest)
+
+        self.decoded[pc] = decoded
+        self.bus.watch_code(pc)
+
+        return decoded
+
+    # If trace is an EmulatorTrace, the instruction gets recorded in it unless
+    # it's a nop.
+    def run_one_instruction(self, verbose, trace=None):
+        prev_pc = self.pc
+
+        try:
+            decoded = self.decoded[prev_pc]
+        except KeyError:
+            decoded = self.decode(prev_pc)
+
+        handler, a, b, c, opcode, func, itype, rtype, jtype, instruction, _, dest = decoded
+
+        if handler is None:
+            self.pc = prev_pc + 4
+            self.instructions_run += 1
+            if opcode == RTYPE_OP:
+                print(f"[{self.pc:08X}] Unknown function {instruction & 0x3FF:03X}")
+            else:
+                print(f"[{self.pc:08X}] Unknown opcode {opcode:02X}")
             return
 
+        next_pc = handler(a, b, c)
+        self.pc = prev_pc + 4 if next_pc is None else next_pc
+
+        if opcode != ITYPE_NOP:
+            self.instructions_run += 1
+            if trace is not None:
+                trace.append(prev_pc, instruction, dest, self.registers[dest] if dest != NO_DEST else 0)
+
         self.cycle += 1
 
         if verbose:
-            print(f"(op = {opcode:02X}, func = {rtype_func:03X}) ", end="")
-            if opcode in OPS_NAME:
-                name = OPS_NAME[opcode]
-                print(
-                    f"[{prev_pc:08X}] {name+',':<5}" + 
-                    f" rs1 = r{itype_rs1:02}[{regs[itype_rs1]:08X}]" + 
-                    f", rd  = r{itype_rd:02}[{regs[itype_rd]:08X}]" +
-                    f", imm = {itype_imm:04X}"
-                )
-
-            elif opcode == 0 and rtype_func in FUNC_NAME:
-                name = FUNC_NAME[rtype_func]
-                print(
-                    f"[{prev_pc:08X}] {name+',':<5}" + 
-                    f" rs1 = r{rtype_rs1:02}[{regs[rtype_rs1]:08X}]" +
-                    f", rs2 = r{rtype_rs2:02}[{regs[rtype_rs2]:08X}]" +
-                    f", rd = r{rtype_rd:02}[{regs[rtype_rd]:08X}]"
-                )
-            elif opcode == JTYPE_J or opcode == JTYPE_JAL:
-                name = OPS_NAME[opcode]
-                print(f"[{prev_pc:08X}] {name+',':<5}, jmp = {jmp_imm}") 
-            else:
-                print(f"[{prev_pc:08X}] invalid instruction")
-
-            print(f"  cur_inst = {self.instructions_run}")
-            print(f"  lr = {self.registers[31]:08X}")
-            print(f"  sp = {self.registers[30]:08X}")
-            for i in range(10):
-                print(f"  r{i} = {self.registers[i]:08X}")
-            print(f"  r29 = {self.registers[29]:08X}")
-
-        itype = (itype_rd, itype_rs1, itype_imm)
-        rtype = (rtype_rd, rtype_rs1, rtype_rs2)
-        jtype = (jtype_jmp, )
-        func = rtype_func if opcode == RTYPE_OP else 0
+            self.print_instruction(prev_pc, instruction)
+
         return InstructionTrace(
                 opcode=opcode,
                 func=func,
@@ -252,4 +452,122 @@ class DLXCpu:
                 jtype=jtype
         )
 
+    # Runs up to max_instructions instructions (nops included), or until the
+    # program writes to the termination address or hits an invalid instruction.
+    # All the state is kept in locals, and nothing is allocated per instruction.
+    # If trace is an EmulatorTrace, every instruction but nops gets recorded in
+    # it. If profile is a profiler.Profile, every instruction gets counted in it.
+    # Returns (stop_reason, instructions_run, cycle).
+    def run(self, max_instructions, trace=None, profile=None):
+        bus = self.bus
+        decoded_cache = self.decoded
+
+        regs = self.registers
+
+        tracing = trace is not None
+        if tracing:
+            append_pc = trace.pcs.append
+            append_instruction = trace.instructions.append
+            append_dest = trace.dests.append
+            append_value = trace.values.append
+
+        profiling = profile is not None
+        if profiling:
+            pc_counts = profile.pc_counts
+            stack_ops = profile.STACK_OPS
+
+        pc = self.pc
+        cycle = self.cycle
+        instructions_run = self.instructions_run
+
+        stop_reason = STOP_MAX_INSTRUCTIONS
+
+        try:
+            for _ in range(max_instructions):
+                try:
+                    decoded = decoded_cache[pc]
+                except KeyError:
+                    decoded = self.decode(pc)
+
+                handler, a, b, c, opcode = decoded[:5]
+
+                if handler is None:
+                    pc += 4
+                    instructions_run += 1
+                    if opcode == RTYPE_OP:
+                        print(f"[{pc:08X}] Unknown function {decoded[9] & 0x3FF:03X}")
+                    else:
+                        print(f"[{pc:08X}] Unknown opcode {opcode:02X}")
+                    stop_reason = STOP_INVALID_INSTRUCTION
+                    break
+
+                next_pc = handler(a, b, c)
+
+                if profiling:
+                    pc_counts[pc] = pc_counts.get(pc, 0) + 1
+                    if opcode in stack_ops:
+                        profile.control(opcode, a, pc + 4 if next_pc is None else next_pc, cycle + 1)
+
+                if opcode != ITYPE_NOP:
+                    if tracing:
+                        dest = decoded[11]
+                        append_pc(pc)
+                        append_instruction(decoded[9])
+                        append_dest(dest)
+                        append_value(regs[dest] if dest != NO_DEST else 0)
+                    instructions_run += 1
+
+                pc = pc + 4 if next_pc is None else next_pc
+                cycle += 1
+
+                if bus.finished:
+                    stop_reason = STOP_FINISHED
+                    break
+        finally:
+            self.pc = pc
+            self.cycle = cycle
+            self.instructions_run = instructions_run
+
+        return stop_reason, instructions_run, cycle
+
+    def print_instruction(self, prev_pc, instruction):
+        regs = self.registers
+
+        opcode, itype, rtype, jtype = extract_fields(instruction)
+        itype_rd, itype_rs1, itype_imm = itype
+        rtype_rd, rtype_rs1, rtype_rs2 = rtype
+        rtype_func = instruction & 0x000003FF
+        jmp_imm = sign_extend(jtype[0], 26) & MASK
+
+        print(f"(op = {opcode:02X}, func = {rtype_func:03X}) ", end="")
+        if opcode in OPS_NAME:
+            name = OPS_NAME[opcode]
+            print(
+                f"[{prev_pc:08X}] {name+',':<5}" +
+                f" rs1 = r{itype_rs1:02}[{regs[itype_rs1]:08X}]" +
+                f", rd  = r{itype_rd:02}[{regs[itype_rd]:08X}]" +
+                f", imm = {itype_imm:04X}"
+            )
+
+        elif opcode == 0 and rtype_func in FUNC_NAME:
+            name = FUNC_NAME[rtype_func]
+            print(
+                f"[{prev_pc:08X}] {name+',':<5}" +
+                f" rs1 = r{rtype_rs1:02}[{regs[rtype_rs1]:08X}]" +
+                f", rs2 = r{rtype_rs2:02}[{regs[rtype_rs2]:08X}]" +
+                f", rd = r{rtype_rd:02}[{regs[rtype_rd]:08X}]"
+            )
+        elif opcode == JTYPE_J or opcode == JTYPE_JAL:
+            name = OPS_NAME[opcode]
+            print(f"[{prev_pc:08X}] {name+',':<5}, jmp = {jmp_imm}")
+        else:
+            print(f"[{prev_pc:08X}] invalid instruction")
+
+        print(f"  cur_inst = {self.instructions_run}")
+        print(f"  lr = {self.registers[31]:08X}")
+        print(f"  sp = {self.registers[30]:08X}")
+        for i in range(10):
+            print(f"  r{i} = {self.registers[i]:08X}")
+        print(f"  r29 = {self.registers[29]:08X}")
+
 
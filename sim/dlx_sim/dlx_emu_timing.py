@@ -0,0 +1,279 @@
+from dlx_emu_btb import BTBModel, MISPREDICT_PENALTY
+from dlx_emu_cpu import DECODED_INSTRUCTION, MASK, NO_DEST, SIGN, STOP_FINISHED, STOP_MAX_INSTRUCTIONS, STOP_INVALID_INSTRUCTION
+from dlx_emu_trace import EmulatorTrace
+from dlx_instructions import *
+
+# Cycle-approximate model of the five stage pipeline in 02-DataPath.vhd and
+# 02-ControlUnit.vhd. Caches are assumed to always hit, unless a
+# MemorySystemModel is given, in which case its stalls get added too.
+#
+# Every instruction (nops included) spends at least one cycle in execute, so
+# the cycles taken are the cycles spent in execute, plus the bubbles that
+# enter it, plus the pipeline fill. Bubbles come from:
+#  - load-use stalls: the forward unit can forward from memory and write back
+#    (and the register file writes through to decode), so the only RAW hazard
+#    that stalls is a load in memory while the instruction in execute reads its
+#    destination. That takes one cycle, after which the load is in write back.
+#    Like the RTL, the rs1 and rs2 fields are compared even when the
+#    instruction doesn't use them (e.g. the rd of I-type instructions);
+#  - multicycle operations, which hold execute until the multiplier or the
+#    divider in 01-MulticycleUnit.vhd is done;
+#  - branch flushes: branches and jumps are resolved in the memory stage, and a
+#    misprediction of the branch predictor (by default the BTB of the DLX)
+#    flushes decode, execute and memory.
+
+# Maximum number of instructions run at a time before they go through the
+# model, when the trace isn't kept
+TIMING_CHUNK_SIZE = 65536
+
+# Cycles imul spends in execute: a request cycle plus the NBIT/2 stages of the
+# booth multiplier's valid chain
+MULTIPLIER_CYCLES = 17
+
+# Fetch and decode of the first instruction, and the memory stage of the last
+# one, which is where the terminating store gets to the bus
+PIPELINE_FILL_CYCLES = 3
+
+BRANCH_OPS = {ITYPE_BEQZ, ITYPE_BNEZ, ITYPE_JR, ITYPE_JALR, JTYPE_J, JTYPE_JAL}
+LOAD_OPS = {ITYPE_LB, ITYPE_LBU, ITYPE_LH, ITYPE_LHU, ITYPE_LW}
+STORE_OPS = {ITYPE_SB, ITYPE_SH, ITYPE_SW}
+
+# Cycles idiv and imod spend in execute, following the FSM in 01-Divider.vhd:
+# Idle, InvertDivisor (negative divisors only), 32 Dividing steps,
+# AdjustingQuotient, AdjustingRemainder (negative final remainder only) and
+# Done. Whether the remainder ends up negative depends on the operands, so the
+# non-restoring division gets replayed.
+def divider_cycles(dividend, divisor):
+    cycles = 35
+
+    remainder = MASK if (dividend ^ divisor) & SIGN else 0
+    if divisor & SIGN:
+        cycles += 1
+        quotient = -dividend & MASK
+        divisor = -divisor & MASK
+    else:
+        quotient = dividend
+
+    for _ in range(32):
+        twice_remainder = ((remainder << 1) | (quotient >> 31)) & MASK
+        positive = not (remainder & SIGN)
+        if positive:
+            remainder = (twice_remainder - divisor) & MASK
+        else:
+            remainder = (twice_remainder + divisor) & MASK
+        quotient = ((quotient << 1) | positive) & MASK
+
+    if remainder & SIGN:
+        cycles += 1
+
+    return cycles
+
+class PipelineTimingModel:
+    def __init__(self, predictor=None, memory=None):
+        self.predictor = predictor if predictor is not None else BTBModel()
+        self.memory = memory
+
+        self.instructions = 0
+        self.nops = 0
+        self.execute_cycles = 0
+        self.memory_stalls = 0
+
+        self.load_use_stalls = 0
+        self.multicycle_stalls = {FUNC_IMUL: 0, FUNC_IDIV: 0, FUNC_IMOD: 0}
+
+        self.branches = 0
+        self.taken_branches = 0
+        self.mispredictions = 0
+
+        # Destination of the previous instruction, if it was a load
+        self.load_dest = None
+
+    # Accounts for one instruction. in1 and in2 are the values of the registers
+    # in its rs1 and rs2 fields before it ran, and next_pc is where it went.
+    def step(self, pc, instruction, next_pc, in1, in2):
+        opcode = instruction >> 26
+
+        if opcode == JTYPE_J or opcode == JTYPE_JAL:
+            rs1 = rs2 = 0
+        else:
+            rs1 = (instruction >> 21) & 0x1F
+            rs2 = (instruction >> 16) & 0x1F
+
+        cycles = 1
+
+        memory = self.memory
+        if memory is not None:
+            self.memory_stalls += memory.fetch(pc, self.execute_cycles + self.memory_stalls)
+
+            # The data access happens in the memory stage, a cycle after execute
+            if opcode in LOAD_OPS or opcode in STORE_OPS:
+                address = (in1 + (instruction & 0xFFFF) - ((instruction & 0x8000) << 1)) & MASK
+                now = self.execute_cycles + self.memory_stalls + 1
+                if opcode in LOAD_OPS:
+                    self.memory_stalls += memory.load(address, now)
+                else:
+                    self.memory_stalls += memory.store(address, now)
+
+        if self.load_dest is not None and (rs1 == self.load_dest or rs2 == self.load_dest):
+            self.load_use_stalls += 1
+            cycles += 1
+
+        if opcode == RTYPE_OP:
+            func = instruction & 0x3FF
+            if func == FUNC_IMUL:
+                occupancy = MULTIPLIER_CYCLES
+            elif func == FUNC_IDIV or func == FUNC_IMOD:
+                occupancy = divider_cycles(in1, in2)
+            else:
+                occupancy = 1
+
+            if occupancy > 1:
+                self.multicycle_stalls[func] += occupancy - 1
+                cycles += occupancy - 1
+        elif opcode in BRANCH_OPS:
+            if opcode == ITYPE_BEQZ:
+                taken = in1 == 0
+            elif opcode == ITYPE_BNEZ:
+                taken = in1 != 0
+            else:
+                taken = True
+
+            self.branches += 1
+            if taken:
+                self.taken_branches += 1
+
+            if self.predictor.resolve(pc, taken, next_pc):
+                self.mispredictions += 1
+                cycles += MISPREDICT_PENALTY
+
+        if opcode == ITYPE_NOP:
+            self.nops += 1
+        else:
+            self.instructions += 1
+
+        # Loads write the register in their rs2 field
+        self.load_dest = rs2 if opcode in LOAD_OPS else None
+        self.execute_cycles += cycles
+
+    # Same as DLXCpu.run, but every instruction also goes through the model.
+    # The cpu runs at full speed into an EmulatorTrace (the given one, or
+    # chunks of TIMING_CHUNK_SIZE instructions), whose columns then get
+    # replayed through the model. With verbose, the instructions run one at a
+    # time instead, to be printed.
+    def run(self, cpu, max_instructions, trace=None, verbose=False):
+        if verbose:
+            return self.run_verbose(cpu, max_instructions, trace)
+
+        end_cycle = cpu.cycle + max_instructions
+        while True:
+            if trace is not None:
+                chunk = trace
+                instructions = end_cycle - cpu.cycle
+            else:
+                chunk = EmulatorTrace(cpu)
+                instructions = min(TIMING_CHUNK_SIZE, end_cycle - cpu.cycle)
+
+            start = len(chunk)
+            registers = list(cpu.registers)
+            pc = cpu.pc
+
+            stop_reason, _, _ = cpu.run(instructions, chunk)
+
+            # The pc is already past an invalid instruction
+            end_pc = cpu.pc - 4 if stop_reason == STOP_INVALID_INSTRUCTION else cpu.pc
+            self.replay(cpu, chunk, start, registers, pc, end_pc)
+
+            if stop_reason != STOP_MAX_INSTRUCTIONS or cpu.cycle >= end_cycle:
+                return stop_reason, cpu.instructions_run, cpu.cycle
+
+    # Feeds the model the instructions recorded in trace from start on, which
+    # ran from pc with the given register file, up to end_pc. Nops aren't
+    # recorded, so they're the instructions between where each recorded one
+    # went and the next one.
+    def replay(self, cpu, trace, start, registers, pc, end_pc):
+        decoded = cpu.decoded
+        step = self.step
+
+        pcs = trace.pcs
+        instructions = trace.instructions
+        dests = trace.dests
+        values = trace.values
+
+        for i in range(start, len(pcs) + 1):
+            next_recorded = pcs[i] if i < len(pcs) else end_pc
+            while pc != next_recorded:
+                step(pc, decoded[pc][DECODED_INSTRUCTION], pc + 4, 0, 0)
+                pc += 4
+
+            if i == len(pcs):
+                break
+
+            instruction = instructions[i]
+            in1 = registers[(instruction >> 21) & 0x1F]
+            in2 = registers[(instruction >> 16) & 0x1F]
+
+            opcode = instruction >> 26
+            next_pc = pc + 4
+            if opcode == ITYPE_BEQZ or opcode == ITYPE_BNEZ:
+                if (in1 == 0) == (opcode == ITYPE_BEQZ):
+                    next_pc += (instruction & 0xFFFF) - ((instruction & 0x8000) << 1)
+            elif opcode == ITYPE_JR or opcode == ITYPE_JALR:
+                next_pc = in1
+            elif opcode == JTYPE_J or opcode == JTYPE_JAL:
+                next_pc = (next_pc + (instruction & 0x3FFFFFF) - ((instruction & 0x2000000) << 1)) & MASK
+
+            step(pc, instruction, next_pc, in1, in2)
+
+            dest = dests[i]
+            if dest != NO_DEST:
+                registers[dest] = values[i]
+            pc = next_pc
+
+    def run_verbose(self, cpu, max_instructions, trace):
+        regs = cpu.registers
+        bus = cpu.bus
+
+        for _ in range(max_instructions):
+            pc = cpu.pc
+            decoded = cpu.decoded.get(pc)
+            if decoded is None:
+                decoded = cpu.decode(pc)
+
+            instruction = decoded[DECODED_INSTRUCTION]
+            in1 = regs[(instruction >> 21) & 0x1F]
+            in2 = regs[(instruction >> 16) & 0x1F]
+
+            if cpu.run_one_instruction(True, trace) is None:
+                return STOP_INVALID_INSTRUCTION, cpu.instructions_run, cpu.cycle
+
+            self.step(pc, instruction, cpu.pc, in1, in2)
+
+            if bus.finished:
+                return STOP_FINISHED, cpu.instructions_run, cpu.cycle
+
+        return STOP_MAX_INSTRUCTIONS, cpu.instructions_run, cpu.cycle
+
+    def branch_flush_cycles(self):
+        return self.mispredictions * MISPREDICT_PENALTY
+
+    def estimated_cycles(self):
+        if self.execute_cycles == 0:
+            return 0
+        return self.execute_cycles + round(self.memory_stalls) + PIPELINE_FILL_CYCLES
+
+    def cpi(self):
+        if self.instructions == 0:
+            return 0
+        return float(self.estimated_cycles()) / float(self.instructions)
+
+    def print_report(self):
+        print(f"Instructions ran: {self.instructions} (+ {self.nops} nops)")
+        print(f"Estimated cycles: {self.estimated_cycles()}")
+        print(f"Estimated clocks per instruction: {self.cpi():.2f}")
+        print(f"Load-use stalls: {self.load_use_stalls}")
+        print(f"Multicycle stalls: imul = {self.multicycle_stalls[FUNC_IMUL]}, idiv = {self.multicycle_stalls[FUNC_IDIV]}, imod = {self.multicycle_stalls[FUNC_IMOD]}")
+        print(f"Branches: {self.branches} ({self.taken_branches} taken), mispredicted: {self.mispredictions} ({self.branch_flush_cycles()} flush cycles)")
+
+        if self.memory is not None:
+            print(f"Memory stalls: {self.memory_stalls:.0f}")
+            self.memory.print_report()
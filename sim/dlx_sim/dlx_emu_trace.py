@@ -0,0 +1,135 @@
+from array import array
+from collections.abc import Sequence
+
+from common import InstructionTrace
+from dlx_emu_cpu import extract_fields, NO_DEST
+from dlx_instructions import RTYPE_OP
+
+# Number of instructions between two register file checkpoints
+CHECKPOINT_INTERVAL = 1024
+
+# The trace of the instructions ran by the emulator, stored column by column.
+# For every instruction but nops it keeps its pc, the instruction word, the
+# register it wrote (NO_DEST if none) and the value written (0 if none), for
+# 13 bytes per instruction. The instruction index is implicit, as the i-th
+# entry is always instruction first_index + i.
+#
+# The register file at any point gets rebuilt from the registers at the start
+# of the trace and the register writes. Checkpoints of the register file every
+# CHECKPOINT_INTERVAL instructions are computed the first time they're needed.
+class EmulatorTrace(Sequence):
+    def __init__(self, cpu):
+        self.first_index = cpu.instructions_run
+        self.initial_registers = array("I", cpu.registers)
+
+        self.pcs = array("I")
+        self.instructions = array("I")
+        self.dests = array("b")
+        self.values = array("I")
+
+        self.checkpoints = []
+
+    def append(self, pc, instruction, dest, value):
+        self.pcs.append(pc)
+        self.instructions.append(instruction)
+        self.dests.append(dest)
+        self.values.append(value)
+
+    def __len__(self):
+        return len(self.pcs)
+
+    def opcode(self, i):
+        return (self.instructions[i] & 0xFC000000) >> 26
+
+    def func(self, i):
+        instruction = self.instructions[i]
+        if (instruction & 0xFC000000) >> 26 == RTYPE_OP:
+            return instruction & 0x3FF
+        return 0
+
+    def update_checkpoints(self):
+        dests = self.dests
+        values = self.values
+
+        if len(self.checkpoints) == 0:
+            self.checkpoints.append(array("I", self.initial_registers))
+
+        registers = array("I", self.checkpoints[-1])
+        start = (len(self.checkpoints) - 1) * CHECKPOINT_INTERVAL
+
+        for checkpoint_start in range(start, len(dests) - CHECKPOINT_INTERVAL + 1, CHECKPOINT_INTERVAL):
+            for i in range(checkpoint_start, checkpoint_start + CHECKPOINT_INTERVAL):
+                dest = dests[i]
+                if dest != NO_DEST:
+                    registers[dest] = values[i]
+
+            self.checkpoints.append(array("I", registers))
+
+    # Returns the register file right after the i-th instruction in the trace
+    def registers_at(self, i):
+        if i < 0:
+            i += len(self)
+
+        if i // CHECKPOINT_INTERVAL >= len(self.checkpoints):
+            self.update_checkpoints()
+
+        checkpoint = i // CHECKPOINT_INTERVAL
+        registers = list(self.checkpoints[checkpoint])
+
+        dests = self.dests
+        values = self.values
+        for j in range(checkpoint * CHECKPOINT_INTERVAL, i + 1):
+            dest = dests[j]
+            if dest != NO_DEST:
+                registers[dest] = values[j]
+
+        return registers
+
+    def make_instruction_trace(self, i, registers):
+        opcode, itype, rtype, jtype = extract_fields(self.instructions[i])
+
+        return InstructionTrace(
+                opcode=opcode,
+                func=self.func(i),
+                instruction_index=self.first_index + i,
+                registers=registers,
+                pc=self.pcs[i],
+                itype=itype,
+                rtype=rtype,
+                jtype=jtype
+        )
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+
+        if i < 0:
+            i += len(self)
+
+        if i < 0 or i >= len(self):
+            raise IndexError("trace index out of range")
+
+        return self.make_instruction_trace(i, self.registers_at(i))
+
+    # Replays the register writes while iterating, so that going through the
+    # whole trace is linear
+    def __iter__(self):
+        registers = list(self.initial_registers)
+        dests = self.dests
+        values = self.values
+
+        for i in range(len(self)):
+            dest = dests[i]
+            if dest != NO_DEST:
+                registers[dest] = values[i]
+
+            yield self.make_instruction_trace(i, tuple(registers))
+
+    # Yields (instruction_index, opcode, func) for every instruction, without
+    # building InstructionTrace objects
+    def iter_opcodes(self):
+        first_index = self.first_index
+        for i, instruction in enumerate(self.instructions):
+            opcode = (instruction & 0xFC000000) >> 26
+            func = instruction & 0x3FF if opcode == RTYPE_OP else 0
+            yield first_index + i, opcode, func
@@ -0,0 +1,518 @@
+import numpy as np
+
+from common import warn
+from dlx_emu_cpu import (
+    extract_fields,
+    sign_extend,
+    MASK,
+    LINK_REGISTER,
+    SIGNED_IMM_OPS,
+    STOP_FINISHED,
+    STOP_MAX_INSTRUCTIONS,
+    STOP_INVALID_INSTRUCTION,
+)
+from dlx_emulator import hexfile_to_memory
+from dlx_instructions import *
+
+# Unlike DLXCpu, each instance only has memory_words words of memory. Reads
+# outside of it return 0 as for memory that was never written, but a write
+# outside of it stops the instance.
+STOP_OUT_OF_MEMORY = "out_of_memory"
+
+# Status of each instance, as stored in VectorDLXCpu.status
+RUNNING = 0
+FINISHED = 1
+INVALID_INSTRUCTION = 2
+OUT_OF_MEMORY = 3
+
+STOP_REASONS = {
+    RUNNING: STOP_MAX_INSTRUCTIONS,
+    FINISHED: STOP_FINISHED,
+    INVALID_INSTRUCTION: STOP_INVALID_INSTRUCTION,
+    OUT_OF_MEMORY: STOP_OUT_OF_MEMORY,
+}
+
+# Runs many instances of the same program at once, each with its own registers
+# and memory, held as NumPy arrays of shape (instances, 32) and
+# (instances, memory_words).
+#
+# All running instances execute one instruction per step. At each step the
+# instances are grouped by the instruction word they're about to execute, and
+# every group is executed by a single vectorized handler, so as long as the
+# instances follow the same path a step costs about as much as for a single
+# instance. Grouping by instruction word instead of by pc means that
+# instances which overwrite their own code still run what's in their memory.
+#
+# Every instance gives the same results as running DLXCpu on it.
+class VectorDLXCpu:
+    def __init__(self, memories, start_pc):
+        self.memory = np.array(memories, dtype=np.uint32, ndmin=2)
+        self.instances, self.memory_words = self.memory.shape
+
+        # Registers are stored one row per register, so that the handlers work
+        # on contiguous values. registers is a (instances, 32) view of it.
+        self.register_rows = np.zeros((32, self.instances), dtype=np.uint32)
+        self.registers = self.register_rows.T
+        self.pc = np.full(self.instances, start_pc, dtype=np.uint32)
+
+        self.cycle = np.zeros(self.instances, dtype=np.int64)
+        self.instructions_run = np.zeros(self.instances, dtype=np.int64)
+        self.status = np.full(self.instances, RUNNING, dtype=np.int8)
+        self.all_instances = np.arange(self.instances)
+
+        # Maps every instruction word that has been fetched to its decoded
+        # instruction
+        self.decoded = {}
+        self.itype_handlers, self.rtype_handlers = self.build_handlers()
+
+    # Loads the program in progfile in every instance. memory_words defaults
+    # to the size of the program.
+    @staticmethod
+    def from_program(progfile, instances, start_pc=0, memory_words=None):
+        return VectorDLXCpu.from_words(hexfile_to_memory(progfile), instances, start_pc, memory_words)
+
+    # Same as from_program, with the program given as a list of words (e.g.
+    # the words() of an AssembledProgram)
+    @staticmethod
+    def from_words(program, instances, start_pc=0, memory_words=None):
+        if memory_words is None:
+            memory_words = len(program)
+
+        memory = np.zeros(memory_words, dtype=np.uint32)
+        memory[:len(program)] = program[:memory_words]
+
+        return VectorDLXCpu(np.tile(memory, (instances, 1)), start_pc)
+
+    # Writes values, with shape (instances, count) or (count,), to the words
+    # starting at addr in every instance
+    def write_words(self, addr, values):
+        values = np.asarray(values, dtype=np.uint32)
+        self.memory[:, addr >> 2:(addr >> 2) + values.shape[-1]] = values
+
+    # Returns the count words starting at addr of every instance, with shape
+    # (instances, count)
+    def read_words(self, addr, count):
+        return self.memory[:, addr >> 2:(addr >> 2) + count].copy()
+
+    def stop_reasons(self):
+        return [STOP_REASONS[status] for status in self.status]
+
+    # Returns the word at addr of each instance in idx, or 0 outside of memory
+    def load(self, idx, addr):
+        idx = self.all_instances if isinstance(idx, slice) else idx
+        word_index = addr >> 2
+        inside = word_index < self.memory_words
+
+        if inside.all():
+            return self.memory[idx, word_index]
+
+        values = np.zeros(len(idx), dtype=np.uint32)
+        values[inside] = self.memory[idx[inside], word_index[inside]]
+        return values
+
+    # Writes value to addr, in the bytes selected by lane_mask, for each
+    # instance in idx. Writing to the termination address or outside of memory
+    # stops the instance instead.
+    def store(self, idx, addr, value, lane_mask):
+        idx = self.all_instances if isinstance(idx, slice) else idx
+        finished = (addr & 0xFFFF0000) == 0xFFFF0000
+        outside = (addr >> 2) >= self.memory_words
+
+        if finished.any() or outside.any():
+            self.status[idx[finished]] = FINISHED
+            self.status[idx[outside & ~finished]] = OUT_OF_MEMORY
+
+            keep = ~(finished | outside)
+            idx, addr, value, lane_mask = idx[keep], addr[keep], value[keep], lane_mask[keep]
+
+        word_index = addr >> 2
+        old = self.memory[idx, word_index]
+        self.memory[idx, word_index] = (old & ~lane_mask) | (value & lane_mask)
+
+    # Handlers take the indices of the instances in the group (or a slice of
+    # all of them), their pcs and the decoded operands, as in DLXCpu. Branches and jumps write the next pc
+    # of the instances they move, the others already have pc + 4.
+    # Arithmetic on uint32 arrays wraps around, signed operations go through
+    # an int32 view of the same values.
+    def build_handlers(self):
+        regs = self.register_rows
+        pc = self.pc
+
+        def addi(idx, _pcs, rd, rs1, imm):
+            regs[rd, idx] = regs[rs1, idx] + np.uint32(imm & MASK)
+
+        def subi(idx, _pcs, rd, rs1, imm):
+            regs[rd, idx] = regs[rs1, idx] - np.uint32(imm & MASK)
+
+        def beqz(idx, pcs, rs1, offset, _):
+            pc[idx] = np.where(regs[rs1, idx] == 0, pcs + np.uint32((4 + offset) & MASK), pc[idx])
+
+        def bnez(idx, pcs, rs1, offset, _):
+            pc[idx] = np.where(regs[rs1, idx] != 0, pcs + np.uint32((4 + offset) & MASK), pc[idx])
+
+        def jalr(idx, pcs, rs1, _offset, _):
+            regs[LINK_REGISTER, idx] = pcs + np.uint32(4)
+            pc[idx] = regs[rs1, idx]
+
+        def jr(idx, _pcs, rs1, _offset, _):
+            pc[idx] = regs[rs1, idx]
+
+        def seqi(idx, _pcs, rd, rs1, imm):
+            regs[rd, idx] = regs[rs1, idx] == imm
+
+        def sgei(idx, _pcs, rd, rs1, imm):
+            regs[rd, idx] = regs[rs1, idx].view(np.int32) >= imm
+
+        def sgeui(idx, _pcs, rd, rs1, imm):
+            regs[rd, idx] = regs[rs1, idx] >= imm
+
+        def sgti(idx, _pcs, rd, rs1, imm):
+            regs[rd, idx] = regs[rs1, idx].view(np.int32) > imm
+
+        def slei(idx, _pcs, rd, rs1, imm):
+            regs[rd, idx] = regs[rs1, idx].view(np.int32) <= imm
+
+        def sleui(idx, _pcs, rd, rs1, imm):
+            regs[rd, idx] = regs[rs1, idx] <= imm
+
+        def slti(idx, _pcs, rd, rs1, imm):
+            regs[rd, idx] = regs[rs1, idx].view(np.int32) < imm
+
+        def sltui(idx, _pcs, rd, rs1, imm):
+            regs[rd, idx] = regs[rs1, idx] < imm
+
+        def snei(idx, _pcs, rd, rs1, imm):
+            regs[rd, idx] = regs[rs1, idx] != imm
+
+        def andi(idx, _pcs, rd, rs1, imm):
+            regs[rd, idx] = regs[rs1, idx] & np.uint32(imm)
+
+        def ori(idx, _pcs, rd, rs1, imm):
+            regs[rd, idx] = regs[rs1, idx] | np.uint32(imm)
+
+        def xori(idx, _pcs, rd, rs1, imm):
+            regs[rd, idx] = regs[rs1, idx] ^ np.uint32(imm)
+
+        # As in the LoadStoreUnit, byte 0 of a word is its least significant
+        # byte and the lowest bit of halfword addresses is ignored
+        def load_byte(idx, rs1, imm):
+            addr = regs[rs1, idx] + np.uint32(imm & MASK)
+            return (self.load(idx, addr) >> ((addr & 3) << 3)) & np.uint32(0xFF)
+
+        def load_halfword(idx, rs1, imm):
+            addr = regs[rs1, idx] + np.uint32(imm & MASK)
+            return (self.load(idx, addr) >> (addr & 2) * 8) & np.uint32(0xFFFF)
+
+        def lb(idx, _pcs, rd, rs1, imm):
+            regs[rd, idx] = load_byte(idx, rs1, imm).astype(np.uint8).view(np.int8).astype(np.int32).view(np.uint32)
+
+        def lbu(idx, _pcs, rd, rs1, imm):
+            regs[rd, idx] = load_byte(idx, rs1, imm)
+
+        def lh(idx, _pcs, rd, rs1, imm):
+            regs[rd, idx] = load_halfword(idx, rs1, imm).astype(np.uint16).view(np.int16).astype(np.int32).view(np.uint32)
+
+        def lhu(idx, _pcs, rd, rs1, imm):
+            regs[rd, idx] = load_halfword(idx, rs1, imm)
+
+        def lw(idx, _pcs, rd, rs1, imm):
+            regs[rd, idx] = self.load(idx, regs[rs1, idx] + np.uint32(imm & MASK))
+
+        def sb(idx, _pcs, rd, rs1, imm):
+            addr = regs[rs1, idx] + np.uint32(imm & MASK)
+            shift = (addr & 3) << 3
+            self.store(idx, addr, regs[rd, idx] << shift, np.uint32(0xFF) << shift)
+
+        def sh(idx, _pcs, rd, rs1, imm):
+            addr = regs[rs1, idx] + np.uint32(imm & MASK)
+            shift = (addr & 2) * 8
+            self.store(idx, addr, regs[rd, idx] << shift, np.uint32(0xFFFF) << shift)
+
+        def sw(idx, _pcs, rd, rs1, imm):
+            addr = regs[rs1, idx] + np.uint32(imm & MASK)
+            self.store(idx, addr, regs[rd, idx], np.full(addr.shape, MASK, dtype=np.uint32))
+
+        # The shifted immediate is computed at decode time
+        def lhi(idx, _pcs, rd, _rs1, value):
+            regs[rd, idx] = value
+
+        def nop(_idx, _pcs, _a, _b, _c):
+            pass
+
+        # The shift amount is masked at decode time
+        def slli(idx, _pcs, rd, rs1, amount):
+            regs[rd, idx] = regs[rs1, idx] << np.uint32(amount)
+
+        def srai(idx, _pcs, rd, rs1, amount):
+            regs[rd, idx] = (regs[rs1, idx].view(np.int32) >> amount).view(np.uint32)
+
+        def srli(idx, _pcs, rd, rs1, amount):
+            regs[rd, idx] = regs[rs1, idx] >> np.uint32(amount)
+
+        def j(idx, pcs, offset, _link, _):
+            pc[idx] = pcs + np.uint32((4 + offset) & MASK)
+
+        def jal(idx, pcs, offset, _link, _):
+            regs[LINK_REGISTER, idx] = pcs + np.uint32(4)
+            pc[idx] = pcs + np.uint32((4 + offset) & MASK)
+
+        def add(idx, _pcs, rd, rs1, rs2):
+            regs[rd, idx] = regs[rs1, idx] + regs[rs2, idx]
+
+        def sub(idx, _pcs, rd, rs1, rs2):
+            regs[rd, idx] = regs[rs1, idx] - regs[rs2, idx]
+
+        def seq(idx, _pcs, rd, rs1, rs2):
+            regs[rd, idx] = regs[rs1, idx] == regs[rs2, idx]
+
+        def sge(idx, _pcs, rd, rs1, rs2):
+            regs[rd, idx] = regs[rs1, idx].view(np.int32) >= regs[rs2, idx].view(np.int32)
+
+        def sgeu(idx, _pcs, rd, rs1, rs2):
+            regs[rd, idx] = regs[rs1, idx] >= regs[rs2, idx]
+
+        def sgt(idx, _pcs, rd, rs1, rs2):
+            regs[rd, idx] = regs[rs1, idx].view(np.int32) > regs[rs2, idx].view(np.int32)
+
+        def sgtu(idx, _pcs, rd, rs1, rs2):
+            regs[rd, idx] = regs[rs1, idx] > regs[rs2, idx]
+
+        def sle(idx, _pcs, rd, rs1, rs2):
+            regs[rd, idx] = regs[rs1, idx].view(np.int32) <= regs[rs2, idx].view(np.int32)
+
+        def sleu(idx, _pcs, rd, rs1, rs2):
+            regs[rd, idx] = regs[rs1, idx] <= regs[rs2, idx]
+
+        def slt(idx, _pcs, rd, rs1, rs2):
+            regs[rd, idx] = regs[rs1, idx].view(np.int32) < regs[rs2, idx].view(np.int32)
+
+        def sltu(idx, _pcs, rd, rs1, rs2):
+            regs[rd, idx] = regs[rs1, idx] < regs[rs2, idx]
+
+        def sne(idx, _pcs, rd, rs1, rs2):
+            regs[rd, idx] = regs[rs1, idx] != regs[rs2, idx]
+
+        def and_(idx, _pcs, rd, rs1, rs2):
+            regs[rd, idx] = regs[rs1, idx] & regs[rs2, idx]
+
+        def or_(idx, _pcs, rd, rs1, rs2):
+            regs[rd, idx] = regs[rs1, idx] | regs[rs2, idx]
+
+        def xor(idx, _pcs, rd, rs1, rs2):
+            regs[rd, idx] = regs[rs1, idx] ^ regs[rs2, idx]
+
+        def sll(idx, _pcs, rd, rs1, rs2):
+            regs[rd, idx] = regs[rs1, idx] << (regs[rs2, idx] & np.uint32(0x1F))
+
+        def sra(idx, _pcs, rd, rs1, rs2):
+            amount = (regs[rs2, idx] & np.uint32(0x1F)).astype(np.int32)
+            regs[rd, idx] = (regs[rs1, idx].view(np.int32) >> amount).view(np.uint32)
+
+        def srl(idx, _pcs, rd, rs1, rs2):
+            regs[rd, idx] = regs[rs1, idx] >> (regs[rs2, idx] & np.uint32(0x1F))
+
+        def imul(idx, _pcs, rd, rs1, rs2):
+            regs[rd, idx] = regs[rs1, idx] * regs[rs2, idx]
+
+        # Division rounds towards negative infinity and modulo takes the
+        # absolute value of the remainder, as Python does in DLXCpu
+        def idiv(idx, _pcs, rd, rs1, rs2):
+            dividend = regs[rs1, idx].view(np.int32).astype(np.int64)
+            divisor = regs[rs2, idx].view(np.int32).astype(np.int64)
+
+            zero = divisor == 0
+            if zero.any():
+                warn("Division by zero detected, result is undefined")
+
+            result = np.floor_divide(dividend, np.where(zero, 1, divisor))
+            regs[rd, idx] = np.where(zero, MASK, result & MASK).astype(np.uint32)
+
+        def imod(idx, _pcs, rd, rs1, rs2):
+            dividend = regs[rs1, idx].view(np.int32).astype(np.int64)
+            divisor = regs[rs2, idx].view(np.int32).astype(np.int64)
+
+            zero = divisor == 0
+            if zero.any():
+                warn("Modulo by zero detected, result is undefined")
+
+            result = np.abs(np.mod(dividend, np.where(zero, 1, divisor)))
+            regs[rd, idx] = np.where(zero, regs[rs1, idx], result & MASK).astype(np.uint32)
+
+        itype_handlers = {
+            ITYPE_ADDI: addi,
+            ITYPE_ADDUI: addi,
+            ITYPE_SUBI: subi,
+            ITYPE_SUBUI: subi,
+            ITYPE_BEQZ: beqz,
+            ITYPE_BNEZ: bnez,
+            ITYPE_JALR: jalr,
+            ITYPE_JR: jr,
+            ITYPE_SEQI: seqi,
+            ITYPE_SGEI: sgei,
+            ITYPE_SGEUI: sgeui,
+            ITYPE_SGTI: sgti,
+            # NOTE: sgtui compares the signed register against the unsigned immediate
+            ITYPE_SGTUI: sgti,
+            ITYPE_SLEI: slei,
+            ITYPE_SLEUI: sleui,
+            ITYPE_SLTI: slti,
+            ITYPE_SLTUI: sltui,
+            ITYPE_SNEI: snei,
+            ITYPE_ANDI: andi,
+            ITYPE_ORI: ori,
+            ITYPE_XORI: xori,
+            ITYPE_LB: lb,
+            ITYPE_LBU: lbu,
+            ITYPE_LH: lh,
+            ITYPE_LHU: lhu,
+            ITYPE_LW: lw,
+            ITYPE_SB: sb,
+            ITYPE_SH: sh,
+            ITYPE_SW: sw,
+            ITYPE_LHI: lhi,
+            ITYPE_NOP: nop,
+            ITYPE_SLLI: slli,
+            ITYPE_SRAI: srai,
+            ITYPE_SRLI: srli,
+            JTYPE_J: j,
+            JTYPE_JAL: jal,
+        }
+
+        rtype_handlers = {
+            FUNC_ADD: add,
+            FUNC_ADDU: add,
+            FUNC_SUB: sub,
+            FUNC_SUBU: sub,
+            FUNC_SEQ: seq,
+            FUNC_SGE: sge,
+            FUNC_SGEU: sgeu,
+            FUNC_SGT: sgt,
+            FUNC_SGTU: sgtu,
+            FUNC_SLE: sle,
+            FUNC_SLEU: sleu,
+            FUNC_SLT: slt,
+            FUNC_SLTU: sltu,
+            FUNC_SNE: sne,
+            FUNC_AND: and_,
+            FUNC_OR: or_,
+            FUNC_XOR: xor,
+            FUNC_SLL: sll,
+            FUNC_SRA: sra,
+            FUNC_SRL: srl,
+            FUNC_IMUL: imul,
+            FUNC_IDIV: idiv,
+            FUNC_IMOD: imod,
+        }
+
+        return itype_handlers, rtype_handlers
+
+    # Decodes an instruction word as DLXCpu.decode does, except that branch
+    # and jump targets are kept as offsets, since the same word can be at
+    # different pcs. The handler is None if the instruction is not valid.
+    def decode(self, instruction):
+        opcode, itype, rtype, jtype = extract_fields(instruction)
+
+        if opcode == RTYPE_OP:
+            handler = self.rtype_handlers.get(instruction & 0x000003FF)
+            a, b, c = rtype
+        else:
+            handler = self.itype_handlers.get(opcode)
+            rd, rs1, imm = itype
+
+            if opcode == ITYPE_BEQZ or opcode == ITYPE_BNEZ:
+                a, b, c = rs1, sign_extend(imm, 16), None
+            elif opcode == ITYPE_JR or opcode == ITYPE_JALR:
+                a, b, c = rs1, None, None
+            elif opcode == JTYPE_J or opcode == JTYPE_JAL:
+                a, b, c = sign_extend(jtype[0], 26), None, None
+            elif opcode == ITYPE_LHI:
+                a, b, c = rd, rs1, (imm << 16) & MASK
+            elif opcode == ITYPE_SLLI or opcode == ITYPE_SRAI or opcode == ITYPE_SRLI:
+                a, b, c = rd, rs1, imm & 0x1F
+            elif opcode in SIGNED_IMM_OPS:
+                a, b, c = rd, rs1, sign_extend(imm, 16)
+            else:
+                a, b, c = rd, rs1, imm
+
+        decoded = (handler, a, b, c, opcode)
+        self.decoded[instruction] = decoded
+
+        return decoded
+
+    # Runs all instances for up to max_cycles instructions each (nops
+    # included), or until every instance has stopped. Returns the stop reason
+    # of every instance, as in DLXCpu.run.
+    def run(self, max_cycles):
+        memory = self.memory
+        status = self.status
+        decoded_cache = self.decoded
+
+        active = np.flatnonzero(status == RUNNING)
+
+        for _ in range(max_cycles):
+            if len(active) == 0:
+                break
+
+            # Usually all instances are running and at the same pc, and then
+            # whole columns can be used instead of gathering
+            everyone = len(active) == self.instances
+            pcs = self.pc.copy() if everyone else self.pc[active]
+            first_pc = int(pcs[0])
+
+            if pcs[-1] == first_pc and (pcs == first_pc).all() and (first_pc >> 2) < self.memory_words:
+                words = memory[active, first_pc >> 2] if not everyone else memory[:, first_pc >> 2]
+            else:
+                words = self.load(active, pcs)
+
+            if everyone:
+                self.pc += np.uint32(4)
+                self.cycle += 1
+            else:
+                self.pc[active] = pcs + np.uint32(4)
+                self.cycle[active] += 1
+
+            # Usually all instances run the same instruction, and there's no
+            # need to group them
+            if words[0] == words[-1] and (words == words[0]).all():
+                groups = [(slice(None) if everyone else active, pcs, int(words[0]))]
+            else:
+                unique_words, inverse = np.unique(words, return_inverse=True)
+                order = np.argsort(inverse, kind="stable")
+                bounds = np.cumsum(np.bincount(inverse))[:-1]
+                groups = zip(
+                    np.split(active[order], bounds),
+                    np.split(pcs[order], bounds),
+                    unique_words.tolist()
+                )
+
+            stopped = False
+            for idx, group_pcs, instruction in groups:
+                try:
+                    handler, a, b, c, opcode = decoded_cache[instruction]
+                except KeyError:
+                    handler, a, b, c, opcode = self.decode(instruction)
+
+                if handler is None:
+                    if opcode == RTYPE_OP:
+                        print(f"Unknown function {instruction & 0x3FF:03X} in {len(group_pcs)} instances")
+                    else:
+                        print(f"Unknown opcode {opcode:02X} in {len(group_pcs)} instances")
+
+                    status[idx] = INVALID_INSTRUCTION
+                    self.cycle[idx] -= 1
+                    self.instructions_run[idx] += 1
+                    stopped = True
+                    continue
+
+                handler(idx, group_pcs, a, b, c)
+
+                if opcode != ITYPE_NOP:
+                    self.instructions_run[idx] += 1
+
+                if opcode == ITYPE_SB or opcode == ITYPE_SH or opcode == ITYPE_SW:
+                    stopped = True
+
+            if stopped:
+                active = np.flatnonzero(status == RUNNING)
+
+        return self.stop_reasons()
@@ -1,8 +1,24 @@
-from dlx_emu_cpu import DLXCpu
-from dlx_emu_bus import MemoryBus
-from dlx_instructions import ITYPE_NOP
+import queue
+import threading
 
-from common import error
+from dlx_emu_cpu import DLXCpu, STOP_FINISHED, STOP_MAX_INSTRUCTIONS, STOP_INVALID_INSTRUCTION
+from dlx_emu_blocks import DLXBlockCpu
+from dlx_emu_bus import MemoryBus, RecordingMemoryBus
+from dlx_emu_checkpoint import save_checkpoint, load_checkpoint
+from dlx_emu_trace import EmulatorTrace
+
+from common import error, warn
+
+EMULATOR_BACKENDS = {
+    "interpreter": DLXCpu,
+    "blocks": DLXBlockCpu,
+}
+
+# Maximum number of instructions in each chunk of a streamed trace, and maximum
+# number of chunks waiting to be written. When the writer falls behind, the
+# emulator waits for it, so that memory stays bounded.
+TRACE_CHUNK_SIZE = 65536
+MAX_PENDING_CHUNKS = 4
 
 def hexfile_to_memory(filename):
     memory = []
@@ -12,33 +28,235 @@ def hexfile_to_memory(filename):
 
     return memory
 
-def emulate(progfile, starting_pc, max_cycles, dumpfile, verbose=False):
-    memory = hexfile_to_memory(progfile)
+# Runs the cpu for up to max_cycles, yielding the trace as EmulatorTrace chunks
+# of up to chunk_size instructions as the emulation goes on. Only the chunk
+# being recorded is kept in memory. Stops early if the program finishes or hits
+# an invalid instruction. If a timing model is given, every instruction also
+# goes through it, otherwise it gets counted in profile, if given.
+def run_in_chunks(cpu, max_cycles, verbose=False, chunk_size=TRACE_CHUNK_SIZE, timing=None, profile=None):
+    membus = cpu.bus
+    end_cycle = cpu.cycle + max_cycles
 
-    membus = MemoryBus(memory)
-    cpu = DLXCpu(membus, starting_pc)
-    was_stopped = False
+    while cpu.cycle < end_cycle and not membus.is_finished():
+        chunk = EmulatorTrace(cpu)
+        cycles = min(chunk_size, end_cycle - cpu.cycle)
 
-    emulator_trace = []
+        stop_reason = None
+        if timing is not None:
+            stop_reason, _, _ = timing.run(cpu, cycles, chunk, verbose)
+        elif verbose:
+            for _ in range(cycles):
+                if cpu.run_one_instruction(verbose, chunk) is None:
+                    stop_reason = STOP_INVALID_INSTRUCTION
+                    break
+                if membus.is_finished():
+                    break
+        else:
+            stop_reason, _, _ = cpu.run(cycles, chunk, profile)
 
-    for _ in range(max_cycles):
-        trace = cpu.run_one_instruction(verbose)
-        if trace.opcode != ITYPE_NOP:
-            emulator_trace.append(trace)
+        if len(chunk) > 0:
+            yield chunk
 
-        if membus.is_finished():
-            was_stopped = True
+        if stop_reason == STOP_INVALID_INSTRUCTION:
+            return
+
+# Runs the cpu without tracing until it has run instruction_index
+# instructions, unless it finishes or goes over max_cycles before.
+def fast_forward(cpu, instruction_index, max_cycles):
+    end_cycle = cpu.cycle + max_cycles
+
+    while cpu.instructions_run < instruction_index and cpu.cycle < end_cycle:
+        # Nops don't count as instructions, so this might take more than one run
+        stop_reason, _, _ = cpu.run(min(instruction_index - cpu.instructions_run, end_cycle - cpu.cycle))
+        if stop_reason != STOP_MAX_INSTRUCTIONS:
             break
 
+# Writes the chunks of a trace to a sink from a background thread, so that the
+# emulation can go on while the trace is being written. The sink needs a
+# write(chunk) and a close() method, and gets closed once all chunks have been
+# written.
+class TraceWriterThread(threading.Thread):
+    def __init__(self, sink):
+        super().__init__(daemon=True)
+        self.sink = sink
+        self.queue = queue.Queue(maxsize=MAX_PENDING_CHUNKS)
+        self.exception = None
+
+    def run(self):
+        try:
+            while True:
+                chunk = self.queue.get()
+                if chunk is None:
+                    break
+
+                # After an error the remaining chunks are still taken from the
+                # queue, or the emulator would wait forever
+                if self.exception is None:
+                    try:
+                        self.sink.write(chunk)
+                    except Exception as e:
+                        self.exception = e
+        finally:
+            self.sink.close()
+
+    def write(self, chunk):
+        self.queue.put(chunk)
+
+    # Waits for all chunks to be written. Raises any error the sink had.
+    def finish(self):
+        self.queue.put(None)
+        self.join()
+
+        if self.exception is not None:
+            raise self.exception
+
+# The program is read from progfile, unless it's given already in memory as the
+# words of program (e.g. the words() of an AssembledProgram).
+#
+# If keep_trace is False, no trace is recorded and the returned trace is empty.
+# If a trace_sink is given, the trace is written to it in chunks while the
+# emulation goes on instead of being returned, and whatever was run is written
+# even if the program goes over max_cycles.
+#
+# If resume_from is given, the emulation starts from that checkpoint instead of
+# from the start of progfile, and fails if it isn't a valid checkpoint. If
+# checkpoint_at is given, the emulator first
+# runs without tracing up to that instruction index and saves a checkpoint to
+# checkpoint_path, and then goes on as usual; the trace only starts from there.
+#
+# If timing is a PipelineTimingModel, every instruction run after the checkpoint
+# (if any) also goes through it, to estimate the cycles the CPU would take.
+#
+# If profile is a profiler.Profile, every instruction run after the checkpoint
+# (if any) gets counted in it, unless the run is verbose or timed, which go one
+# instruction at a time.
+#
+# If memory_profile is a memory_profile.MemoryAccessProfile, every load and
+# store run after the checkpoint (if any) gets counted in it, a chunk at a time
+# (see RecordingMemoryBus).
+def emulate(
+        progfile,
+        starting_pc,
+        max_cycles,
+        dumpfile,
+        verbose=False,
+        backend="interpreter",
+        keep_trace=True,
+        trace_sink=None,
+        checkpoint_at=None,
+        checkpoint_path=None,
+        resume_from=None,
+        timing=None,
+        program=None,
+        profile=None,
+        memory_profile=None):
+
+    if resume_from is not None:
+        bus = RecordingMemoryBus([], memory_profile.add) if memory_profile is not None else None
+        try:
+            cpu = load_checkpoint(resume_from, EMULATOR_BACKENDS[backend], bus)
+        except ValueError as e:
+            error(f"ERROR: {e}")
+            if trace_sink is not None:
+                trace_sink.close()
+            return False, 0, []
+        membus = cpu.bus
+    else:
+        memory = list(program) if program is not None else hexfile_to_memory(progfile)
+
+        if memory_profile is not None:
+            membus = RecordingMemoryBus(memory, memory_profile.add)
+        else:
+            membus = MemoryBus(memory)
+        cpu = EMULATOR_BACKENDS[backend](membus, starting_pc)
+
+    max_cycles_left = max_cycles
+
+    if checkpoint_at is not None:
+        start_cycle = cpu.cycle
+        fast_forward(cpu, checkpoint_at, max_cycles)
+        max_cycles_left -= cpu.cycle - start_cycle
+
+        if cpu.instructions_run == checkpoint_at:
+            save_checkpoint(cpu, checkpoint_path)
+        else:
+            warn(f"The emulation stopped before instruction {checkpoint_at}, no checkpoint was saved.")
+
+        # Like the trace, the accesses only start from the checkpoint
+        if memory_profile is not None:
+            membus.discard()
+            memory_profile.clear()
+
+    if profile is not None:
+        if verbose or timing is not None:
+            warn("The profile isn't recorded with --verbose, --timing or --caches")
+            profile = None
+        else:
+            profile.begin(cpu.pc, cpu.cycle)
+
+    if trace_sink is not None:
+        writer = TraceWriterThread(trace_sink)
+        writer.start()
+
+        end_cycle = cpu.cycle + max_cycles_left
+        try:
+            for chunk in run_in_chunks(cpu, max_cycles_left, verbose, timing=timing, profile=profile):
+                writer.write(chunk)
+        finally:
+            writer.finish()
+
+        # Invalid instructions don't take a cycle, so they're the only reason
+        # to stop before the end without finishing
+        if membus.is_finished():
+            stop_reason = STOP_FINISHED
+        elif cpu.cycle < end_cycle:
+            stop_reason = STOP_INVALID_INSTRUCTION
+        else:
+            stop_reason = STOP_MAX_INSTRUCTIONS
+        emulator_trace = []
+    elif membus.is_finished():
+        # The program finished before the checkpoint, or the checkpoint was
+        # saved once it had finished
+        stop_reason = STOP_FINISHED
+        emulator_trace = EmulatorTrace(cpu) if keep_trace else []
+    elif verbose and timing is None:
+        stop_reason = STOP_MAX_INSTRUCTIONS
+        emulator_trace = EmulatorTrace(cpu)
+        for _ in range(max_cycles_left):
+            if cpu.run_one_instruction(verbose, emulator_trace) is None:
+                stop_reason = STOP_INVALID_INSTRUCTION
+                break
+
+            if membus.is_finished():
+                stop_reason = STOP_FINISHED
+                break
+    else:
+        emulator_trace = EmulatorTrace(cpu) if keep_trace else None
+        if timing is not None:
+            stop_reason, _, _ = timing.run(cpu, max_cycles_left, emulator_trace, verbose)
+        else:
+            stop_reason, _, _ = cpu.run(max_cycles_left, emulator_trace, profile)
+
+        if emulator_trace is None:
+            emulator_trace = []
+
+    if profile is not None:
+        profile.finish(cpu)
+
+    if memory_profile is not None:
+        membus.flush()
+
+    if stop_reason == STOP_INVALID_INSTRUCTION:
+        # The pc is already past the instruction
+        error(f"ERROR: The emulation stopped at an invalid instruction at pc {cpu.pc - 4:08X}.")
+        return False, cpu.instructions_run, []
 
-    if not was_stopped:
+    if stop_reason != STOP_FINISHED:
         error(f"ERROR: The simulation went over {max_cycles} cycles.")
         return False, cpu.instructions_run, []
 
     if dumpfile != "":
-        with open(dumpfile, "w") as dump:
-            for i, val in enumerate(membus.memory):
-                print(f"{i*4:08X}: {val:08X}", file=dump)
+        membus.dump(dumpfile)
 
     return True, cpu.instructions_run, emulator_trace
 
@@ -2,19 +2,52 @@
 
 import subprocess
 import argparse
+import sys
 import shutil
 import re
 import time
+import os
+import io
+import contextlib
+import traceback
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.util import Finalize
 
 import dlx_emulator as emulator
+import dlx_assembler
 import simulator
+import state_hash
+import pipeline_log
+from vsim_session import VsimSession
 import checker
 
-from common import error, success, write_trace_to_file, load_memory, load_symbols, CpuSimulationConfig
+from common import error, success, warn, write_trace, write_trace_to_file, load_memory, load_symbols, CpuSimulationConfig, CacheSize
+from trace_file import write_binary_trace, TraceFile, TextTraceSink, BinaryTraceSink
+from dlx_emu_timing import PipelineTimingModel
+from dlx_emu_cache import MemorySystemModel
+from dlx_emu_trace import EmulatorTrace
+from dlx_emu_btb import BTBModel, BranchRecorder, DEFAULT_BTB_LINES_WIDTH, sweep_btb, print_btb_table
+from assembly_cache import AssemblyCache
+from listing import ProgramListing
+from profiler import Profile
 from pathlib import Path
 
 ASSEMBLER_PATH = "./assembler/dlxasm.pl"
 
+# The in-process port of dlxasm.pl, or dlxasm.pl itself. The programs that
+# go to the cpu simulation are assembled by dlxasm.pl unless asked otherwise,
+# while the sweeps, which only emulate, use the port.
+ASSEMBLERS = ["python", "perl"]
+DEFAULT_ASSEMBLER = "perl"
+
+# Cycles the cpu can go without retiring instructions before the simulation is
+# stopped, when it's checked against the emulator while it runs
+DEFAULT_WATCHDOG_CYCLES = 1000
+
+# The vsim session of a worker of the test suite pool, if the tests run in one
+worker_vsim_session = None
+
 def run_gui_simulation(program_source, outdir, start_address, max_cycles):
     path_asm_source = Path(program_source)
 
@@ -23,7 +56,6 @@ def run_gui_simulation(program_source, outdir, start_address, max_cycles):
 
     path_dumpfile_mem_init = path_outdir / f"{progname}.mem"
     path_dumpfile_cpu = path_outdir / f"{progname}_sim_dump.mem"
-    path_symbols = path_outdir / f"{progname}.sym"
 
     if not path_asm_source.exists():
         error(f"ERROR: {path_asm_source} does not exist")
@@ -35,7 +67,8 @@ def run_gui_simulation(program_source, outdir, start_address, max_cycles):
 
     path_outdir.mkdir(parents=True, exist_ok=True)
 
-    assemble(path_asm_source, path_outdir)
+    program = assemble(path_asm_source, path_outdir)
+    symbols = program.symbols if program is not None else load_symbols(path_outdir / f"{progname}.sym")
 
     simulator.simulate_cpu_with_gui(
             mem_init=path_dumpfile_mem_init,
@@ -43,20 +76,10 @@ def run_gui_simulation(program_source, outdir, start_address, max_cycles):
             max_cycles=max_cycles,
             start_addr=start_address,
             outdir=path_outdir,
-            symbols=load_symbols(path_symbols))
-
+            symbols=symbols)
 
-def load_symbols(path_symbols):
-    symbols = {}
-    with open(path_symbols, "r") as symfile:
-        for line in symfile:
-            key, val = re.split(r"\s+", line.strip())
-            symbols[key] = int(val, 16)
 
-    return symbols
-
-def print_variables_from_dump(path_symbols, path_dump):
-    symbols = load_symbols(path_symbols)
+def print_variables_from_dump(symbols, path_dump):
     if "data_start" not in symbols:
         print("No variables to show")
         return
@@ -69,17 +92,132 @@ def print_variables_from_dump(path_symbols, path_dump):
             print(f"{name} = 0x{mem[address]:08X} ({mem[address]})")
 
 
-def run_test(program_source, outdir, max_cycles=30_000):
+# How the tests of a suite are run, the same for all of them. It gets passed
+# to the worker processes, so it only holds plain values.
+class SuiteOptions:
+    def __init__(
+            self,
+            outdir,
+            max_cycles=30_000,
+            emulator_backend="interpreter",
+            estimate_timing=False,
+            jobs=1,
+            use_asm_cache=True,
+            assembler=DEFAULT_ASSEMBLER,
+            use_vsim_session=False,
+            watchdog_cycles=DEFAULT_WATCHDOG_CYCLES):
+
+        self.outdir = outdir
+        self.max_cycles = max_cycles
+        self.emulator_backend = emulator_backend
+        self.estimate_timing = estimate_timing
+        self.jobs = jobs
+        self.use_asm_cache = use_asm_cache
+        self.assembler = assembler
+        self.use_vsim_session = use_vsim_session
+        self.watchdog_cycles = watchdog_cycles
+
+def run_test(program_source, options, timing=None, work_dir=None, vsim_session=None):
     return run_program(
         program_source,
-        outdir,
-        max_cycles=max_cycles,
+        options.outdir,
+        max_cycles=options.max_cycles,
         should_emulate=True,
         should_simulate=True,
-        quiet=True
+        quiet=True,
+        emulator_backend=options.emulator_backend,
+        timing=timing,
+        work_dir=work_dir,
+        use_asm_cache=options.use_asm_cache,
+        assembler=options.assembler,
+        vsim_session=vsim_session,
+        watchdog_cycles=options.watchdog_cycles
     )
 
-def run_test_suite(tests_file_path, outdir, max_cycles=30_000):
+# Runs one test of the suite and prints its results. Returns
+# (name, success, cpi, timing_estimate, counters), where timing_estimate is
+# (cycles_taken, estimated_cycles, error) or None, and counters are the
+# performance counters of the cpu, or None.
+def run_suite_test(path_program, options, work_dir=None, vsim_session=None):
+    start = time.perf_counter()
+
+    timing = PipelineTimingModel(memory=MemorySystemModel()) if options.estimate_timing else None
+
+    try:
+        test_success, instructions_ran, cycles_taken, counters = run_test(path_program, options, timing=timing, work_dir=work_dir, vsim_session=vsim_session)
+    except SystemExit:
+        # The assembler exits on errors, which would take down a whole worker
+        if work_dir is None:
+            raise
+        test_success, instructions_ran, cycles_taken, counters = False, 0, 0, None
+    except Exception:
+        # Anything else that goes wrong (vsim not starting, a file that can't
+        # be read, ...) only fails this test
+        traceback.print_exc(file=sys.stdout)
+        test_success, instructions_ran, cycles_taken, counters = False, 0, 0, None
+
+    if instructions_ran > 0:
+        cpi = float(cycles_taken) / float(instructions_ran)
+    else:
+        cpi = 0
+
+    if not test_success:
+        error("Test Failed.")
+    else:
+        success("Test Succeded!")
+
+    print(f"Instructions ran: {instructions_ran}, Cycles Taken: {cycles_taken}")
+    if instructions_ran > 0:
+        print(f"Clocks per instruction: {cpi:.2f}")
+
+    timing_estimate = None
+    if timing is not None and cycles_taken > 0:
+        estimated_cycles = timing.estimated_cycles()
+        timing_error = float(estimated_cycles - cycles_taken) / float(cycles_taken) * 100.0
+        timing_estimate = (cycles_taken, estimated_cycles, timing_error)
+        print(f"Estimated cycles: {estimated_cycles} (error = {timing_error:+.2f} %)")
+
+
+    end = time.perf_counter()
+
+    print(f"Done! Took {(end - start):.2f} s.")
+    print()
+
+    return path_program.name, test_success, cpi, timing_estimate, counters
+
+# Runs a test in a worker process of the pool. Every worker compiles the RTL in
+# its own vsim work library, so that workers don't overwrite each other's
+# design units, and its output is returned instead of printed, so that it can
+# be printed in the order of the tests. With use_vsim_session, every worker
+# keeps its own vsim session open for all the tests it runs, and closes it when
+# the pool shuts down.
+def run_suite_test_in_worker(path_program, options):
+    global worker_vsim_session
+
+    work_dir = Path(options.outdir) / "vsim" / f"worker_{os.getpid()}"
+    work_dir.mkdir(parents=True, exist_ok=True)
+
+    if options.use_vsim_session and worker_vsim_session is None:
+        worker_vsim_session = VsimSession(work_dir)
+        # Closed when the worker exits, which runs the finalizers of
+        # multiprocessing but not the ones of atexit
+        Finalize(None, worker_vsim_session.close, exitpriority=0)
+
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        result = run_suite_test(path_program, options, work_dir=work_dir, vsim_session=worker_vsim_session)
+
+    return output.getvalue(), result
+
+# Runs the tests listed in tests_file_path with the given SuiteOptions. If
+# estimate_timing is True, the cycles estimated by the pipeline timing model
+# (caches included) get compared with the ones taken by the simulation for
+# every test. With jobs > 1, the tests run in a pool of that many processes,
+# and the output of each test is printed once it and all the ones before it are
+# done. With use_vsim_session, the tests are simulated one after the other in
+# the same vsim process (one for each process of the pool), instead of starting
+# vsim for each of them.
+def run_test_suite(tests_file_path, options):
     path_tests_file = Path(tests_file_path)
 
     if not path_tests_file.exists():
@@ -88,48 +226,70 @@ def run_test_suite(tests_file_path, outdir, max_cycles=30_000):
 
     failing_tests = []
     successful_tests = []
+    timing_estimates = []
+    performance = []
 
     print("### STARTING TESTS ###")
     time_start_tests = time.perf_counter()
 
     with open(tests_file_path, "r") as tests_file:
         tests_array = tests_file.readlines()
-        total_tests = len(tests_array)
-        for i, line in enumerate(tests_array):
-            line = line.strip().split("#")[0]
-
-            if line == "":
-                continue
-
-            path_program = Path(line)
-
-            print(f"[{i+1:03}/{total_tests:03}] Running {path_program}")
-
-            start = time.perf_counter()
 
-            test_success, instructions_ran, cycles_taken = run_test(path_program, outdir, max_cycles=max_cycles)
+    total_tests = len(tests_array)
+    tests = []
+    for i, line in enumerate(tests_array):
+        line = line.strip().split("#")[0]
 
-            if instructions_ran > 0:
-                cpi = float(cycles_taken) / float(instructions_ran)
-            else:
-                cpi = 0
+        if line == "":
+            continue
 
-            if not test_success:
-                failing_tests.append((path_program.name, cpi))
-                error("Test Failed.")
-            else:
-                successful_tests.append((path_program.name, cpi))
-                success("Test Succeded!")
+        tests.append((i, Path(line)))
 
-            print(f"Instructions ran: {instructions_ran}, Cycles Taken: {cycles_taken}")
-            if instructions_ran > 0:
-                print(f"Clocks per instruction: {cpi:.2f}")
+    def add_result(result):
+        name, test_success, cpi, timing_estimate, counters = result
 
-
-            end = time.perf_counter()
-
-            print(f"Done! Took {(end - start):.2f} s.")
-            print()
+        if not test_success:
+            failing_tests.append((name, cpi))
+        else:
+            successful_tests.append((name, cpi))
+
+        if timing_estimate is not None:
+            timing_estimates.append((name, *timing_estimate))
+
+        if test_success and counters is not None:
+            performance.append((name, cpi, counters))
+
+    if options.jobs <= 1:
+        session = VsimSession(Path(options.outdir) / "vsim" / "session") if options.use_vsim_session else None
+        try:
+            for i, path_program in tests:
+                print(f"[{i+1:03}/{total_tests:03}] Running {path_program}")
+                add_result(run_suite_test(path_program, options, vsim_session=session))
+        finally:
+            if session is not None:
+                session.close()
+    else:
+        with ProcessPoolExecutor(max_workers=options.jobs) as pool:
+            futures = [
+                pool.submit(run_suite_test_in_worker, path_program, options)
+                for _, path_program in tests
+            ]
+
+            for (i, path_program), future in zip(tests, futures):
+                try:
+                    output, result = future.result()
+                except Exception:
+                    output, result = traceback.format_exc(), None
+
+                print(f"[{i+1:03}/{total_tests:03}] Running {path_program}")
+                print(output, end="", flush=True)
+                if result is None:
+                    # The worker failed outside of the test, like setting up
+                    # its work directory or its vsim session
+                    error("Test Failed.")
+                    print()
+                    result = (path_program.name, False, 0, None, None)
+                add_result(result)
 
     time_end_tests = time.perf_counter()
     elapsed = time_end_tests - time_start_tests
@@ -157,9 +317,36 @@ def run_test_suite(tests_file_path, outdir, max_cycles=30_000):
         for test, cpi in failing_tests:
             error(f" {test} (CLocks per instruction = {cpi:.2f})")
 
+    if len(performance) > 0:
+        print_performance_table(performance)
+
+    if len(timing_estimates) > 0:
+        print("\n### TIMING MODEL ERROR ###")
+        print(f"{'Test':<32} {'Simulated':>10} {'Estimated':>10} {'Error':>9}")
+        for test, cycles_taken, estimated_cycles, timing_error in timing_estimates:
+            print(f"{test:<32} {cycles_taken:>10} {estimated_cycles:>10} {timing_error:>+8.2f}%")
+
+        mean_error = sum(abs(e[3]) for e in timing_estimates) / len(timing_estimates)
+        print(f"Mean absolute error: {mean_error:.2f} %")
+
+# Prints where the cycles of every test went, from the performance counters of
+# the cpu: the miss rates of the caches, the BTB mispredictions and the stall
+# cycles by cause, so that a change in CPI can be traced back to its cause
+def print_performance_table(performance):
+    print("\n### PERFORMANCE COUNTERS ###")
+    print(
+        f"{'Test':<32} {'CPI':>6} {'I$ miss':>8} {'D$ miss':>8} {'BTB miss':>9}"
+        f" {'D$ stall':>9} {'I$ stall':>9} {'Load':>7} {'Mcycle':>7} {'Bus wait':>9}"
+    )
+    for test, cpi, counters in performance:
+        print(
+            f"{test:<32} {cpi:>6.2f} {counters.icache_miss_rate() * 100:>7.2f}% {counters.dcache_miss_rate() * 100:>7.2f}%"
+            f" {counters.btb_mispredictions:>9} {counters.dcache_stall_cycles:>9} {counters.icache_stall_cycles:>9}"
+            f" {counters.load_stall_cycles:>7} {counters.multicycle_stall_cycles:>7} {counters.bus_wait_cycles:>9}"
+        )
 
-
-# Returns (success: bool, reason_for_failure: string | None)
+# Returns (success, instructions_ran, cycles_taken, counters), where counters
+# are the performance counters of the cpu simulation, or None
 def run_program(
         program_source,
         outdir="./build",
@@ -171,7 +358,23 @@ def run_program(
         echo_variables=False,
         quiet=False,
         verbose=False,
-        cpu_config=None
+        cpu_config=None,
+        emulator_backend="interpreter",
+        should_trace=True,
+        trace_format="text",
+        stream_trace=False,
+        checkpoint_at=None,
+        resume_from=None,
+        timing=None,
+        work_dir=None,
+        use_asm_cache=True,
+        assembler=DEFAULT_ASSEMBLER,
+        vsim_session=None,
+        watchdog_cycles=DEFAULT_WATCHDOG_CYCLES,
+        state_hash_interval=0,
+        log_pipeline=False,
+        should_profile=False,
+        should_profile_memory=False
     ):
 
     if cpu_config is None:
@@ -188,10 +391,25 @@ def run_program(
     path_symbols = path_outdir / f"{progname}.sym"
     path_sim_trace = path_outdir / f"simulator.trace"
     path_emu_trace = path_outdir / f"emulator.trace"
+    path_listing = path_outdir / f"{progname}.list"
+    path_pipeline_log = path_outdir / "pipeline.log"
+    path_konata = path_outdir / "pipeline.kanata"
+    path_profile_listing = path_outdir / f"{progname}.profile.list"
+    path_collapsed_stacks = path_outdir / f"{progname}.folded"
+    path_memory_csv = path_outdir / f"{progname}.memory.csv"
+    path_memory_heatmap = path_outdir / f"{progname}.memory.png"
+
+    # Checkpoints are saved outside of the program's folder, so that they
+    # don't get removed when running the program again
+    path_checkpoint = Path(outdir) / f"{progname}_{checkpoint_at}.checkpoint"
 
     if not path_asm_source.exists():
         error(f"ERROR: {path_asm_source} does not exist")
-        return False, 0, 0
+        return False, 0, 0, None
+
+    if resume_from is not None and not Path(resume_from).exists():
+        error(f"ERROR: {resume_from} does not exist")
+        return False, 0, 0, None
 
     # Remove outdir if it exists, makes sure that no previous result is used
     if path_outdir.exists():
@@ -199,7 +417,13 @@ def run_program(
 
     path_outdir.mkdir(parents=True, exist_ok=True)
 
-    assemble(path_asm_source, path_outdir, quiet=quiet)
+    asm_cache = None
+    if use_asm_cache:
+        assembler_path = ASSEMBLER_PATH if assembler == "perl" else dlx_assembler.__file__
+        asm_cache = AssemblyCache(Path(outdir) / "asm_cache", assembler_path)
+
+    program = assemble(path_asm_source, path_outdir, quiet=quiet, cache=asm_cache, assembler=assembler)
+    symbols = program.symbols if program is not None else load_symbols(path_symbols)
 
     emulator_success = True
     emu_instructions_ran = 0
@@ -211,53 +435,149 @@ def run_program(
         else:
             print("Emulating...")
 
+        trace_sink = None
+        if should_trace and stream_trace:
+            trace_sink = make_trace_sink(path_emu_trace, trace_format)
+
+        profile = Profile() if should_profile else None
+
+        access_profile = None
+        if should_profile_memory:
+            access_profile = make_memory_profile(cpu_config.dcache.line_size, path_listing, path_dumpfile_mem_init)
+
         emulator_success, emu_instructions_ran, emulator_trace = emulator.emulate(
             progfile=path_dumpfile_mem_init,
+            program=program.words() if program is not None else None,
             starting_pc=start_address,
             max_cycles=max_cycles,
             dumpfile=path_dumpfile_emu,
-            verbose=verbose)
+            verbose=verbose,
+            backend=emulator_backend,
+            keep_trace=should_trace,
+            trace_sink=trace_sink,
+            checkpoint_at=checkpoint_at,
+            checkpoint_path=path_checkpoint,
+            resume_from=resume_from,
+            timing=timing,
+            profile=profile,
+            memory_profile=access_profile)
+
+        if checkpoint_at is not None and path_checkpoint.exists() and not quiet:
+            print(f"Checkpoint at instruction {checkpoint_at} saved to {path_checkpoint}")
 
         if not emulator_success:
             error("Emulator failure")
-            return False, 0, 0
-        else:
-            write_trace_to_file(emulator_trace, path_emu_trace)
+            if trace_sink is not None:
+                warn(f"The partial emulator trace was saved to {trace_sink.path}")
+            return False, 0, 0, None
+        elif should_trace and not stream_trace:
+            save_trace(emulator_trace, path_emu_trace, trace_format)
+
+        if profile is not None and profile.total() > 0:
+            listing = ProgramListing.load(path_listing)
+            profile.write_annotated_listing(path_listing, path_profile_listing, listing)
+            profile.write_collapsed_stacks(path_collapsed_stacks, listing)
+            if not quiet:
+                print("### PROFILE ###\n")
+                profile.print_report(listing)
+                print()
+                print(f"Annotated listing saved to {path_profile_listing}")
+                print(f"Call stacks saved to {path_collapsed_stacks}")
+                print()
+
+        if access_profile is not None:
+            print_memory_profile(access_profile, path_memory_csv, path_memory_heatmap)
+
+        if timing is not None and not quiet:
+            print("### TIMING ESTIMATE ###\n")
+            timing.print_report()
+            print()
 
         if not should_simulate and echo_variables:
             print("### ECHOING EMULATOR VARIABLES ###\n")
-            print_variables_from_dump(path_symbols, path_dumpfile_emu)
+            print_variables_from_dump(symbols, path_dumpfile_emu)
 
     simulator_success = True
     sim_instructions_ran = 0
     simulator_trace = []
     cycles_taken = 0
+    counters = None
 
     if should_simulate:
         if not quiet:
             print("### SIMULATING ###\n")
         else:
             print("Simulating...")
-        simulator_success, sim_instructions_ran, simulator_trace, cycles_taken = simulator.simulate_cpu(
-            mem_init=path_dumpfile_mem_init,
-            dumpfile=path_dumpfile_cpu,
-            max_cycles=max_cycles,
-            start_addr=start_address,
-            outdir=path_outdir,
-            quiet=quiet,
-            show_vsim_output=verbose,
-            cpu_config=cpu_config
+        # The emulator trace, if there's one, is checked while the simulation
+        # runs, so that it stops at the first difference
+        reference = None
+        if isinstance(emulator_trace, EmulatorTrace):
+            state_hashes = None
+            if state_hash_interval > 0 and emulator_trace.first_index != 0:
+                warn("The state hashes can't be checked when the emulator resumes from a checkpoint")
+            elif state_hash_interval > 0:
+                state_hashes = state_hash.StateHashes(state_hash.WriteStream(emulator_trace), state_hash_interval)
+            reference = simulator.ReferenceTrace(emulator_trace, watchdog_cycles, state_hashes)
+        elif state_hash_interval > 0:
+            warn("The state hashes need the emulator trace, they won't be checked")
+
+        def simulate(reference, quiet=quiet, pipeline_log=None):
+            if vsim_session is not None:
+                return vsim_session.simulate_cpu(
+                    mem_init=path_dumpfile_mem_init,
+                    dumpfile=path_dumpfile_cpu,
+                    max_cycles=max_cycles,
+                    quiet=quiet,
+                    cpu_config=cpu_config,
+                    reference=reference
+                )
+
+            return simulator.simulate_cpu(
+                mem_init=path_dumpfile_mem_init,
+                dumpfile=path_dumpfile_cpu,
+                max_cycles=max_cycles,
+                start_addr=start_address,
+                outdir=path_outdir,
+                quiet=quiet,
+                show_vsim_output=verbose,
+                cpu_config=cpu_config,
+                work_dir=work_dir,
+                reference=reference,
+                pipeline_log=pipeline_log
+            )
+
+        simulator_success, sim_instructions_ran, simulator_trace, cycles_taken, counters = simulate(
+            reference, pipeline_log=path_pipeline_log if log_pipeline else None
         )
 
+        # The pipeline log is converted even if the simulation failed, since
+        # that's when it's most useful
+        if log_pipeline and path_pipeline_log.exists():
+            if not quiet:
+                print("### PIPELINE ###\n")
+            pipeline_log.process_pipeline_log(path_pipeline_log, path_konata, ProgramListing.load(path_listing), quiet=quiet)
+        elif log_pipeline:
+            warn("The cpu didn't write the pipeline log")
+
+        # If the state hashes differ, the simulation is run again with more
+        # of them, to find the first write that differs
+        if reference is not None and reference.state_hashes is not None and reference.state_hashes.mismatch is not None:
+            state_hash.bisect(
+                lambda state_hashes: simulate(
+                    simulator.ReferenceTrace(emulator_trace, watchdog_cycles, state_hashes), quiet=True
+                ),
+                reference.state_hashes
+            )
+
         if not simulator_success:
             error("Simulator failure")
-            return False, 0, 0
+            return False, 0, 0, None
         else:
-            write_trace_to_file(simulator_trace, path_sim_trace)
+            save_trace(simulator_trace, path_sim_trace, trace_format)
 
         if echo_variables:
             print("### ECHOING SIMULATOR VARIABLES ###\n")
-            print_variables_from_dump(path_symbols, path_dumpfile_cpu)
+            print_variables_from_dump(symbols, path_dumpfile_cpu)
 
     if should_emulate and should_simulate:
         check_success = True
@@ -269,27 +589,180 @@ def run_program(
         elif not quiet:
             success("Number of instructions matches between cpu and emulator!")
 
-        traces_success = compare_traces(emulator_trace, simulator_trace)
-        if traces_success and not quiet:
-            success("Traces match equal between cpu and emulator!")
+        # A streamed trace can only be read back if it's binary
+        if should_trace and stream_trace and trace_format == "binary":
+            with TraceFile(trace_sink.path) as streamed_trace:
+                traces_success = compare_traces(streamed_trace, simulator_trace)
+            if traces_success and not quiet:
+                success("Traces match equal between cpu and emulator!")
+        elif should_trace and not stream_trace:
+            traces_success = compare_traces(emulator_trace, simulator_trace)
+            if traces_success and not quiet:
+                success("Traces match equal between cpu and emulator!")
+        else:
+            traces_success = True
+            if not quiet:
+                warn("Emulator trace not available, traces were not compared.")
 
         dumps_success = compare_dumps(path_dumpfile_emu, path_dumpfile_cpu)
         if dumps_success and not quiet:
             success("Memories are equal between cpu and emulator!")
 
         if not check_success or not traces_success or not dumps_success:
-            return False, 0, 0
+            return False, 0, 0, None
 
 
     if should_check:
         if should_simulate:
             print("### CHECKING CPU ###\n")
-            checker.check(path_asm_source, path_dumpfile_cpu, path_symbols)
+            checker.check(path_asm_source, path_dumpfile_cpu, symbols)
         elif should_emulate:
             print("### CHECKING EMULATOR ###\n")
-            checker.check(path_asm_source, path_dumpfile_emu, path_symbols)
+            checker.check(path_asm_source, path_dumpfile_emu, symbols)
+
+    return True, sim_instructions_ran, cycles_taken, counters
+
+# Returns an empty MemoryAccessProfile for the data symbols of the program, or
+# None if NumPy isn't installed
+def make_memory_profile(line_size, path_listing, path_mem_init):
+    try:
+        import memory_profile
+    except ImportError:
+        warn("The memory profile needs NumPy, it won't be recorded")
+        return None
+
+    listing = ProgramListing.load(path_listing)
+    image_end = len(emulator.hexfile_to_memory(path_mem_init)) * 4
+    symbols = memory_profile.data_symbols(listing, image_end)
+    return memory_profile.MemoryAccessProfile(symbols, line_size)
+
+# Prints the loads and stores counted for every data symbol of the program,
+# and saves the ones of every word as CSV and, with matplotlib, as a heatmap
+def print_memory_profile(accesses, path_csv, path_heatmap):
+    print("### MEMORY PROFILE ###\n")
+    accesses.print_report()
+    print()
+
+    if len(accesses.words) == 0:
+        return
+
+    accesses.write_csv(path_csv)
+    print(f"Accesses of every word saved to {path_csv}")
+    if accesses.write_heatmap(path_heatmap):
+        print(f"Heatmap saved to {path_heatmap}")
+    else:
+        warn("The heatmap needs matplotlib, it wasn't saved")
+    print()
 
-    return True, sim_instructions_ran, cycles_taken
+# Emulates the program while recording its fetch and data addresses, and
+# writes the hit rates of every cache geometry for both streams.
+def run_cache_sweep(program_source, outdir, start_address, max_cycles, table_format, output_path):
+    try:
+        import cache_sweep
+    except ImportError:
+        error("ERROR: The cache sweep needs NumPy")
+        return False
+
+    recorder = cache_sweep.AccessRecorder()
+
+    emulator_success, _, _, _ = run_program(
+        program_source,
+        outdir,
+        start_address=start_address,
+        max_cycles=max_cycles,
+        should_emulate=True,
+        quiet=True,
+        should_trace=False,
+        timing=PipelineTimingModel(memory=recorder),
+        assembler="python"
+    )
+
+    if not emulator_success:
+        return False
+
+    rows = cache_sweep.sweep(recorder)
+    cache_sweep.write_table(rows, table_format, output_path)
+
+    if output_path is not None:
+        print(f"Saved {len(rows)} cache configurations to {output_path}")
+
+    return True
+
+# Emulates the program while recording its branches and jumps, and replays them
+# on a BTB of every width between min_width and max_width.
+def run_btb_sweep(program_source, outdir, start_address, max_cycles, min_width, max_width):
+    recorder = BranchRecorder(BTBModel())
+    timing = PipelineTimingModel(predictor=recorder)
+
+    emulator_success, _, _, _ = run_program(
+        program_source,
+        outdir,
+        start_address=start_address,
+        max_cycles=max_cycles,
+        should_emulate=True,
+        quiet=True,
+        should_trace=False,
+        timing=timing,
+        assembler="python"
+    )
+
+    if not emulator_success:
+        return False
+
+    print(f"Instructions ran: {timing.instructions}, branches: {timing.branches} ({timing.taken_branches} taken)")
+    print_btb_table(sweep_btb(recorder, timing, range(min_width, max_width + 1)))
+
+    return True
+
+# Binary traces get saved as <path>.bin
+def save_trace(trace, path, trace_format):
+    if trace_format == "binary":
+        write_binary_trace(trace, path.with_name(path.name + ".bin"))
+    else:
+        write_trace_to_file(trace, path)
+
+# Returns the sink to stream a trace to the same file save_trace would write
+def make_trace_sink(path, trace_format):
+    if trace_format == "binary":
+        return BinaryTraceSink(path.with_name(path.name + ".bin"))
+    else:
+        return TextTraceSink(path)
+
+# Converts a binary trace to the text format, optionally only the instructions
+# between start and stop, or with the pc between min_pc and max_pc
+def convert_trace(trace_path, output_path, start=None, stop=None, min_pc=None, max_pc=None):
+    if not Path(trace_path).exists():
+        error(f"ERROR: {trace_path} does not exist")
+        return False
+
+    try:
+        trace = TraceFile(trace_path)
+    except ValueError as e:
+        error(f"ERROR: {e}")
+        return False
+
+    with trace:
+        first = trace.position_of(start) if start is not None else 0
+        last = trace.position_of(stop) if stop is not None else len(trace)
+        instructions = trace.iter_range(first, last)
+
+        if min_pc is not None or max_pc is not None:
+            if not trace.has_pc:
+                error(f"ERROR: {trace_path} has no pcs")
+                return False
+
+            instructions = trace.iter_pc_range(
+                min_pc if min_pc is not None else 0,
+                max_pc if max_pc is not None else 0xFFFF_FFFF,
+                first,
+                last)
+
+        if output_path is None:
+            write_trace(instructions, sys.stdout)
+        else:
+            write_trace_to_file(instructions, output_path)
+
+    return True
 
 def compare_traces(emu_trace, sim_trace):
     check_success = True
@@ -297,19 +770,24 @@ def compare_traces(emu_trace, sim_trace):
     different_traces = []
 
     # NOTE: This should not count the final lhi and sw
-    for emu_instr in emu_trace[:-2]:
-        if len(sim_trace) <= emu_instr.instruction_index:
+    last = len(emu_trace) - 2
+    for i, (instruction_index, opcode, func) in enumerate(emu_trace.iter_opcodes()):
+        if i >= last:
+            break
+
+        if len(sim_trace) <= instruction_index:
             error(f"Simulator stops at instruction {len(sim_trace)}.")
             check_success = False
             break
 
-        sim_instr = sim_trace[emu_instr.instruction_index]
-        if sim_instr.opcode != emu_instr.opcode or sim_instr.func != emu_instr.func:
-            different_traces.append((emu_instr, sim_instr))
+        sim_instr = sim_trace[instruction_index]
+        if sim_instr.opcode != opcode or sim_instr.func != func:
+            different_traces.append((i, sim_instr))
 
     if len(different_traces) > 0:
         error("Traces differ between emulator and simulator. First ten differing traces:")
-        for emu_instr, sim_instr in different_traces[:10]:
+        for i, sim_instr in different_traces[:10]:
+            emu_instr = emu_trace[i]
             error(f" [{emu_instr.instruction_index}] emu: {emu_instr.get_name()} sim: {sim_instr.get_name()}")
 
         check_success = False
@@ -345,7 +823,11 @@ def compare_dumps(emu_dump_path, sim_dump_path):
     return len(errors) == 0
 
 
-def assemble(program_path, outdir, quiet=False):
+# Assembles the program in outdir with the given assembler, returning the
+# AssembledProgram when it's the in-process one, or None. If a cache is given
+# and the program was already assembled, the artifacts are taken from the
+# cache instead, and None is returned.
+def assemble(program_path, outdir, quiet=False, cache=None, assembler=DEFAULT_ASSEMBLER):
     if not quiet:
         print("### ASSEMBLING ###\n")
     else:
@@ -353,6 +835,43 @@ def assemble(program_path, outdir, quiet=False):
 
     progname = program_path.stem
 
+    if cache is not None:
+        cache_key = cache.key(program_path)
+        output = cache.restore(cache_key, outdir)
+        if output is not None:
+            if not quiet:
+                print(f"Using the cached assembly of {program_path}")
+            print(output, end="")
+            return None
+
+    if assembler == "python":
+        try:
+            program = dlx_assembler.assemble_file(program_path)
+        except dlx_assembler.AssemblerError as e:
+            error(e)
+            error("ERROR: Assembler failed, exiting")
+            exit(-1)
+
+        for warning in program.warnings:
+            warn(warning)
+        print(program.output, end="")
+
+        program.save(outdir, progname)
+        output = program.output
+    else:
+        program = None
+        output = assemble_with_perl(program_path, outdir)
+
+    if cache is not None:
+        artifacts = [outdir / f"{progname}{suffix}" for suffix in (".bin", ".bin.hdr", ".list", ".sym", ".mem")]
+        cache.store(cache_key, [artifact for artifact in artifacts if artifact.exists()], output)
+
+    return program
+
+# Runs dlxasm.pl, and writes the .mem file from its .bin. Returns its output.
+def assemble_with_perl(program_path, outdir):
+    progname = program_path.stem
+
     assembler_args = [
         "perl", ASSEMBLER_PATH,
         "-o", outdir / Path(f"{progname}.bin"),
@@ -362,21 +881,22 @@ def assemble(program_path, outdir, quiet=False):
 
     ]
 
-    result = subprocess.run(assembler_args)
+    # The output goes through print, so that it can be captured along with the
+    # rest when running in a worker
+    result = subprocess.run(assembler_args, stdout=subprocess.PIPE, universal_newlines=True)
+    print(result.stdout, end="")
 
     if result.returncode != 0:
         error("ERROR: Assembler failed, exiting")
         exit(-1)
 
     with open(outdir / f"{progname}.bin", "rb") as outfile:
-        program_output = list(outfile.read())
+        words = dlx_assembler.binary_to_words(outfile.read())
 
     with open(outdir / f"{progname}.mem", "w") as dumpfile:
-        for i in range(len(program_output)//4):
-            word = 0
-            for j in range(4):
-                word += program_output[i * 4 + j] << ((3-j) * 8)
-            dumpfile.write(f"{word:08X}\n")
+        dumpfile.write(dlx_assembler.mem_text(words))
+
+    return result.stdout
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -388,6 +908,10 @@ def parse_args():
     gui_parser = subparsers.add_parser("gui")
     single_parser = subparsers.add_parser("single")
     all_parser = subparsers.add_parser("all")
+    trace_parser = subparsers.add_parser("trace")
+    pipeline_parser = subparsers.add_parser("pipeline")
+    cache_sweep_parser = subparsers.add_parser("cache-sweep")
+    btb_sweep_parser = subparsers.add_parser("btb-sweep")
 
     gui_parser.add_argument("program_source")
 
@@ -410,6 +934,45 @@ def parse_args():
     single_parser.add_argument("-v", "--verbose", action="store_true",
                         help="run the emulator in verbose mode")
 
+    single_parser.add_argument("-b", "--backend", choices=emulator.EMULATOR_BACKENDS.keys(), default="interpreter",
+                        help="the emulator backend to use")
+
+    single_parser.add_argument("-n", "--no-trace", action="store_true",
+                        help="don't record the emulator trace")
+
+    single_parser.add_argument("-f", "--trace-format", choices=["text", "binary"], default="text",
+                        help="the format of the saved traces")
+
+    single_parser.add_argument("--stream", action="store_true",
+                        help="write the emulator trace while the emulation runs, instead of at the end")
+
+    single_parser.add_argument("--checkpoint-at", type=int, default=None,
+                        help="save a checkpoint of the emulator after this many instructions")
+
+    single_parser.add_argument("--resume-from", type=str, default=None,
+                        help="start the emulator from this checkpoint")
+
+    single_parser.add_argument("--profile", action="store_true",
+                        help="count how many times the emulator runs every instruction, and print the hot spots by function, label, opcode and basic block")
+
+    single_parser.add_argument("--memory-profile", action="store_true",
+                        help="count the loads and stores of the emulator for every word, data cache line and data symbol, and save them as CSV and as a heatmap (needs NumPy, and matplotlib for the heatmap)")
+
+    single_parser.add_argument("--timing", action="store_true",
+                        help="estimate the cycles the cpu would take with the pipeline timing model")
+
+    single_parser.add_argument("--caches", action="store_true",
+                        help="also model the caches and the bus in the timing model (implies --timing)")
+
+    single_parser.add_argument("--btb-width", type=int, default=DEFAULT_BTB_LINES_WIDTH,
+                        help="the BTB_LINES_WIDTH of the BTB in the timing model")
+
+    single_parser.add_argument("--icache", type=parse_cache_size, default=None, metavar="SETS,WAYS,LINE_SIZE",
+                        help="the instruction cache size, for both the cache model and the cpu simulation")
+
+    single_parser.add_argument("--dcache", type=parse_cache_size, default=None, metavar="SETS,WAYS,LINE_SIZE",
+                        help="the data cache size, for both the cache model and the cpu simulation")
+
     single_parser.add_argument("-s", "--cpu-sim", action="store_true",
                         help="run the modelsim cpu simulation")
 
@@ -428,6 +991,21 @@ def parse_args():
     single_parser.add_argument("-m", "--max-cycles", type=int, default=30_000,
                         help="the maximum cycles to run before stopping")
 
+    single_parser.add_argument("--no-asm-cache", action="store_true",
+                        help="always run the assembler, instead of reusing the programs assembled before")
+
+    single_parser.add_argument("--assembler", choices=ASSEMBLERS, default=DEFAULT_ASSEMBLER,
+                        help="the assembler to use, the in-process one or dlxasm.pl")
+
+    single_parser.add_argument("--watchdog-cycles", type=int, default=DEFAULT_WATCHDOG_CYCLES,
+                        help="stop the cpu simulation if it retires no instructions for this many cycles before the emulator's end (0 to disable)")
+
+    single_parser.add_argument("--state-hash", type=int, default=0, metavar="INTERVAL",
+                        help="check a hash of the cpu's register and memory writes against the emulator every INTERVAL writes, and find the first write that differs (0 to disable)")
+
+    single_parser.add_argument("--pipeline", action="store_true",
+                        help="log the stages of the cpu pipeline every cycle, and save them as a Kanata file to view with Konata")
+
     single_parser.set_defaults(func=single_simulation)
 
     all_parser.add_argument("-t", "--tests-file-path", type=str, default="tests.list",
@@ -439,8 +1017,99 @@ def parse_args():
     all_parser.add_argument("-m", "--max-cycles", type=int, default=200_000,
                         help="the maximum cycles to run before stopping")
 
+    all_parser.add_argument("-b", "--backend", choices=emulator.EMULATOR_BACKENDS.keys(), default="interpreter",
+                        help="the emulator backend to use")
+
+    all_parser.add_argument("--timing", action="store_true",
+                        help="compare the cycles estimated by the pipeline timing model with the simulated ones")
+
+    all_parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="the number of tests to run in parallel")
+
+    all_parser.add_argument("--no-asm-cache", action="store_true",
+                        help="always run the assembler, instead of reusing the programs assembled before")
+
+    all_parser.add_argument("--assembler", choices=ASSEMBLERS, default=DEFAULT_ASSEMBLER,
+                        help="the assembler to use, the in-process one or dlxasm.pl")
+
+    all_parser.add_argument("--vsim-session", action="store_true",
+                        help="simulate all tests in the same vsim process, instead of starting vsim for each of them")
+
+    all_parser.add_argument("--watchdog-cycles", type=int, default=DEFAULT_WATCHDOG_CYCLES,
+                        help="stop the cpu simulation if it retires no instructions for this many cycles before the emulator's end (0 to disable)")
+
     all_parser.set_defaults(func=all_simulation)
 
+    trace_parser.add_argument("trace_file")
+
+    trace_parser.add_argument("-o", "--output", type=str, default=None,
+                        help="the file where to save the text trace, instead of printing it")
+
+    trace_parser.add_argument("--start", type=int, default=None,
+                        help="the index of the first instruction to convert")
+
+    trace_parser.add_argument("--stop", type=int, default=None,
+                        help="the index of the instruction where to stop converting (excluded)")
+
+    trace_parser.add_argument("--min-pc", type=lambda x: int(x, 0), default=None,
+                        help="only convert the instructions with a pc greater or equal than this")
+
+    trace_parser.add_argument("--max-pc", type=lambda x: int(x, 0), default=None,
+                        help="only convert the instructions with a pc lower or equal than this")
+
+    trace_parser.set_defaults(func=trace_conversion)
+
+    pipeline_parser.add_argument("pipeline_log")
+
+    pipeline_parser.add_argument("-l", "--listing", type=str, default=None,
+                        help="the .list file of the program, to show the source of every instruction")
+
+    pipeline_parser.add_argument("-o", "--output", type=str, default=None,
+                        help="the Kanata file to write (default: the log with the .kanata extension)")
+
+    pipeline_parser.add_argument("-n", "--top", type=int, default=20,
+                        help="how many of the instructions that lost the most cycles to show")
+
+    pipeline_parser.set_defaults(func=pipeline_conversion)
+
+    cache_sweep_parser.add_argument("program_source")
+
+    cache_sweep_parser.add_argument("-o", "--outdir", type=str, default="build",
+                        help="the folder where to save the output")
+
+    cache_sweep_parser.add_argument("-a", "--start-address", type=int, default=0,
+                        help="the address where to start loading instructions")
+
+    cache_sweep_parser.add_argument("-m", "--max-cycles", type=int, default=30_000,
+                        help="the maximum cycles to run before stopping")
+
+    cache_sweep_parser.add_argument("-f", "--format", choices=["markdown", "csv"], default="markdown",
+                        help="the format of the table")
+
+    cache_sweep_parser.add_argument("--output", type=str, default=None,
+                        help="the file where to save the table, instead of printing it")
+
+    cache_sweep_parser.set_defaults(func=cache_sweep_simulation)
+
+    btb_sweep_parser.add_argument("program_source")
+
+    btb_sweep_parser.add_argument("-o", "--outdir", type=str, default="build",
+                        help="the folder where to save the output")
+
+    btb_sweep_parser.add_argument("-a", "--start-address", type=int, default=0,
+                        help="the address where to start loading instructions")
+
+    btb_sweep_parser.add_argument("-m", "--max-cycles", type=int, default=30_000,
+                        help="the maximum cycles to run before stopping")
+
+    btb_sweep_parser.add_argument("--min-width", type=int, default=1,
+                        help="the smallest BTB_LINES_WIDTH to try, at least 1")
+
+    btb_sweep_parser.add_argument("--max-width", type=int, default=8,
+                        help="the largest BTB_LINES_WIDTH to try")
+
+    btb_sweep_parser.set_defaults(func=btb_sweep_simulation)
+
     return parser.parse_args()
 
 def gui_simulation(args):
@@ -451,7 +1120,31 @@ def gui_simulation(args):
         max_cycles=args.max_cycles,
     )
 
+# Parses a cache size given as sets,ways,line_size
+def parse_cache_size(text):
+    try:
+        sets, ways, line_size = (int(x) for x in text.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid cache size {text}, expected sets,ways,line_size")
+
+    for value in (sets, ways, line_size):
+        if value <= 0 or value & (value - 1) != 0:
+            raise argparse.ArgumentTypeError(f"invalid cache size {text}, all values must be powers of two")
+
+    return CacheSize(sets=sets, ways=ways, line_size=line_size)
+
 def single_simulation(args):
+    cpu_config = CpuSimulationConfig.default()
+    if args.icache is not None:
+        cpu_config.icache = args.icache
+    if args.dcache is not None:
+        cpu_config.dcache = args.dcache
+
+    timing = None
+    if args.timing or args.caches:
+        memory = MemorySystemModel(cpu_config) if args.caches else None
+        timing = PipelineTimingModel(predictor=BTBModel(args.btb_width), memory=memory)
+
     run_program(
         program_source=args.program_source,
         outdir=args.outdir,
@@ -461,16 +1154,83 @@ def single_simulation(args):
         should_simulate=args.cpu_sim,
         should_check=args.check,
         echo_variables=args.print_variables,
-        verbose=args.verbose
+        verbose=args.verbose,
+        emulator_backend=args.backend,
+        should_trace=not args.no_trace,
+        trace_format=args.trace_format,
+        stream_trace=args.stream,
+        checkpoint_at=args.checkpoint_at,
+        resume_from=args.resume_from,
+        cpu_config=cpu_config,
+        timing=timing,
+        use_asm_cache=not args.no_asm_cache,
+        assembler=args.assembler,
+        watchdog_cycles=args.watchdog_cycles,
+        state_hash_interval=args.state_hash,
+        log_pipeline=args.pipeline,
+        should_profile=args.profile,
+        should_profile_memory=args.memory_profile
     )
 
 def all_simulation(args):
-    run_test_suite(
-        tests_file_path=args.tests_file_path,
+    options = SuiteOptions(
+        outdir=args.outdir,
+        max_cycles=args.max_cycles,
+        emulator_backend=args.backend,
+        estimate_timing=args.timing,
+        jobs=args.jobs,
+        use_asm_cache=not args.no_asm_cache,
+        assembler=args.assembler,
+        use_vsim_session=args.vsim_session,
+        watchdog_cycles=args.watchdog_cycles
+    )
+    run_test_suite(args.tests_file_path, options)
+
+def cache_sweep_simulation(args):
+    run_cache_sweep(
+        program_source=args.program_source,
+        outdir=args.outdir,
+        start_address=args.start_address,
+        max_cycles=args.max_cycles,
+        table_format=args.format,
+        output_path=args.output
+    )
+
+def btb_sweep_simulation(args):
+    # A BTB_LINES_WIDTH of 0 would leave the BTB without an index
+    if args.min_width < 1 or args.max_width < args.min_width:
+        error(f"ERROR: Invalid BTB width range {args.min_width}..{args.max_width}")
+        return
+
+    run_btb_sweep(
+        program_source=args.program_source,
         outdir=args.outdir,
-        max_cycles=args.max_cycles
+        start_address=args.start_address,
+        max_cycles=args.max_cycles,
+        min_width=args.min_width,
+        max_width=args.max_width
     )
 
+def trace_conversion(args):
+    convert_trace(
+        trace_path=args.trace_file,
+        output_path=args.output,
+        start=args.start,
+        stop=args.stop,
+        min_pc=args.min_pc,
+        max_pc=args.max_pc
+    )
+
+def pipeline_conversion(args):
+    path_log = Path(args.pipeline_log)
+    if not path_log.exists():
+        error(f"ERROR: {path_log} does not exist")
+        return
+
+    listing = ProgramListing.load(args.listing) if args.listing is not None else None
+    output = args.output if args.output is not None else path_log.with_suffix(".kanata")
+    pipeline_log.process_pipeline_log(path_log, output, listing, top=args.top)
+
 def main():
     args = parse_args()
 
@@ -0,0 +1,93 @@
+import re
+
+from bisect import bisect_right
+
+# A line of the .list file that has an address: line number, address, contents
+# (up to a word, in hex) and source line
+LINE_RE = re.compile(r"^\s*(\d+)  ([0-9a-fA-F]{8})  ([0-9a-fA-F ]{0,8})\t(.*)$")
+LABEL_RE = re.compile(r"^([a-zA-Z0-9_]+):")
+
+# The .list file written by the assembler, which tells the source line of every
+# instruction and which labels are in the text section and which in the data
+# section, something the .sym file doesn't.
+class ProgramListing:
+    def __init__(self):
+        # address -> (line number, source) of every instruction
+        self.instructions = {}
+
+        # (address, name) of the labels of each section, sorted by address. A
+        # name can show up more than once, since the assembler allows it.
+        self.text_labels = []
+        self.data_labels = []
+        self.text_label_addresses = []
+
+        # The source of every line of the program, by line number
+        self.source_lines = {}
+
+    @staticmethod
+    def load(path):
+        listing = ProgramListing()
+        section = "t"
+
+        with open(path, "r", encoding="latin-1") as infile:
+            # The first line is the header
+            next(infile, None)
+
+            for line in infile:
+                line = line.rstrip("\r\n")
+                match = LINE_RE.match(line)
+                if match is None:
+                    # Comments and empty lines only have the line number
+                    fields = line.split(None, 1)
+                    if len(fields) > 0 and fields[0].isdigit():
+                        listing.source_lines[int(fields[0])] = fields[1] if len(fields) > 1 else ""
+                    continue
+
+                lineno = int(match.group(1))
+                address = int(match.group(2), 16)
+                contents = match.group(3).strip()
+                source = match.group(4)
+
+                # Data longer than a word goes on more lines, with no source
+                if source == "" and lineno in listing.source_lines:
+                    continue
+                listing.source_lines[lineno] = source
+
+                directive = re.match(r"^\.(text|data)", source)
+                label = LABEL_RE.match(source)
+                if directive is not None:
+                    section = directive.group(1)[0]
+                elif label is not None:
+                    labels = listing.text_labels if section == "t" else listing.data_labels
+                    labels.append((address, label.group(1)))
+                elif section == "t" and len(contents) == 8:
+                    listing.instructions[address] = (lineno, source)
+
+        listing.text_labels.sort()
+        listing.data_labels.sort()
+        listing.text_label_addresses = [address for address, _ in listing.text_labels]
+        return listing
+
+    def source_at(self, pc):
+        return self.instructions.get(pc, (None, ""))[1]
+
+    def line_at(self, pc):
+        return self.instructions.get(pc, (None, ""))[0]
+
+    # Returns (label, offset) for the last text label at or before pc, or
+    # (None, pc) if there's none
+    def label_at(self, pc):
+        i = bisect_right(self.text_label_addresses, pc)
+        if i == 0:
+            return None, pc
+        address, name = self.text_labels[i - 1]
+        return name, pc - address
+
+    # The pc as label+offset, like "fact_loop+0x4"
+    def describe(self, pc):
+        name, offset = self.label_at(pc)
+        if name is None:
+            return f"0x{pc:08X}"
+        if offset == 0:
+            return name
+        return f"{name}+0x{offset:X}"
@@ -0,0 +1,271 @@
+import csv
+
+import numpy as np
+
+from cache_sweep import LINE_SIZES
+from dlx_emu_bus import MASK, WRITE_FLAG
+
+# Accesses at or above this address are the writes that end the program
+TERMINATION_ADDRESS = 0xFFFF0000
+
+# How many strides to show for every symbol, and how many symbols to show
+TOP_STRIDES = 3
+TOP_SYMBOLS = 20
+
+OTHER_SYMBOL = "(other)"
+
+# The data symbols of the listing as (name, start, end), each one going up to
+# the next one, and the last one up to the end of the memory image. Of the
+# labels at the same address (like data_start and the first array), the last
+# one is kept.
+def data_symbols(listing, image_end):
+    symbols = []
+    labels = listing.data_labels
+    for i, (address, name) in enumerate(labels):
+        end = labels[i + 1][0] if i + 1 < len(labels) else max(image_end, address + 4)
+        if end > address:
+            symbols.append((name, address, end))
+    return symbols
+
+def percentage(part, total):
+    return part / total * 100 if total > 0 else 0.0
+
+# Returns the distinct values of keys, sorted, with the sums of the reads and
+# the writes of each
+def sum_counts(keys, reads, writes):
+    values, indexes = np.unique(keys, return_inverse=True)
+    return (
+        values,
+        np.bincount(indexes, weights=reads, minlength=len(values)).astype(np.int64),
+        np.bincount(indexes, weights=writes, minlength=len(values)).astype(np.int64),
+    )
+
+# Merges counts of keys (a tuple of arrays, one per key) into the ones of
+# new_keys, both sorted and without duplicates. Returns the merged keys and
+# counts.
+def merge_counts(keys, counts, new_keys, new_counts):
+    merged = np.union1d(keys, new_keys)
+    positions = np.searchsorted(merged, keys)
+    new_positions = np.searchsorted(merged, new_keys)
+
+    totals = []
+    for old, new in zip(counts, new_counts):
+        total = np.zeros(len(merged), dtype=np.int64)
+        total[positions] += old
+        total[new_positions] += new
+        totals.append(total)
+    return merged, tuple(totals)
+
+# The loads and stores of an emulation, as recorded by a RecordingMemoryBus,
+# counted for every data symbol, word and line of the given size (in words, as
+# in CacheSize). The accesses come in chunks, which get folded in the counts as
+# they come, so that memory only depends on the words accessed.
+#
+# The counts are NumPy arrays indexed like keys, which holds symbol << 32 |
+# word for every word accessed, sorted, since the address space is too sparse
+# to index by address directly. The accesses out of every symbol go to an
+# extra one after them. The strides of every symbol are counted from its
+# accesses in order, going on from the last one of the chunks before.
+class MemoryAccessProfile:
+    def __init__(self, symbols, line_size):
+        self.symbols = symbols
+        self.starts = np.array([start for _, start, _ in symbols], dtype=np.int64)
+        self.ends = np.array([end for _, _, end in symbols], dtype=np.int64)
+        self.other = len(symbols)
+
+        self.line_size = line_size
+        self.line_shift = line_size.bit_length() - 1
+
+        self.clear()
+
+    def clear(self):
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.key_reads = np.zeros(0, dtype=np.int64)
+        self.key_writes = np.zeros(0, dtype=np.int64)
+
+        # For every symbol, stride -> count, and the last address accessed
+        self.strides = [{} for _ in range(self.other + 1)]
+        self.last_addresses = [None] * (self.other + 1)
+
+        self.count_words()
+
+    # Folds in a chunk of accesses, an array("Q") as in RecordingMemoryBus
+    def add(self, accesses):
+        accesses = np.frombuffer(accesses, dtype=np.uint64)
+        addresses = (accesses & MASK).astype(np.int64)
+        keep = addresses < TERMINATION_ADDRESS
+
+        addresses = addresses[keep]
+        is_write = (accesses[keep] & WRITE_FLAG) != 0
+        if len(addresses) == 0:
+            return
+
+        symbols = np.full(len(addresses), self.other, dtype=np.int64)
+        if self.other > 0:
+            i = np.searchsorted(self.starts, addresses, side="right") - 1
+            inside = (i >= 0) & (addresses < self.ends[np.maximum(i, 0)])
+            symbols[inside] = i[inside]
+
+        keys, indexes = np.unique((symbols << 32) | (addresses >> 2), return_inverse=True)
+        reads = np.bincount(indexes[~is_write], minlength=len(keys))
+        writes = np.bincount(indexes[is_write], minlength=len(keys))
+        self.keys, (self.key_reads, self.key_writes) = merge_counts(
+            self.keys, (self.key_reads, self.key_writes), keys, (reads, writes)
+        )
+
+        order = np.argsort(symbols, kind="stable")
+        present, firsts = np.unique(symbols[order], return_index=True)
+        for symbol, group in zip(present.tolist(), np.split(addresses[order], firsts[1:])):
+            last = self.last_addresses[symbol]
+            distances = np.diff(group) if last is None else np.diff(group, prepend=last)
+            self.last_addresses[symbol] = int(group[-1])
+
+            strides = self.strides[symbol]
+            values, counts = np.unique(distances, return_counts=True)
+            for stride, count in zip(values.tolist(), counts.tolist()):
+                strides[stride] = strides.get(stride, 0) + count
+
+        self.count_words()
+
+    # Sums the counts of the symbols for every word, and of the words for
+    # every line
+    def count_words(self):
+        self.words, self.word_reads, self.word_writes = sum_counts(self.keys & MASK, self.key_reads, self.key_writes)
+        self.lines, self.line_reads, self.line_writes = sum_counts(self.words >> self.line_shift, self.word_reads, self.word_writes)
+
+    def reads(self):
+        return int(self.key_reads.sum())
+
+    def writes(self):
+        return int(self.key_writes.sum())
+
+    # Returns (rows, other), where rows has the counts of every symbol that
+    # was accessed, and other those of the accesses out of every symbol
+    def symbol_rows(self):
+        key_symbols = self.keys >> 32
+
+        rows = []
+        for symbol, (name, start, end) in enumerate(self.symbols):
+            mask = key_symbols == symbol
+            if mask.any():
+                rows.append(self.describe(name, start, end, symbol, mask))
+
+        other = None
+        mask = key_symbols == self.other
+        if mask.any():
+            words = self.keys[mask] & MASK
+            other = self.describe(OTHER_SYMBOL, int(words.min()) << 2, (int(words.max()) + 1) << 2, self.other, mask)
+
+        return rows, other
+
+    def describe(self, name, start, end, symbol, mask):
+        words = self.keys[mask] & MASK
+        lines = np.unique(words >> self.line_shift)
+
+        # The distance between each access to the symbol and the one before
+        strides = sorted(self.strides[symbol].items(), key=lambda item: (-item[1], item[0]))
+
+        return {
+            "name": name,
+            "start": start,
+            "size_words": (end - start + 3) // 4,
+            "reads": int(self.key_reads[mask].sum()),
+            "writes": int(self.key_writes[mask].sum()),
+            "words": len(words),
+            "lines": len(lines),
+            "strides": strides[:TOP_STRIDES],
+            "stride_total": sum(self.strides[symbol].values()),
+        }
+
+    # Returns (line_size, lines, words per line) for every line size, that is
+    # how many lines the words accessed would take, and how many of the words
+    # of each line get used
+    def line_usage(self):
+        rows = []
+        for line_size in [1] + LINE_SIZES:
+            lines = len(np.unique(self.words >> (line_size.bit_length() - 1)))
+            rows.append((line_size, lines, len(self.words) / lines if lines > 0 else 0.0))
+        return rows
+
+    def print_report(self, top=TOP_SYMBOLS):
+        reads, writes = self.reads(), self.writes()
+        total = reads + writes
+        print(f"Loads: {reads}, stores: {writes}, words accessed: {len(self.words)}, lines of {self.line_size} words: {len(self.lines)}")
+        if total == 0:
+            return
+
+        rows, other = self.symbol_rows()
+        if other is not None:
+            rows.append(other)
+
+        print()
+        print(f"{'symbol':<20} {'address':>8} {'size':>6} {'reads':>9} {'writes':>9} {'traffic':>8} {'r/w':>6} {'words':>6} {'lines':>6}  strides (bytes)")
+        rows.sort(key=lambda row: -(row["reads"] + row["writes"]))
+        for row in rows[:top]:
+            accesses = row["reads"] + row["writes"]
+            ratio = f"{row['reads'] / row['writes']:.2f}" if row["writes"] > 0 else "-"
+            strides = ", ".join(
+                f"{stride:+d} ({percentage(count, row['stride_total']):.0f}%)" for stride, count in row["strides"]
+            )
+            print(
+                f"{row['name']:<20} {row['start']:08X} {row['size_words']:>6} {row['reads']:>9} {row['writes']:>9}"
+                f" {percentage(accesses, total):>7.2f}% {ratio:>6} {row['words']:>6} {row['lines']:>6}  {strides}"
+            )
+        if len(rows) > top:
+            print(f"... and {len(rows) - top} more symbols")
+
+        print()
+        print(f"{'line size':>9} {'lines':>8} {'words used per line':>20}")
+        for line_size, lines, words_per_line in self.line_usage():
+            marker = "  <- data cache" if line_size == self.line_size else ""
+            print(f"{line_size:>9} {lines:>8} {words_per_line:>10.2f} ({percentage(words_per_line, line_size):>5.1f} %){marker}")
+
+    # Writes the reads and writes of every word accessed, with its line and
+    # symbol
+    def write_csv(self, path):
+        symbols = self.symbols
+        with open(path, "w", newline="") as outfile:
+            writer = csv.writer(outfile, lineterminator="\n")
+            writer.writerow(["address", "line", "symbol", "reads", "writes"])
+            for word, reads, writes in zip(self.words.tolist(), self.word_reads.tolist(), self.word_writes.tolist()):
+                address = word << 2
+                i = int(np.searchsorted(self.starts, address, side="right")) - 1
+                name = symbols[i][0] if i >= 0 and address < symbols[i][2] else OTHER_SYMBOL
+                writer.writerow([f"{address:08X}", f"{address >> (2 + self.line_shift) << (2 + self.line_shift):08X}", name, reads, writes])
+
+    # Saves an image with a row for every line accessed and a column for every
+    # word of the line, colored by its accesses, with the symbols on the side.
+    # Returns False if matplotlib isn't installed.
+    def write_heatmap(self, path):
+        try:
+            import matplotlib
+            matplotlib.use("Agg")
+            import matplotlib.pyplot as plt
+            from matplotlib.colors import LogNorm
+        except ImportError:
+            return False
+
+        grid = np.zeros((len(self.lines), self.line_size))
+        rows = np.searchsorted(self.lines, self.words >> self.line_shift)
+        grid[rows, self.words & (self.line_size - 1)] = self.word_reads + self.word_writes
+
+        figure, axes = plt.subplots(figsize=(8, min(2 + len(self.lines) * 0.15, 40)))
+        image = axes.imshow(np.ma.masked_equal(grid, 0), aspect="auto", interpolation="nearest", cmap="inferno", norm=LogNorm())
+        figure.colorbar(image, ax=axes, label="accesses")
+
+        ticks, labels = [], []
+        for name, start, end in self.symbols:
+            # The first line of the symbol that was accessed
+            i = int(np.searchsorted(self.lines, start >> (2 + self.line_shift)))
+            if i < len(self.lines) and int(self.lines[i]) << (2 + self.line_shift) < end:
+                ticks.append(i)
+                labels.append(f"{name} {start:08X}")
+        axes.set_yticks(ticks)
+        axes.set_yticklabels(labels)
+        axes.set_xlabel(f"word in the line ({self.line_size} words)")
+        axes.set_title("Loads and stores by data cache line")
+
+        figure.tight_layout()
+        figure.savefig(path)
+        plt.close(figure)
+        return True
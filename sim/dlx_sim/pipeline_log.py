@@ -0,0 +1,235 @@
+from collections import defaultdict
+
+from common import success
+
+# The stages as named in the Kanata log
+STAGES = ["F", "D", "X", "M", "W"]
+
+CAUSE_NAMES = {
+    "D": "data cache",
+    "I": "instruction cache",
+    "B": "mispredict",
+    "L": "load-use",
+    "M": "multicycle",
+}
+
+# The stage whose instruction a stall or flush cycle is charged to: the one
+# that missed in the cache, the mispredicted branch, or the one waiting for the
+# load or for the multicycle unit
+CAUSE_STAGES = {
+    "D": 3,
+    "I": 0,
+    "B": 3,
+    "L": 2,
+    "M": 2,
+}
+
+# A line of the pipeline log of the DLX (see PipelineLog in the datapath)
+class PipelineCycle:
+    def __init__(self, cycle, cause, flags, pcs):
+        self.cycle = cycle
+        self.cause = cause
+
+        # S (stalled), F (flushed) or . for every stage
+        self.flags = flags
+
+        # The pc in every stage, None for a bubble
+        self.pcs = pcs
+
+    @staticmethod
+    def parse(line):
+        fields = line.split()
+        pcs = [None if field == "-" else int(field, 16) for field in fields[3:8]]
+        return PipelineCycle(int(fields[0]), fields[1], fields[2], pcs)
+
+def read_pipeline_log(path):
+    with open(path, "r") as infile:
+        for line in infile:
+            if line.strip() != "":
+                yield PipelineCycle.parse(line)
+
+# An instruction going through the pipeline
+class PipelineInstruction:
+    def __init__(self, id, pc, stage, cycle):
+        self.id = id
+        self.pc = pc
+        self.stage = stage
+        self.stage_start = cycle
+
+# Follows every instruction through the pipeline, one cycle after the other.
+# An instruction stays in a stage that's stalled, and moves to the next stage
+# when it's there with the same pc in the next cycle; what's neither is
+# flushed, unless it leaves write back, which is retiring. on_event gets called
+# as on_event(kind, instruction, cycle) with kind in "fetch", "start", "end",
+# "retire" or "flush".
+class PipelineTracker:
+    def __init__(self, on_event):
+        self.on_event = on_event
+        self.slots = [None] * len(STAGES)
+        self.next_id = 0
+        self.previous = None
+
+    def new_instruction(self, pc, stage, cycle):
+        instruction = PipelineInstruction(self.next_id, pc, stage, cycle)
+        self.next_id += 1
+        self.on_event("fetch", instruction, cycle)
+        self.on_event("start", instruction, cycle)
+        return instruction
+
+    def feed(self, current):
+        previous = self.previous
+        self.previous = current
+
+        if previous is None:
+            self.slots = [
+                None if pc is None else self.new_instruction(pc, stage, current.cycle)
+                for stage, pc in enumerate(current.pcs)
+            ]
+            return
+
+        slots = [None] * len(STAGES)
+        kept = set()
+        for stage, pc in enumerate(current.pcs):
+            if pc is None:
+                continue
+
+            old = self.slots[stage]
+            if previous.flags[stage] == "S" and old is not None and old.pc == pc:
+                slots[stage] = old
+                kept.add(old.id)
+                continue
+
+            if stage > 0:
+                old = self.slots[stage - 1]
+                if old is not None and old.pc == pc and old.id not in kept:
+                    self.on_event("end", old, current.cycle)
+                    old.stage = stage
+                    old.stage_start = current.cycle
+                    self.on_event("start", old, current.cycle)
+                    slots[stage] = old
+                    kept.add(old.id)
+                    continue
+
+            slots[stage] = self.new_instruction(pc, stage, current.cycle)
+            kept.add(slots[stage].id)
+
+        for stage, old in enumerate(self.slots):
+            if old is None or old.id in kept:
+                continue
+
+            self.on_event("end", old, current.cycle)
+            if stage == len(STAGES) - 1 and previous.flags[stage] != "S":
+                self.on_event("retire", old, current.cycle)
+            else:
+                self.on_event("flush", old, current.cycle)
+
+        self.slots = slots
+
+    # Ends the instructions still in the pipeline
+    def finish(self, cycle):
+        for old in self.slots:
+            if old is not None:
+                self.on_event("end", old, cycle)
+                self.on_event("flush", old, cycle)
+        self.slots = [None] * len(STAGES)
+
+# Writes the pipeline log as a Kanata log, which Konata shows as a pipeline
+# diagram, with every instruction labeled with its pc and source line
+def write_konata(cycles, path, listing=None):
+    with open(path, "w") as outfile:
+        outfile.write("Kanata\t0004\n")
+
+        retired = 0
+        last_cycle = None
+
+        def on_event(kind, instruction, cycle):
+            nonlocal retired
+            if kind == "fetch":
+                outfile.write(f"I\t{instruction.id}\t{instruction.id}\t0\n")
+                label = f"{instruction.pc:08X}"
+                if listing is not None:
+                    label += f": {listing.source_at(instruction.pc)}"
+                    outfile.write(f"L\t{instruction.id}\t1\t{listing.describe(instruction.pc)}\n")
+                outfile.write(f"L\t{instruction.id}\t0\t{label}\n")
+            elif kind == "start":
+                outfile.write(f"S\t{instruction.id}\t0\t{STAGES[instruction.stage]}\n")
+            elif kind == "end":
+                outfile.write(f"E\t{instruction.id}\t0\t{STAGES[instruction.stage]}\n")
+            elif kind == "retire":
+                outfile.write(f"R\t{instruction.id}\t{retired}\t0\n")
+                retired += 1
+            elif kind == "flush":
+                outfile.write(f"R\t{instruction.id}\t{instruction.id}\t1\n")
+
+        tracker = PipelineTracker(on_event)
+        for current in cycles:
+            if last_cycle is None:
+                outfile.write(f"C=\t{current.cycle}\n")
+            else:
+                outfile.write(f"C\t{current.cycle - last_cycle}\n")
+            last_cycle = current.cycle
+
+            tracker.feed(current)
+
+        if last_cycle is not None:
+            outfile.write("C\t1\n")
+            tracker.finish(last_cycle + 1)
+
+        return retired
+
+# The cycles lost to stalls and flushes, for every pc they're charged to
+class StallHotSpots:
+    def __init__(self):
+        self.cycles = 0
+        self.by_cause = defaultdict(int)
+
+        # pc -> cause -> cycles
+        self.by_pc = defaultdict(lambda: defaultdict(int))
+
+    def feed(self, current):
+        self.cycles += 1
+        if current.cause == ".":
+            return
+
+        self.by_cause[current.cause] += 1
+        pc = current.pcs[CAUSE_STAGES[current.cause]]
+        if pc is not None:
+            self.by_pc[pc][current.cause] += 1
+
+    def print_report(self, listing=None, top=20):
+        lost = sum(self.by_cause.values())
+        percentage = lost / self.cycles * 100 if self.cycles > 0 else 0
+        print(f"Cycles: {self.cycles}, stalled or flushed: {lost} ({percentage:.2f} %)")
+        for cause, name in CAUSE_NAMES.items():
+            print(f"  {name:<18} {self.by_cause[cause]:>8}")
+
+        hot_spots = sorted(self.by_pc.items(), key=lambda item: -sum(item[1].values()))[:top]
+        if len(hot_spots) == 0:
+            return
+
+        print()
+        print(f"{'pc':>8}  {'where':<24} {'total':>7} " + " ".join(f"{cause:>6}" for cause in CAUSE_NAMES) + "  source")
+        for pc, causes in hot_spots:
+            where = listing.describe(pc) if listing is not None else ""
+            source = listing.source_at(pc) if listing is not None else ""
+            counts = " ".join(f"{causes[cause]:>6}" for cause in CAUSE_NAMES)
+            print(f"{pc:08X}  {where:<24} {sum(causes.values()):>7} {counts}  {source}")
+
+# Turns a pipeline log into a Kanata file and prints the stall hot spots,
+# reading the log only once
+def process_pipeline_log(log_path, konata_path, listing=None, top=20, quiet=False):
+    hot_spots = StallHotSpots()
+
+    def cycles():
+        for current in read_pipeline_log(log_path):
+            hot_spots.feed(current)
+            yield current
+
+    retired = write_konata(cycles(), konata_path, listing)
+
+    if not quiet:
+        hot_spots.print_report(listing, top)
+        print()
+        success(f"Pipeline view of {retired} instructions saved to {konata_path}")
+
+    return hot_spots
@@ -0,0 +1,195 @@
+from collections import defaultdict
+
+import dlx_instructions as inst
+
+from dlx_emu_cpu import DECODED_INSTRUCTION, DECODED_PC, LINK_REGISTER
+from listing import LINE_RE
+
+# Instructions that change the call stack: calls push their target, and jr r31
+# pops it
+STACK_OPS = frozenset({inst.JTYPE_JAL, inst.ITYPE_JALR, inst.ITYPE_JR})
+
+# Instructions after which a basic block ends
+CONTROL_OPS = frozenset({
+    inst.ITYPE_BEQZ, inst.ITYPE_BNEZ,
+    inst.JTYPE_J, inst.JTYPE_JAL,
+    inst.ITYPE_JR, inst.ITYPE_JALR,
+})
+
+# How many lines every table of the flat profile shows
+PROFILE_TOP = 20
+
+def instruction_name(instruction):
+    opcode = (instruction & 0xFC000000) >> 26
+    if opcode == inst.RTYPE_OP:
+        return inst.FUNC_NAME.get(instruction & 0x3FF, "invalid")
+    return inst.OPS_NAME.get(opcode, "invalid")
+
+# Execution counts of an emulation, recorded by DLXCpu.run and DLXBlockCpu.run
+# as they go. Everything that can be worked out afterwards (opcodes, basic
+# blocks, labels) is, so that the run only has to count pcs, or whole blocks
+# with the blocks backend, and follow the calls and returns.
+class Profile:
+    STACK_OPS = STACK_OPS
+
+    def __init__(self):
+        # pc -> times it was executed, nops included
+        self.pc_counts = {}
+
+        # TranslatedBlock -> times it ran, added to pc_counts by finish
+        self.block_runs = {}
+
+        # The entry pcs of the functions called and not yet returned from,
+        # and the instructions executed with every call stack, counted when
+        # the stack changes from the executed instructions of the cpu at that
+        # point
+        self.stack = []
+        self.stack_counts = defaultdict(int)
+        self.stack_since = 0
+        self.calls = defaultdict(int)
+
+        # pc -> instruction word, filled in by finish
+        self.instructions = {}
+
+    # Called before the cpu starts running, with the pc it starts from and the
+    # instructions it executed so far
+    def begin(self, pc, executed):
+        self.stack = [pc]
+        self.stack_since = executed
+
+    # Called after a jal, jalr or jr ran, with its rs1 field and the pc it went
+    # to, when the cpu has executed the given instructions, the jump included
+    def control(self, opcode, rs1, next_pc, executed):
+        if opcode == inst.ITYPE_JR:
+            if rs1 != LINK_REGISTER or len(self.stack) <= 1:
+                return
+            self.stack_counts[tuple(self.stack)] += executed - self.stack_since
+            self.stack.pop()
+        else:
+            self.stack_counts[tuple(self.stack)] += executed - self.stack_since
+            self.stack.append(next_pc)
+            self.calls[next_pc] += 1
+        self.stack_since = executed
+
+    def finish(self, cpu):
+        if len(self.stack) > 0:
+            self.stack_counts[tuple(self.stack)] += cpu.cycle - self.stack_since
+            self.stack_since = cpu.cycle
+
+        for block, runs in self.block_runs.items():
+            for decoded in block.instructions:
+                pc = decoded[DECODED_PC]
+                self.pc_counts[pc] = self.pc_counts.get(pc, 0) + runs
+        self.block_runs = {}
+
+        for pc in self.pc_counts:
+            decoded = cpu.decoded.get(pc)
+            self.instructions[pc] = decoded[DECODED_INSTRUCTION] if decoded is not None else cpu.bus.fetch(pc)
+
+    def total(self):
+        return sum(self.pc_counts.values())
+
+    def opcode_counts(self):
+        counts = defaultdict(int)
+        for pc, count in self.pc_counts.items():
+            counts[instruction_name(self.instructions[pc])] += count
+        return counts
+
+    # Counts of the pcs of every label, the closest one before them in the
+    # listing
+    def label_counts(self, listing):
+        counts = defaultdict(int)
+        for pc, count in self.pc_counts.items():
+            counts[listing.label_at(pc)[0] or f"0x{pc:08X}"] += count
+        return counts
+
+    # Returns (self, inclusive) instructions for every function, named after
+    # its entry
+    def function_counts(self):
+        exclusive = defaultdict(int)
+        inclusive = defaultdict(int)
+        for stack, count in self.stack_counts.items():
+            exclusive[stack[-1]] += count
+            for entry in set(stack):
+                inclusive[entry] += count
+        return exclusive, inclusive
+
+    # The executed basic blocks as (start, length, runs), split wherever the
+    # counts change, after branches and jumps, and at labels
+    def basic_blocks(self, listing):
+        blocks = []
+        for pc in sorted(self.pc_counts):
+            count = self.pc_counts[pc]
+            previous = pc - 4
+            if (
+                len(blocks) == 0
+                or blocks[-1][0] + blocks[-1][1] * 4 != pc
+                or self.pc_counts[previous] != count
+                or (self.instructions[previous] & 0xFC000000) >> 26 in CONTROL_OPS
+                or listing.label_at(pc)[1] == 0
+            ):
+                blocks.append([pc, 1, count])
+            else:
+                blocks[-1][1] += 1
+        return [tuple(block) for block in blocks]
+
+    # Writes the call stacks in the collapsed format of flamegraph.pl and
+    # speedscope, one "caller;callee count" line each
+    def write_collapsed_stacks(self, path, listing):
+        with open(path, "w") as outfile:
+            for stack, count in sorted(self.stack_counts.items()):
+                if count > 0:
+                    outfile.write(";".join(listing.describe(entry) for entry in stack) + f" {count}\n")
+
+    # Writes the .list file of the program with the times every instruction
+    # was executed in front of it
+    def write_annotated_listing(self, path_listing, path, listing):
+        line_counts = {}
+        for pc, (lineno, _) in listing.instructions.items():
+            if pc in self.pc_counts:
+                line_counts[lineno] = self.pc_counts[pc]
+
+        total = self.total()
+        with open(path_listing, "r", encoding="latin-1") as infile, open(path, "w", encoding="latin-1") as outfile:
+            outfile.write(f"{'count':>10} {'%':>6}  {next(infile, '')}")
+            for line in infile:
+                match = LINE_RE.match(line.rstrip("\r\n"))
+                count = line_counts.get(int(match.group(1))) if match is not None else None
+                if count is not None and int(match.group(2), 16) in listing.instructions:
+                    outfile.write(f"{count:>10} {count / total * 100:>6.2f}  {line}")
+                else:
+                    outfile.write(f"{'':>10} {'':>6}  {line}")
+
+    def print_report(self, listing, top=PROFILE_TOP):
+        total = self.total()
+        if total == 0:
+            print("No instructions were executed")
+            return
+
+        def percentage(count):
+            return f"{count / total * 100:>6.2f}%"
+
+        print(f"Instructions executed: {total}")
+
+        exclusive, inclusive = self.function_counts()
+        print()
+        print(f"{'self':>10} {'':>7} {'total':>10} {'':>7} {'calls':>8}  function")
+        for entry, count in sorted(exclusive.items(), key=lambda item: -item[1])[:top]:
+            print(f"{count:>10} {percentage(count)} {inclusive[entry]:>10} {percentage(inclusive[entry])} {self.calls[entry]:>8}  {listing.describe(entry)}")
+
+        print()
+        print(f"{'count':>10} {'':>7}  label")
+        for name, count in sorted(self.label_counts(listing).items(), key=lambda item: -item[1])[:top]:
+            print(f"{count:>10} {percentage(count)}  {name}")
+
+        print()
+        print(f"{'count':>10} {'':>7}  opcode")
+        for name, count in sorted(self.opcode_counts().items(), key=lambda item: -item[1])[:top]:
+            print(f"{count:>10} {percentage(count)}  {name}")
+
+        print()
+        print(f"{'count':>10} {'':>7} {'runs':>8} {'length':>6}  {'start':>8}  {'where':<24} source")
+        blocks = sorted(self.basic_blocks(listing), key=lambda block: -block[1] * block[2])[:top]
+        for start, length, runs in blocks:
+            count = length * runs
+            print(f"{count:>10} {percentage(count)} {runs:>8} {length:>6}  {start:08X}  {listing.describe(start):<24} {listing.source_at(start)}")
@@ -0,0 +1,171 @@
+import hashlib
+import json
+import re
+
+from pathlib import Path
+
+SOURCES_PATH = "./sources.f"
+SOURCES_TB_PATH = "./sources_tb.f"
+
+# Keeps track of what's compiled in a vsim work library, so that only the
+# files that changed since the last compilation get compiled again.
+#
+# Next to the library, in <library>.sources.json, there's the hash of every
+# file compiled in it, and whether it was compiled with coverage. A file gets
+# compiled again when its hash changed, and so does every file that uses one
+# of the design units it declares (packages, entities or components, directly
+# or through other files), since vsim refuses to load units compiled before
+# the ones they depend on. If the library doesn't exist or the coverage
+# changed, everything gets compiled.
+
+COMMENT_RE = re.compile(r"--.*")
+DECLARATION_RE = re.compile(r"^\s*(?:entity|package)\s+(\w+)\s+is\b", re.IGNORECASE | re.MULTILINE)
+REFERENCE_RES = [
+    # use work.constants.all, entity work.ALU
+    re.compile(r"\bwork\.(\w+)", re.IGNORECASE),
+    # Component declarations
+    re.compile(r"\bcomponent\s+(\w+)", re.IGNORECASE),
+    # Package bodies and architectures, which could be in another file
+    re.compile(r"\bpackage\s+body\s+(\w+)", re.IGNORECASE),
+    re.compile(r"\barchitecture\s+\w+\s+of\s+(\w+)", re.IGNORECASE),
+]
+
+# The files in a .f file, as written, which is relative to the sim folder
+def read_file_list(path):
+    with open(path, "r") as infile:
+        return [line.strip() for line in infile if line.strip() != ""]
+
+# Returns the design units the VHDL file declares, and the ones it uses
+def design_units(path):
+    with open(path, "r", encoding="latin-1") as infile:
+        source = COMMENT_RE.sub("", infile.read())
+
+    declared = {name.lower() for name in DECLARATION_RE.findall(source)}
+
+    used = set()
+    for reference_re in REFERENCE_RES:
+        used.update(name.lower() for name in reference_re.findall(source))
+
+    return declared, used - declared
+
+def hash_file(path):
+    return hashlib.sha256(Path(path).read_bytes()).hexdigest()
+
+def manifest_path(work_library):
+    work_library = Path(work_library)
+    return work_library.with_name(f"{work_library.name}.sources.json")
+
+def load_manifest(work_library):
+    try:
+        with open(manifest_path(work_library), "r") as infile:
+            return json.load(infile)
+    except (OSError, ValueError):
+        return None
+
+# The files to compile, in order, split between the design (sources.f) and the
+# testbenches (sources_tb.f), which never get coverage
+class CompilePlan:
+    def __init__(self, work_library, enable_coverage, hashes, sources, sources_tb):
+        self.work_library = Path(work_library)
+        self.enable_coverage = enable_coverage
+
+        # Hash of every file, after compiling
+        self.hashes = hashes
+
+        self.sources = sources
+        self.sources_tb = sources_tb
+
+    def is_empty(self):
+        return len(self.sources) == 0 and len(self.sources_tb) == 0
+
+    def file_count(self):
+        return len(self.sources) + len(self.sources_tb)
+
+    # vsim commands that make compile_all in simulate.do only compile the
+    # files of the plan
+    def tcl_commands(self):
+        return [
+            f"quietly set COMPILE_SOURCES {tcl_list(self.sources)}",
+            f"quietly set COMPILE_SOURCES_TB {tcl_list(self.sources_tb)}",
+        ]
+
+    # To be called before compiling: the files of the plan are forgotten, so
+    # that they get compiled again if the compilation doesn't finish
+    def mark_pending(self):
+        pending = set(self.sources) | set(self.sources_tb)
+        manifest = load_manifest(self.work_library)
+        if manifest is None or manifest.get("coverage") != self.enable_coverage:
+            hashes = {}
+        else:
+            hashes = {path: value for path, value in manifest["hashes"].items() if path not in pending}
+
+        self.save(hashes)
+
+    # To be called once the files of the plan compiled without errors
+    def mark_compiled(self):
+        self.save(self.hashes)
+
+    def save(self, hashes):
+        path = manifest_path(self.work_library)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as outfile:
+            json.dump({"coverage": self.enable_coverage, "hashes": hashes}, outfile, indent=2)
+
+def tcl_list(items):
+    return "{" + " ".join(f"{{{item}}}" for item in items) + "}"
+
+def plan_compile(work_library, enable_coverage=False, sources_path=SOURCES_PATH, sources_tb_path=SOURCES_TB_PATH):
+    sources = read_file_list(sources_path)
+    sources_tb = read_file_list(sources_tb_path)
+    files = sources + sources_tb
+
+    hashes = {path: hash_file(path) for path in files}
+
+    manifest = load_manifest(work_library)
+    if (
+        manifest is None
+        or not Path(work_library).is_dir()
+        or manifest.get("coverage") != enable_coverage
+    ):
+        changed = set(files)
+    else:
+        changed = {path for path in files if manifest["hashes"].get(path) != hashes[path]}
+
+    if len(changed) > 0:
+        changed = add_dependents(files, changed)
+
+    return CompilePlan(
+        work_library,
+        enable_coverage,
+        hashes,
+        [path for path in sources if path in changed],
+        [path for path in sources_tb if path in changed],
+    )
+
+# Adds to changed every file that uses, directly or not, a design unit
+# declared in one of the changed files
+def add_dependents(files, changed):
+    declared_in = {}
+    uses = {}
+    for path in files:
+        declared, used = design_units(path)
+        for unit in declared:
+            declared_in[unit] = path
+        uses[path] = used
+
+    dependents = {path: set() for path in files}
+    for path in files:
+        for unit in uses[path]:
+            dependency = declared_in.get(unit)
+            if dependency is not None and dependency != path:
+                dependents[dependency].add(path)
+
+    changed = set(changed)
+    stack = list(changed)
+    while len(stack) > 0:
+        for dependent in dependents[stack.pop()]:
+            if dependent not in changed:
+                changed.add(dependent)
+                stack.append(dependent)
+
+    return changed
@@ -0,0 +1,239 @@
+#!/bin/python3
+
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import rtl_build
+
+from common import error, success
+
+SIMULATE_DO_PATH = "./simulate.do"
+
+# The testbenches run by simulate_all, taken from simulate.do so that the list
+# is kept in one place
+def load_testbenches(path_simulate_do=SIMULATE_DO_PATH):
+    with open(path_simulate_do, "r") as infile:
+        match = re.search(r"set TESTBENCHES \{([^}]*)\}", infile.read())
+
+    if match is None:
+        return []
+
+    return match.group(1).split()
+
+def run_vsim(commands, work_library, transcript_path):
+    args = [
+        "vsim",
+        "-c",
+        "-quiet",
+        "-l",
+        transcript_path.as_posix(),
+        "-do",
+        "onerror {quit -f -code 1}",
+        "-do",
+        f"quietly set WORK_LIBRARY {work_library.as_posix()}",
+        "-do",
+        "simulate.do",
+    ]
+
+    for command in commands:
+        args += ["-do", command]
+
+    args += ["-do", "quit -f"]
+
+    return subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+
+# Compiles the sources once, in the library every testbench gets a copy of.
+# Only the files that changed since the last run get compiled.
+def compile_sources(outdir, enable_coverage):
+    work_library = outdir / "work"
+
+    compile_plan = rtl_build.plan_compile(work_library, enable_coverage)
+    if compile_plan.is_empty():
+        print("The RTL is up to date, skipping compilation")
+        return work_library
+
+    print(f"Compiling {compile_plan.file_count()} files...")
+    compile_plan.mark_pending()
+
+    commands = compile_plan.tcl_commands() + [f"compile_all {'true' if enable_coverage else 'false'}"]
+    result = run_vsim(commands, work_library, outdir / "compile.transcript")
+    if result.returncode != 0 or "** Error" in result.stdout:
+        print(result.stdout)
+        return None
+
+    compile_plan.mark_compiled()
+    return work_library
+
+# Runs a testbench in its own vsim process, with its own copy of the compiled
+# library, since vsim can write optimized design units into it. Returns
+# (testbench, total_assertions, misses, output), where total_assertions is None
+# if the simulation didn't finish.
+def run_testbench(tb, work_library, outdir, enable_coverage):
+    path_run = outdir / tb
+    if path_run.exists():
+        shutil.rmtree(path_run)
+    path_run.mkdir(parents=True)
+
+    run_library = path_run / "work"
+    shutil.copytree(work_library, run_library)
+
+    command = f"simulate_testbench {tb}"
+    if enable_coverage:
+        command += f" {coverage_file(outdir, tb).as_posix()}"
+
+    result = run_vsim([command], run_library, path_run / "transcript")
+
+    match = re.search(r"\[" + tb + r"\] Assertions: (\d+), misses: (\d+)", result.stdout)
+    if result.returncode != 0 or match is None:
+        return tb, None, 0, result.stdout
+
+    return tb, int(match.group(1)), int(match.group(2)), result.stdout
+
+def coverage_file(outdir, tb):
+    return outdir / "coverage" / f"{tb}.ucdb"
+
+# Merges the coverage of every testbench and writes the HTML report, like
+# simulate_all -coverage
+def merge_coverage(outdir, testbenches):
+    path_coverage = outdir / "coverage"
+    final_coverfile = path_coverage / "full_coverage.ucdb"
+
+    coverage_files = [coverage_file(outdir, tb).as_posix() for tb in testbenches]
+    merge = subprocess.run(["vcover", "merge", final_coverfile.as_posix(), *coverage_files])
+    if merge.returncode != 0:
+        error("ERROR: Merging the coverage files failed")
+        return False
+
+    report = subprocess.run([
+        "vcover", "report", "-details", "-html", final_coverfile.as_posix(),
+        "-output", (path_coverage / "html").as_posix()
+    ])
+    if report.returncode != 0:
+        error("ERROR: The coverage report failed")
+        return False
+
+    print(f"Coverage saved to {final_coverfile}")
+    return True
+
+def run_testbenches(testbenches, outdir, jobs, enable_coverage=False, verbose=False):
+    outdir = Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    if enable_coverage:
+        (outdir / "coverage").mkdir(exist_ok=True)
+
+    time_start = time.perf_counter()
+
+    work_library = compile_sources(outdir, enable_coverage)
+    if work_library is None:
+        error("ERROR: Compilation failed")
+        return False
+
+    total_assertions = 0
+    failing_assertions = 0
+    failing_testbenches = []
+    crashed_testbenches = []
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [
+            pool.submit(run_testbench, tb, work_library, outdir, enable_coverage)
+            for tb in testbenches
+        ]
+
+        # Results are printed in the order of the list, whatever order the
+        # simulations end in
+        for future in futures:
+            tb, total, misses, output = future.result()
+
+            if verbose:
+                print(output)
+
+            if total is None:
+                error(f"[{tb}] Simulation failed, see {outdir / tb / 'transcript'}")
+                crashed_testbenches.append(tb)
+                continue
+
+            if misses > 0:
+                print(f"[{tb}] Test failed")
+                failing_testbenches.append((tb, misses))
+            else:
+                print(f"[{tb}] Test succeded!")
+
+            total_assertions += total
+            failing_assertions += misses
+
+    passing_assertions = total_assertions - failing_assertions
+    if total_assertions > 0:
+        percentage = float(passing_assertions) / float(total_assertions) * 100.0
+    else:
+        percentage = 0
+
+    print()
+    print()
+    print("### TEST DONE ###")
+    print(f"Passing Assertions: {passing_assertions}/{total_assertions} ({percentage:.2f} %)")
+    print(f"Elapsed time: {(time.perf_counter() - time_start):.2f} s.")
+
+    all_passed = failing_assertions == 0 and len(crashed_testbenches) == 0
+    if all_passed:
+        success("All tests passed!")
+    else:
+        error(" Tests Failed ")
+        if len(failing_testbenches) > 0:
+            print("Failing testbenches: ")
+            for tb, misses in failing_testbenches:
+                print(f"- {tb} ({misses} failures)")
+        if len(crashed_testbenches) > 0:
+            print("Testbenches that didn't finish: ")
+            for tb in crashed_testbenches:
+                print(f"- {tb}")
+    print()
+
+    if enable_coverage:
+        finished = [tb for tb in testbenches if tb not in crashed_testbenches]
+        if not merge_coverage(outdir, finished):
+            return False
+
+    return all_passed
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog="run_testbenches", description="Runs the component testbenches of simulate.do in parallel"
+    )
+
+    parser.add_argument("testbenches", nargs="*",
+                        help="the testbenches to run, all the ones in simulate.do if not given")
+
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="the number of testbenches to simulate at the same time")
+
+    parser.add_argument("-c", "--coverage", action="store_true",
+                        help="collect the code coverage of every testbench and merge it")
+
+    parser.add_argument("-o", "--outdir", type=str, default="build/testbenches",
+                        help="the folder where to save the output")
+
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="print the vsim output of every testbench")
+
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    testbenches = args.testbenches if len(args.testbenches) > 0 else load_testbenches()
+    if len(testbenches) == 0:
+        error("ERROR: No testbenches to run")
+        exit(-1)
+
+    if not run_testbenches(testbenches, args.outdir, args.jobs, enable_coverage=args.coverage, verbose=args.verbose):
+        exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,6 @@ from pathlib import Path
 
 from common import (
     error,
-    write_trace_to_file,
     InstructionTrace,
     instruction_reverse_lookup,
     CpuSimulationConfig,
@@ -14,6 +13,8 @@ import subprocess
 import shutil
 import re
 
+import rtl_build
+
 
 def add_memory_waves(path_outdir, symbols):
     assert "data_start" in symbols
@@ -76,12 +77,19 @@ def simulate_cpu(
     quiet=False,
     show_vsim_output=False,
     cpu_config=None,
+    work_dir=None,
+    reference=None,
+    pipeline_log=None,
 ):
 
     if cpu_config is None:
         cpu_config = CpuSimulationConfig.default()
 
     start_sim = f"start_sim -top tb_DLX -generics PROGRAM={mem_init},DUMP={dumpfile},MAX_CYCLES={max_cycles},{cpu_config.get_parameters()}"
+    if reference is not None:
+        start_sim += f",{reference.get_parameters()}"
+    if pipeline_log is not None:
+        start_sim += f",PIPELINE_LOG={Path(pipeline_log).as_posix()}"
 
     # TODO: IMPLEMENT
     _ = start_addr
@@ -90,6 +98,37 @@ def simulate_cpu(
         "vsim",
         "-c",
         "-quiet",
+    ]
+
+    # With a work_dir, the design is compiled in a work library inside it, and
+    # the transcript and waves are saved there too, so that more simulations
+    # can run at the same time
+    if work_dir is not None:
+        work_dir = Path(work_dir)
+        work_library = work_dir / "work"
+        start_sim += f" -wavefile {(work_dir / 'waves.wlf').as_posix()}"
+        args += [
+            "-l",
+            (work_dir / "transcript").as_posix(),
+            "-do",
+            f"quietly set WORK_LIBRARY {work_library.as_posix()}",
+        ]
+    else:
+        work_library = Path("work")
+
+    # Only the files that changed since the last simulation get compiled
+    compile_plan = rtl_build.plan_compile(work_library)
+    compile_plan.mark_pending()
+    for command in compile_plan.tcl_commands():
+        args += ["-do", command]
+
+    if not quiet:
+        if compile_plan.is_empty():
+            print("The RTL is up to date, skipping compilation")
+        else:
+            print(f"Compiling {compile_plan.file_count()} RTL files")
+
+    args += [
         "-do",
         "simulate.do",
         "-do",
@@ -101,26 +140,248 @@ def simulate_cpu(
     if not quiet:
         print(" ".join(args))
 
-    print_next = False
+    output = SimulationOutput(quiet, show_vsim_output, reference)
+    popen = subprocess.Popen(args, stdout=subprocess.PIPE, universal_newlines=True)
+    for line in iter(popen.stdout.readline, ""):
+        if not output.feed(line):
+            popen.kill()
+            break
+
+    popen.wait()
+    # The files compiled even if the simulation failed or was stopped, and
+    # they don't need to be compiled again
+    if output.compiled and not output.compile_failed:
+        compile_plan.mark_compiled()
+
+    return output.result()
+
+
+# Checks the instructions retired by the cpu against the emulator trace while
+# the simulation runs, so that it can be stopped at the first one that differs
+# instead of at the end. With watchdog_cycles, tb_DLX reports a heartbeat every
+# watchdog_cycles cycles, and the simulation is also stopped if the cpu didn't
+# retire any instruction between two of them, while the emulator went on.
+# With state_hashes (a state_hash.StateHashes), it's also stopped at the first
+# hash of the architectural writes that differs.
+class ReferenceTrace:
+    # Instructions shown before and after the one that differs
+    CONTEXT = 5
+
+    def __init__(self, emulator_trace, watchdog_cycles=0, state_hashes=None):
+        self.watchdog_cycles = watchdog_cycles
+        self.state_hashes = state_hashes
+
+        self.first_index = emulator_trace.first_index
+        self.opcodes = [(opcode, func) for _, opcode, func in emulator_trace.iter_opcodes()]
+
+        # Like compare_traces, this doesn't count the final lhi and sw, which
+        # the simulation stops at
+        self.last_index = self.first_index + len(self.opcodes) - 2
+
+        self.retired_at_heartbeat = 0
+
+    # The generics of tb_DLX for the checks
+    def get_parameters(self):
+        parameters = f"HEARTBEAT_CYCLES={self.watchdog_cycles}"
+        if self.state_hashes is not None:
+            parameters += f",{self.state_hashes.get_parameters()}"
+        return parameters
+
+    def name(self, index):
+        i = index - self.first_index
+        if i < 0 or i >= len(self.opcodes):
+            return ""
+        opcode, func = self.opcodes[i]
+        return InstructionTrace(opcode=opcode, func=func, instruction_index=index).get_name()
+
+    # Returns why the simulation should stop after the instruction at the end
+    # of trace, or None
+    def check_instruction(self, trace):
+        instruction = trace[-1]
+        index = instruction.instruction_index
+        if index < self.first_index or index >= self.last_index:
+            return None
+
+        if self.opcodes[index - self.first_index] == (instruction.opcode, instruction.func):
+            return None
+
+        return f"The cpu diverges from the emulator at instruction {index}: cpu = {instruction.get_name()}, emulator = {self.name(index)}"
+
+    # Returns why the simulation should stop after a heartbeat at the given
+    # cycle, or None
+    def check_heartbeat(self, cycle, retired):
+        stuck = retired == self.retired_at_heartbeat and retired < self.last_index
+        self.retired_at_heartbeat = retired
+
+        if stuck:
+            return f"The cpu retired no instructions in the {self.watchdog_cycles} cycles before cycle {cycle}, while the emulator ran {self.last_index - retired} more"
+        return None
+
+    # Returns why the simulation should stop after the cpu reported the hash
+    # of its first writes, or None
+    def check_state_hash(self, writes, hash, description):
+        if self.state_hashes is None:
+            return None
+        return self.state_hashes.check(writes, hash, description)
+
+    def print_context(self, trace):
+        # The writes that differ get found by state_hash.bisect instead
+        if len(trace) == 0 or (self.state_hashes is not None and self.state_hashes.mismatch is not None):
+            return
+
+        stop = trace[-1].instruction_index
+        start = max(0, stop - self.CONTEXT)
+
+        print(f"   {'':>8}  {'cpu':<8}{'emulator':<8}")
+        for index in range(start, stop + self.CONTEXT + 1):
+            cpu_name = trace[index].get_name() if index < len(trace) else ""
+            marker = ">" if index == stop else " "
+            print(f" {marker} [{index:>6}]  {cpu_name:<8}{self.name(index):<8}")
+
+# The performance counters the DLX reports at the end of a simulation, which
+# tell what its cycles went into
+class PerformanceCounters:
+    NAMES = [
+        "icache_hits",
+        "icache_misses",
+        "dcache_hits",
+        "dcache_misses",
+        "btb_hits",
+        "btb_mispredictions",
+        "dcache_stall_cycles",
+        "icache_stall_cycles",
+        "load_stall_cycles",
+        "multicycle_stall_cycles",
+        "multicycle_busy_cycles",
+        "bus_wait_cycles",
+    ]
+
+    def __init__(self):
+        self.icache_hits = 0
+        self.icache_misses = 0
+        self.dcache_hits = 0
+        self.dcache_misses = 0
+
+        # Taken branches predicted by the BTB, and branches it got wrong
+        self.btb_hits = 0
+        self.btb_mispredictions = 0
+
+        # Stall cycles, by cause
+        self.dcache_stall_cycles = 0
+        self.icache_stall_cycles = 0
+        self.load_stall_cycles = 0
+        self.multicycle_stall_cycles = 0
+
+        self.multicycle_busy_cycles = 0
+
+        # Cycles where both caches needed the bus, so one of them waited
+        self.bus_wait_cycles = 0
+
+    # Parses the "name=value" pairs of the report
+    @staticmethod
+    def parse(text):
+        counters = PerformanceCounters()
+        for pair in text.split():
+            name, _, value = pair.partition("=")
+            if name in PerformanceCounters.NAMES:
+                setattr(counters, name, int(value))
+
+        return counters
+
+    def icache_miss_rate(self):
+        accesses = self.icache_hits + self.icache_misses
+        return self.icache_misses / accesses if accesses > 0 else 0
+
+    def dcache_miss_rate(self):
+        accesses = self.dcache_hits + self.dcache_misses
+        return self.dcache_misses / accesses if accesses > 0 else 0
+
+    def stall_cycles(self):
+        return self.dcache_stall_cycles + self.icache_stall_cycles + self.load_stall_cycles + self.multicycle_stall_cycles
+
+    def print_report(self):
+        print(f"Instruction cache: {self.icache_hits} hits, {self.icache_misses} misses ({self.icache_miss_rate() * 100:.2f} % miss rate)")
+        print(f"Data cache: {self.dcache_hits} hits, {self.dcache_misses} misses ({self.dcache_miss_rate() * 100:.2f} % miss rate)")
+        print(f"BTB: {self.btb_hits} hits, {self.btb_mispredictions} mispredictions")
+        print(f"Stall cycles: {self.stall_cycles()} (data cache = {self.dcache_stall_cycles}, instruction cache = {self.icache_stall_cycles}, load-use = {self.load_stall_cycles}, multicycle = {self.multicycle_stall_cycles})")
+        print(f"Multicycle unit busy cycles: {self.multicycle_busy_cycles}")
+        print(f"Bus wait cycles: {self.bus_wait_cycles}")
+
+# Parses the output of a tb_DLX simulation, one line at a time, printing what
+# needs to be printed. If a ReferenceTrace is given, the instructions are
+# checked against it as they retire.
+class SimulationOutput:
+    def __init__(self, quiet=False, show_vsim_output=False, reference=None):
+        self.quiet = quiet
+        self.show_vsim_output = show_vsim_output
+        self.reference = reference
+
+        # Why the simulation was stopped early, if it was
+        self.abort_reason = None
+
+        self.print_next = False
+
+        self.cycle_taken = 0
+        self.instruction_ran = 0
+        self.counters = None
+
+        self.execution_trace = []
+
+        self.simulation_success = False
+        self.compile_failed = False
+
+        # Whether start_sim got past the compilation, see simulate.do
+        self.compiled = False
+
+        self.skip_next = False
+
+    # Returns False if the simulation should be stopped
+    def feed(self, line):
+        if "** Error" in line and ".vhd" in line:
+            self.compile_failed = True
+
+        # The echo of the command has the variable instead of its value
+        if re.search(r"Compilation finished in [^$]", line):
+            self.compiled = True
+
+        heartbeat_match = re.search(r"Heartbeat: (\d+)", line)
+        if heartbeat_match:
+            if self.reference is not None:
+                self.abort_reason = self.reference.check_heartbeat(int(heartbeat_match.group(1)), len(self.execution_trace))
+            # The time of the report is on the next line
+            self.skip_next = True
+            return self.abort_reason is None
+
+        state_hash_match = re.search(r"State hash: (\d+) ([0-9A-F]{8}) (\S+)", line)
+        if state_hash_match:
+            if self.reference is not None:
+                self.abort_reason = self.reference.check_state_hash(
+                    int(state_hash_match.group(1)), int(state_hash_match.group(2), 16), state_hash_match.group(3)
+                )
+            self.skip_next = True
+            return self.abort_reason is None
 
-    cycle_taken = 0
-    instruction_ran = 0
+        if self.skip_next:
+            self.skip_next = False
+            if line.lstrip("# ").startswith("Time:"):
+                return True
 
-    execution_trace = []
+        counters_match = re.search(r"Performance counters:(.*)", line)
+        if counters_match:
+            self.counters = PerformanceCounters.parse(counters_match.group(1))
+            self.skip_next = True
+            return True
 
-    simulation_success = False
-    popen = subprocess.Popen(args, stdout=subprocess.PIPE, universal_newlines=True)
-    for line in iter(popen.stdout.readline, ""):
         inst_match = re.search(r"Instructions ran:\s*(\d+)", line)
         cyc_match = re.search(r"Cycles taken:\s*(\d+)", line)
 
         if inst_match:
-            instruction_ran = int(inst_match.group(1))
+            self.instruction_ran = int(inst_match.group(1))
 
         if cyc_match:
-            cycle_taken = int(cyc_match.group(1))
+            self.cycle_taken = int(cyc_match.group(1))
 
-        if show_vsim_output:
+        if self.show_vsim_output:
             print(line.strip())
 
         inst_trace_match = re.search(r"\[(\d+)\] ([a-zA-Z_]+)_op", line)
@@ -129,37 +390,54 @@ def simulate_cpu(
             instruction = inst_trace_match.group(2)
 
             opcode, func = instruction_reverse_lookup(instruction)
-            execution_trace.append(
+            self.execution_trace.append(
                 InstructionTrace(
                     opcode=opcode, func=func, instruction_index=instruction_number
                 )
             )
 
-            assert instruction_number == len(execution_trace) - 1
-            continue
+            assert instruction_number == len(self.execution_trace) - 1
 
-        if not show_vsim_output and not quiet:
+            if self.reference is not None:
+                self.abort_reason = self.reference.check_instruction(self.execution_trace)
+            return self.abort_reason is None
+
+        if not self.show_vsim_output and not self.quiet:
             if line.startswith("# **"):
                 print(line.strip())
-                print_next = True
-            elif print_next:
+                self.print_next = True
+            elif self.print_next:
                 print(line.strip())
-                print_next = False
+                self.print_next = False
 
         # A bit hacky, but it will work
         if "Simulation Finished!" in line:
-            simulation_success = True
-
-    if not simulation_success or cycle_taken == 0 or instruction_ran == 0:
-        if not quiet:
-            error(f"Simulation Failed")
-        return False, 0, [], 0
-
-    if cycle_taken != 0 and instruction_ran != 0:
-        cpi = float(cycle_taken) / float(instruction_ran)
-        if not quiet:
-            print(f"\nSimulation Finished!\nCycles per Instruction: {cpi:.2f}")
-
-    write_trace_to_file(execution_trace, outdir / "simulator.trace")
-
-    return True, instruction_ran, execution_trace, cycle_taken
+            self.simulation_success = True
+
+        return True
+
+    # Returns (success, instructions_ran, trace, cycles_taken, counters), like
+    # simulate_cpu, where counters are the PerformanceCounters, or None if the
+    # DLX didn't report them
+    def result(self):
+        cycle_taken = self.cycle_taken
+        instruction_ran = self.instruction_ran
+
+        if self.abort_reason is not None:
+            error(f"Simulation stopped early: {self.abort_reason}")
+            self.reference.print_context(self.execution_trace)
+            return False, 0, [], 0, None
+
+        if not self.simulation_success or cycle_taken == 0 or instruction_ran == 0:
+            if not self.quiet:
+                error(f"Simulation Failed")
+            return False, 0, [], 0, None
+
+        if cycle_taken != 0 and instruction_ran != 0:
+            cpi = float(cycle_taken) / float(instruction_ran)
+            if not self.quiet:
+                print(f"\nSimulation Finished!\nCycles per Instruction: {cpi:.2f}")
+                if self.counters is not None:
+                    self.counters.print_report()
+
+        return True, instruction_ran, self.execution_trace, cycle_taken, self.counters
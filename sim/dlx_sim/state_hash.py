@@ -0,0 +1,168 @@
+from array import array
+
+from common import error, warn
+from dlx_emu_cpu import NO_DEST, MASK, sign_extend
+from dlx_instructions import ITYPE_SB, ITYPE_SH, ITYPE_SW
+
+# 32 bit FNV-1a, folding a word at a time, like the StateHash process of the
+# datapath
+HASH_OFFSET = 0x811C9DC5
+HASH_PRIME = 0x01000193
+
+# Tags folded before every write, so that a register write and a store can't
+# hash the same
+REGISTER_TAG = 0x100
+STORE_TAG = 0x200
+
+STORE_SIZES = {
+    ITYPE_SB: 1,
+    ITYPE_SH: 2,
+    ITYPE_SW: 4,
+}
+
+# Every rerun of the bisection reports the hash this many times in the writes
+# left to check
+BISECT_SPLIT = 64
+
+def fold(hash, word):
+    return ((hash ^ word) * HASH_PRIME) & MASK
+
+# The architectural writes of the emulator, in program order: the registers
+# written (but r0) and the stores, with the rolling hash after each of them,
+# the same the cpu reports with STATE_HASH_INTERVAL. Like the cpu, this stops
+# before the final sw, which ends the program. The cpu reports its hash once
+# more at that sw, with the number of writes it covers, which depends on
+# whether the final lhi got through write back in time.
+class WriteStream:
+    def __init__(self, emulator_trace):
+        self.trace = emulator_trace
+
+        # hashes[n] is the hash after the first n writes, and
+        # write_positions[n - 1] is the position in the trace of the
+        # instruction that did the n-th write
+        self.hashes = array("I", [HASH_OFFSET])
+        self.write_positions = array("I")
+
+        registers = list(emulator_trace.initial_registers)
+        hash = HASH_OFFSET
+
+        for i in range(len(emulator_trace) - 1):
+            instruction = emulator_trace.instructions[i]
+            opcode = (instruction & 0xFC000000) >> 26
+            size = STORE_SIZES.get(opcode)
+
+            if size is not None:
+                rs1 = (instruction & 0x03E00000) >> 21
+                rd = (instruction & 0x001F0000) >> 16
+                address = (registers[rs1] + sign_extend(instruction & 0xFFFF, 16)) & MASK
+                value = registers[rd] & ((1 << (size * 8)) - 1)
+
+                hash = fold(fold(fold(hash, STORE_TAG | size), address), value)
+                self.hashes.append(hash)
+                self.write_positions.append(i)
+
+            dest = emulator_trace.dests[i]
+            if dest != NO_DEST:
+                registers[dest] = emulator_trace.values[i]
+                if dest != 0:
+                    hash = fold(fold(hash, REGISTER_TAG | dest), emulator_trace.values[i])
+                    self.hashes.append(hash)
+                    self.write_positions.append(i)
+
+    def __len__(self):
+        return len(self.write_positions)
+
+    # Describes the n-th write like the cpu does in its reports
+    def describe(self, n):
+        i = self.write_positions[n - 1]
+        instruction = self.trace.instructions[i]
+        size = STORE_SIZES.get((instruction & 0xFC000000) >> 26)
+
+        if size is None:
+            dest = self.trace.dests[i]
+            return f"r{dest}={self.trace.values[i]:08X}"
+
+        registers = self.trace.registers_at(i)
+        rs1 = (instruction & 0x03E00000) >> 21
+        rd = (instruction & 0x001F0000) >> 16
+        address = (registers[rs1] + sign_extend(instruction & 0xFFFF, 16)) & MASK
+        value = registers[rd] & ((1 << (size * 8)) - 1)
+        return f"m{size}[{address:08X}]={value:08X}"
+
+# The hashes the cpu reports in a simulation, checked against a WriteStream as
+# they come: the cpu reports one every interval writes after the first start,
+# and the simulation is stopped at the first one that differs.
+class StateHashes:
+    def __init__(self, stream, interval, start=0):
+        self.stream = stream
+        self.interval = interval
+        self.start = start
+
+        # The last write whose hash matched, and the first one whose hash
+        # didn't, with how the cpu described it
+        self.last_match = start
+        self.mismatch = None
+        self.mismatch_description = None
+
+    def get_parameters(self):
+        return f"STATE_HASH_INTERVAL={self.interval},STATE_HASH_START={self.start}"
+
+    # Returns why the simulation should stop after the cpu reported the given
+    # hash, or None
+    def check(self, writes, hash, description):
+        if writes > len(self.stream):
+            return None
+
+        if self.stream.hashes[writes] == hash:
+            self.last_match = writes
+            return None
+
+        self.mismatch = writes
+        self.mismatch_description = description
+        if writes == self.last_match + 1:
+            return f"The state hash of the cpu diverges from the emulator's at write {writes}"
+        return f"The state hash of the cpu diverges from the emulator's between writes {self.last_match + 1} and {writes}"
+
+    # Returns the hashes to check in a rerun of the simulation, to narrow down
+    # the writes between the last match and the mismatch, or None if the
+    # mismatch is already the first write that differs
+    def refine(self):
+        if self.mismatch is None or self.mismatch - self.last_match <= 1:
+            return None
+
+        interval = max(1, (self.mismatch - self.last_match) // BISECT_SPLIT)
+        return StateHashes(self.stream, interval, self.last_match)
+
+    def print_divergence(self):
+        n = self.mismatch
+        i = self.stream.write_positions[n - 1]
+        instruction = self.stream.trace[i]
+
+        print(f"First write that differs: write {n}, by instruction {instruction.instruction_index} ({instruction.get_name()} at pc {instruction.pc:08X})")
+        print(f"   emulator: {self.stream.describe(n)}")
+        print(f"   cpu:      {self.mismatch_description}")
+
+# Reruns the simulation with finer and finer intervals between the hashes, in
+# the writes between the last hash that matched and the first that didn't,
+# until the first write that differs is found. simulate(state_hashes) runs the
+# simulation checking the given hashes.
+def bisect(simulate, state_hashes):
+    while True:
+        finer = state_hashes.refine()
+        if finer is None:
+            break
+
+        print(f"Bisecting writes {finer.start + 1} to {state_hashes.mismatch}, with a hash every {finer.interval}")
+        simulate(finer)
+
+        if finer.mismatch is None:
+            warn("The rerun of the simulation didn't diverge, stopping the bisection")
+            break
+
+        state_hashes = finer
+
+    if state_hashes.mismatch - state_hashes.last_match > 1:
+        error(f"The first write that differs is between writes {state_hashes.last_match + 1} and {state_hashes.mismatch}")
+        return
+
+    state_hashes.print_divergence()
@@ -0,0 +1,402 @@
+import mmap
+import struct
+import sys
+
+from array import array
+from collections.abc import Sequence
+
+from common import InstructionTrace, write_trace
+from dlx_emu_cpu import extract_fields, NO_DEST
+from dlx_emu_trace import EmulatorTrace
+from dlx_instructions import RTYPE_OP
+
+# Binary trace file format. All values are little endian.
+#
+# The file starts with a header, followed by one fixed size record per
+# instruction and then by the seek index:
+#  - header: magic, version, flags, record size, index interval, number of
+#    records, instruction index of the first record, offset of the index,
+#    followed by the register file before the first record;
+#  - record: pc, instruction word, destination register (NO_DEST if none) and
+#    the value written to it, as four 32 bit words;
+#  - index: one entry every INDEX_INTERVAL records, with the lowest and highest
+#    pc in those records and the register file before the first of them.
+#
+# The index is only written when the trace is closed. Until then the offset of
+# the index is 0, and readers rebuild it from the records.
+#
+# Traces without pcs or registers (as the ones from the CPU simulation) leave
+# those fields to zero, and clear the corresponding flag.
+TRACE_MAGIC = b"DLXT"
+TRACE_VERSION = 1
+
+FLAG_HAS_PC = 1
+FLAG_HAS_REGISTERS = 2
+
+HEADER = struct.Struct("<4sHHHHIQQQ")
+RECORD_WORDS = 4
+RECORD_SIZE = RECORD_WORDS * 4
+INDEX_ENTRY_WORDS = 2 + 32
+INDEX_INTERVAL = 4096
+RECORDS_OFFSET = HEADER.size + 32 * 4
+
+MASK = 0xFFFF_FFFF
+
+def to_little_endian(words):
+    if sys.byteorder != "little":
+        words = array("I", words)
+        words.byteswap()
+    return words
+
+# Writes a binary trace file, taking the records a column at a time so that
+# it can be fed directly from an EmulatorTrace, or in chunks while the trace
+# is still being recorded.
+class TraceFileWriter:
+    def __init__(self, path, first_index=0, initial_registers=None, has_pc=True, index_interval=INDEX_INTERVAL):
+        self.flags = 0
+        if has_pc:
+            self.flags |= FLAG_HAS_PC
+        if initial_registers is not None:
+            self.flags |= FLAG_HAS_REGISTERS
+        else:
+            initial_registers = [0] * 32
+
+        self.first_index = first_index
+        self.index_interval = index_interval
+        self.count = 0
+
+        # Register file after the last record written, and the index entries
+        # as [min_pc, max_pc, registers]
+        self.registers = array("I", initial_registers)
+        self.index = []
+
+        self.file = open(path, "wb")
+        self.write_header(0)
+        self.file.write(to_little_endian(self.registers))
+
+    def extend(self, pcs, instructions, dests, values):
+        length = len(pcs)
+
+        words = array("I", bytes(length * RECORD_SIZE))
+        words[0::RECORD_WORDS] = array("I", pcs)
+        words[1::RECORD_WORDS] = array("I", instructions)
+        memoryview(words).cast("B").cast("i")[2::RECORD_WORDS] = array("i", dests)
+        words[3::RECORD_WORDS] = array("I", values)
+        self.file.write(to_little_endian(words))
+
+        registers = self.registers
+        start = 0
+        while start < length:
+            offset = self.count % self.index_interval
+            if offset == 0:
+                self.index.append([MASK, 0, array("I", registers)])
+
+            end = min(length, start + self.index_interval - offset)
+
+            entry = self.index[-1]
+            entry[0] = min(entry[0], min(pcs[start:end]))
+            entry[1] = max(entry[1], max(pcs[start:end]))
+
+            for i in range(start, end):
+                dest = dests[i]
+                if dest != NO_DEST:
+                    registers[dest] = values[i]
+
+            self.count += end - start
+            start = end
+
+    def write_header(self, index_offset):
+        self.file.write(HEADER.pack(
+            TRACE_MAGIC,
+            TRACE_VERSION,
+            self.flags,
+            RECORD_SIZE,
+            0,
+            self.index_interval,
+            self.count,
+            self.first_index,
+            index_offset
+        ))
+
+    # Updates the number of records in the header, so that the records
+    # written so far can be read while the trace is still being written
+    def flush(self):
+        self.file.seek(0)
+        self.write_header(0)
+        self.file.seek(0, 2)
+        self.file.flush()
+
+    def close(self):
+        index_offset = RECORDS_OFFSET + self.count * RECORD_SIZE
+
+        for min_pc, max_pc, registers in self.index:
+            self.file.write(to_little_endian(array("I", [min_pc, max_pc]) + registers))
+
+        self.file.seek(0)
+        self.write_header(index_offset)
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+# Writes either an EmulatorTrace, or a list of InstructionTrace without pcs or
+# registers (as returned by the CPU simulation), to a binary trace file.
+def write_binary_trace(trace, path):
+    if isinstance(trace, EmulatorTrace):
+        with TraceFileWriter(path, trace.first_index, trace.initial_registers) as writer:
+            writer.extend(trace.pcs, trace.instructions, trace.dests, trace.values)
+        return
+
+    first_index = trace[0].instruction_index if len(trace) > 0 else 0
+    instructions = array("I", [
+        (instruction.opcode << 26) | (instruction.func if instruction.opcode == RTYPE_OP else 0)
+        for instruction in trace
+    ])
+
+    with TraceFileWriter(path, first_index, has_pc=False) as writer:
+        writer.extend(
+            array("I", bytes(len(trace) * 4)),
+            instructions,
+            array("b", [NO_DEST]) * len(trace),
+            array("I", bytes(len(trace) * 4)))
+
+# Trace sinks for emulate, which get the trace one EmulatorTrace chunk at a
+# time. Each chunk is flushed to disk as soon as it's written, so a partial
+# trace is readable while the emulation is still running.
+class TextTraceSink:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "w")
+
+    def write(self, chunk):
+        write_trace(chunk, self.file)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class BinaryTraceSink:
+    def __init__(self, path):
+        self.path = path
+        self.writer = None
+
+    def write(self, chunk):
+        # The first chunk gives the starting instruction and registers
+        if self.writer is None:
+            self.writer = TraceFileWriter(self.path, chunk.first_index, chunk.initial_registers)
+
+        self.writer.extend(chunk.pcs, chunk.instructions, chunk.dests, chunk.values)
+        self.writer.flush()
+
+    def close(self):
+        if self.writer is None:
+            self.writer = TraceFileWriter(self.path, initial_registers=[0] * 32)
+
+        self.writer.close()
+
+# A memory mapped binary trace file. Works like an EmulatorTrace: indexing
+# and iterating give InstructionTrace objects, but only the records that are
+# accessed get read from the file.
+class TraceFile(Sequence):
+    def __init__(self, path):
+        with open(path, "rb") as trace_file:
+            self.mmap = mmap.mmap(trace_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self.mmap) < RECORDS_OFFSET:
+            self.mmap.close()
+            raise ValueError(f"{path} is not a binary trace file")
+
+        (
+            magic,
+            version,
+            self.flags,
+            record_size,
+            _,
+            self.index_interval,
+            self.count,
+            self.first_index,
+            index_offset
+        ) = HEADER.unpack_from(self.mmap)
+
+        if magic != TRACE_MAGIC or version != TRACE_VERSION or record_size != RECORD_SIZE:
+            self.mmap.close()
+            raise ValueError(f"{path} is not a binary trace file")
+
+        index_entries = -(-self.count // self.index_interval)
+        records_end = RECORDS_OFFSET + self.count * RECORD_SIZE
+
+        view = memoryview(self.mmap)
+        self.initial_registers = view[HEADER.size:RECORDS_OFFSET].cast("I")
+        self.records = view[RECORDS_OFFSET:records_end].cast("I")
+        if index_offset != 0:
+            self.index = view[index_offset:index_offset + index_entries * INDEX_ENTRY_WORDS * 4].cast("I")
+
+        # The views follow the host's byte order, so on big endian hosts the
+        # file has to be copied and swapped
+        if sys.byteorder != "little":
+            self.initial_registers = to_little_endian(self.initial_registers)
+            self.records = to_little_endian(self.records)
+            if index_offset != 0:
+                self.index = to_little_endian(self.index)
+
+        if index_offset == 0:
+            self.index = self.build_index()
+
+        self.has_pc = (self.flags & FLAG_HAS_PC) != 0
+        self.has_registers = (self.flags & FLAG_HAS_REGISTERS) != 0
+
+    def close(self):
+        for view in (self.initial_registers, self.records, self.index):
+            if isinstance(view, memoryview):
+                view.release()
+
+        self.mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    # Returns (pc, instruction, dest, value) for the i-th record
+    def record(self, i):
+        base = i * RECORD_WORDS
+        pc, instruction, dest, value = self.records[base:base + RECORD_WORDS]
+        return pc, instruction, dest if dest != MASK else NO_DEST, value
+
+    # Builds the index for a trace that is still being written, or whose
+    # writer didn't get to close it
+    def build_index(self):
+        index = array("I")
+        registers = array("I", self.initial_registers)
+
+        for start in range(0, self.count, self.index_interval):
+            stop = min(start + self.index_interval, self.count)
+            pcs = self.records[start * RECORD_WORDS:stop * RECORD_WORDS:RECORD_WORDS]
+            index.extend([min(pcs), max(pcs)])
+            index.extend(registers)
+
+            for i in range(start, stop):
+                _, _, dest, value = self.record(i)
+                if dest != NO_DEST:
+                    registers[dest] = value
+
+        return index
+
+    # Returns the position in the file of the given instruction index
+    def position_of(self, instruction_index):
+        return instruction_index - self.first_index
+
+    # Returns the register file before the i-th record
+    def registers_before(self, i):
+        entry = i // self.index_interval
+        base = entry * INDEX_ENTRY_WORDS + 2
+        registers = list(self.index[base:base + 32])
+
+        for j in range(entry * self.index_interval, i):
+            _, _, dest, value = self.record(j)
+            if dest != NO_DEST:
+                registers[dest] = value
+
+        return registers
+
+    # Returns the register file right after the i-th record
+    def registers_at(self, i):
+        registers = self.registers_before(i)
+
+        _, _, dest, value = self.record(i)
+        if dest != NO_DEST:
+            registers[dest] = value
+
+        return registers
+
+    def make_instruction_trace(self, i, registers):
+        pc, instruction, _, _ = self.record(i)
+        opcode, itype, rtype, jtype = extract_fields(instruction)
+
+        return InstructionTrace(
+                opcode=opcode,
+                func=instruction & 0x3FF if opcode == RTYPE_OP else 0,
+                instruction_index=self.first_index + i,
+                registers=registers,
+                pc=pc if self.has_pc else None,
+                itype=itype,
+                rtype=rtype,
+                jtype=jtype
+        )
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step == 1:
+                return list(self.iter_range(start, stop))
+            return [self[j] for j in range(start, stop, step)]
+
+        if i < 0:
+            i += len(self)
+
+        if i < 0 or i >= len(self):
+            raise IndexError("trace index out of range")
+
+        registers = tuple(self.registers_at(i)) if self.has_registers else None
+        return self.make_instruction_trace(i, registers)
+
+    def __iter__(self):
+        return self.iter_range(0, len(self))
+
+    # Yields the records from start to stop (excluded) as InstructionTrace
+    # objects. Only the index entry before start gets read to rebuild the
+    # registers, so this can start anywhere in the file.
+    def iter_range(self, start, stop):
+        start = max(start, 0)
+        stop = min(stop, len(self))
+        if start >= stop:
+            return
+
+        registers = self.registers_before(start) if self.has_registers else None
+
+        for i in range(start, stop):
+            if registers is not None:
+                _, _, dest, value = self.record(i)
+                if dest != NO_DEST:
+                    registers[dest] = value
+
+            yield self.make_instruction_trace(i, tuple(registers) if registers is not None else None)
+
+    # Yields the index entries which could have records with
+    # min_pc <= pc <= max_pc, as (start, stop) positions of their records
+    def index_entries_in_pc_range(self, min_pc, max_pc):
+        for entry in range(len(self.index) // INDEX_ENTRY_WORDS):
+            base = entry * INDEX_ENTRY_WORDS
+            if self.index[base] > max_pc or self.index[base + 1] < min_pc:
+                continue
+
+            start = entry * self.index_interval
+            yield start, min(start + self.index_interval, self.count)
+
+    # Same as iter_range, but only yields the records with
+    # min_pc <= pc <= max_pc
+    def iter_pc_range(self, min_pc, max_pc, start=0, stop=None):
+        stop = len(self) if stop is None else stop
+
+        for entry_start, entry_stop in self.index_entries_in_pc_range(min_pc, max_pc):
+            for instruction in self.iter_range(max(start, entry_start), min(stop, entry_stop)):
+                if min_pc <= instruction.pc <= max_pc:
+                    yield instruction
+
+    # Yields (instruction_index, opcode, func) for every record, as in
+    # EmulatorTrace.iter_opcodes
+    def iter_opcodes(self):
+        # A slice of the records would keep the mmap from being closed while
+        # this runs
+        for i in range(self.count):
+            instruction = self.records[i * RECORD_WORDS + 1]
+            opcode = (instruction & 0xFC000000) >> 26
+            func = instruction & 0x3FF if opcode == RTYPE_OP else 0
+            yield self.first_index + i, opcode, func
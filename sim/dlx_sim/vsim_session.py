@@ -0,0 +1,162 @@
+import shutil
+import subprocess
+
+from pathlib import Path
+
+import rtl_build
+
+from common import CpuSimulationConfig
+from simulator import SimulationOutput
+
+# A vsim process that stays open, running tb_DLX for one program after the
+# other, so that QuestaSim starts, loads the library and compiles the design
+# only once instead of for every program.
+#
+# Commands are Tcl, written to the standard input of vsim -c. After every
+# simulation, a marker gets printed, which is how the end of its output is
+# found. tb_DLX takes the program and the dump file as generics, so every
+# program is copied to the same program.mem, and its dump is copied from the
+# same dump.mem. When the generics don't change (same max cycles and caches),
+# the next program only needs restart -f, which reloads program.mem without
+# elaborating the design again, since the memory of tb_DLX reads it whenever
+# it's reset, and not when it's elaborated; otherwise the design gets loaded
+# again with the new generics.
+#
+# If the python process dies, vsim gets EOF on its input and quits too.
+class VsimSession:
+    def __init__(self, work_dir, show_vsim_output=False):
+        self.work_dir = Path(work_dir)
+        self.work_library = self.work_dir / "work"
+        self.show_vsim_output = show_vsim_output
+
+        self.path_program = self.work_dir / "program.mem"
+        self.path_dump = self.work_dir / "dump.mem"
+
+        self.process = None
+
+        # Generics of the design loaded in vsim, if any
+        self.generics = None
+        self.compile_plan = None
+
+        self.commands_sent = 0
+
+    def start(self):
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+
+        # The design is compiled by the first start_sim, with only the files
+        # that changed since the last simulation
+        self.compile_plan = rtl_build.plan_compile(self.work_library)
+        self.compile_plan.mark_pending()
+
+        args = [
+            "vsim",
+            "-c",
+            "-quiet",
+            "-l",
+            (self.work_dir / "transcript").as_posix(),
+            "-do",
+            f"quietly set WORK_LIBRARY {self.work_library.as_posix()}",
+        ]
+        for command in self.compile_plan.tcl_commands():
+            args += ["-do", command]
+        args += ["-do", "simulate.do"]
+
+        self.process = subprocess.Popen(
+            args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True, bufsize=1
+        )
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def close(self):
+        if self.process is None:
+            return
+
+        if self.is_running():
+            try:
+                self.process.stdin.write("quit -f\n")
+                self.process.stdin.close()
+            except OSError:
+                pass
+            self.process.wait()
+
+        self.process = None
+        self.generics = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Same as simulator.simulate_cpu, but in this session, which gets started
+    # if it isn't running
+    def simulate_cpu(self, mem_init, dumpfile, max_cycles, quiet=False, cpu_config=None, reference=None):
+        if cpu_config is None:
+            cpu_config = CpuSimulationConfig.default()
+
+        if not self.is_running():
+            self.close()
+            self.start()
+
+        shutil.copy(mem_init, self.path_program)
+        if self.path_dump.exists():
+            self.path_dump.unlink()
+
+        generics = f"PROGRAM={self.path_program.as_posix()},DUMP={self.path_dump.as_posix()},MAX_CYCLES={max_cycles},{cpu_config.get_parameters()}"
+        if reference is not None:
+            generics += f",{reference.get_parameters()}"
+        if generics == self.generics:
+            command = "restart -f; run -all"
+        else:
+            # Only the first start_sim of the session compiles the design
+            command = f"start_sim -top tb_DLX -generics {generics} -wavefile {(self.work_dir / 'waves.wlf').as_posix()}"
+            if self.generics is not None:
+                command = f"quit -sim; {command} -compile false"
+            self.generics = generics
+
+        if not quiet:
+            print(f"[vsim session] {command}")
+
+        output = SimulationOutput(quiet, self.show_vsim_output, reference)
+        if not self.run_command(command, output.feed):
+            # vsim quit, or the simulation was stopped early, in which case
+            # vsim gets killed, since it can't be interrupted through its input
+            if output.abort_reason is not None:
+                self.process.kill()
+                self.process.wait()
+            self.close()
+
+        # Only the first start_sim of the process compiles, whether its test
+        # passes or not
+        if output.compiled and not output.compile_failed:
+            self.compile_plan.mark_compiled()
+
+        if self.path_dump.exists():
+            shutil.copy(self.path_dump, dumpfile)
+
+        return output.result()
+
+    # Sends a command, passing every line of its output to on_line, until it
+    # returns False. Returns False if vsim quit before the command was done, or
+    # on_line returned False.
+    def run_command(self, command, on_line):
+        self.commands_sent += 1
+
+        # The marker is built by Tcl, so that it doesn't show up in the echo
+        # of the command itself
+        marker = f"vsim_session_done {self.commands_sent}"
+        try:
+            self.process.stdin.write(f"{command}\n")
+            self.process.stdin.write(f"puts \"vsim_session_done [expr {{{self.commands_sent}}}]\"\n")
+            self.process.stdin.flush()
+        except OSError:
+            return False
+
+        for line in iter(self.process.stdout.readline, ""):
+            if line.strip().endswith(marker):
+                return True
+            if not on_line(line):
+                return False
+
+        return False
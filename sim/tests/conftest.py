@@ -0,0 +1,17 @@
+import sys
+
+from pathlib import Path
+
+import pytest
+
+SIM_DIR = Path(__file__).resolve().parents[1]
+
+# The scripts import each other by name, as they run from dlx_sim
+sys.path.insert(0, str(SIM_DIR / "dlx_sim"))
+
+# The scripts are run from the sim folder, and find the sources and the
+# programs relative to it
+@pytest.fixture
+def sim_dir(monkeypatch):
+    monkeypatch.chdir(SIM_DIR)
+    return SIM_DIR
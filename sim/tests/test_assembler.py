@@ -0,0 +1,92 @@
+import shutil
+import subprocess
+
+from pathlib import Path
+
+import pytest
+
+from dlx_assembler import AssemblerError, assemble, assemble_file, binary_to_words, mem_text
+
+SIM_DIR = Path(__file__).resolve().parents[1]
+DLXASM_PATH = SIM_DIR / "assembler" / "dlxasm.pl"
+PROGRAMS = sorted((SIM_DIR / "programs").glob("*.asm"))
+
+needs_perl = pytest.mark.skipif(shutil.which("perl") is None, reason="dlxasm.pl needs perl")
+
+# Runs dlxasm.pl like dlx_sim used to, with the .mem made from the .bin.
+# Returns the exit code and what it printed.
+def run_dlxasm(source, outdir, progname):
+    result = subprocess.run(
+        [
+            "perl", DLXASM_PATH,
+            "-o", outdir / f"{progname}.bin",
+            "-list", outdir / f"{progname}.list",
+            "-sym", outdir / f"{progname}.sym",
+            source,
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+    )
+
+    if result.returncode == 0:
+        words = binary_to_words((outdir / f"{progname}.bin").read_bytes())
+        (outdir / f"{progname}.mem").write_text(mem_text(words))
+
+    return result.returncode, result.stdout
+
+@needs_perl
+@pytest.mark.parametrize("source", PROGRAMS, ids=[path.stem for path in PROGRAMS])
+def test_same_files_as_dlxasm(source, tmp_path):
+    perl_dir = tmp_path / "perl"
+    python_dir = tmp_path / "python"
+    perl_dir.mkdir()
+    python_dir.mkdir()
+
+    returncode, output = run_dlxasm(source, perl_dir, source.stem)
+    assert returncode == 0, output
+    assemble_file(source).save(python_dir, source.stem)
+
+    for suffix in (".bin", ".bin.hdr", ".list", ".sym", ".mem"):
+        name = f"{source.stem}{suffix}"
+        assert (python_dir / name).read_bytes() == (perl_dir / name).read_bytes(), name
+
+ERRORS = [
+    (
+        ".data\ndata_start:\n\tadd r1, r2, r3\n",
+        ["Instructions not allowed in data segment (at line 3)"],
+    ),
+    (
+        ".text\n\t.space 4\n",
+        [".space can't be used in the text segment (at line 2)!"],
+    ),
+    (
+        ".text\n\t.space 4\n.data\n\tsub r1, r2, r3\n\t.word 1\n\tj 0\n",
+        [
+            ".space can't be used in the text segment (at line 2)!",
+            "Instructions not allowed in data segment (at line 4)",
+            "Instructions not allowed in data segment (at line 6)",
+        ],
+    ),
+]
+
+@pytest.mark.parametrize("source, errors", ERRORS)
+def test_errors_raise(source, errors):
+    with pytest.raises(AssemblerError) as raised:
+        assemble(source)
+    assert str(raised.value).splitlines() == errors + ["Errors occurred during assembly."]
+
+@needs_perl
+@pytest.mark.parametrize("source, errors", ERRORS)
+def test_errors_like_dlxasm(source, errors, tmp_path):
+    (tmp_path / "error.asm").write_text(source)
+    returncode, output = run_dlxasm(tmp_path / "error.asm", tmp_path, "error")
+
+    assert returncode != 0
+    assert [line for line in output.splitlines() if line in errors] == errors
+
+# Undefined symbols are 0, like in dlxasm.pl, with a warning
+def test_undefined_symbol_is_a_warning():
+    program = assemble(".text\n_main:\n\tj undefined_label\n")
+    assert program.warnings == ["Undefined symbol: undefined_label at line 3"]
+    assert len(program.words()) == 1
@@ -0,0 +1,87 @@
+import shutil
+
+from pathlib import Path
+
+import pytest
+
+import dlx_sim
+
+from assembly_cache import AssemblyCache
+
+PROGRAMS = Path(__file__).resolve().parents[1] / "programs"
+
+ARTIFACTS = ["factorial.bin", "factorial.bin.hdr", "factorial.list", "factorial.mem", "factorial.sym"]
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "src" / "factorial.asm"
+    path.parent.mkdir()
+    shutil.copy(PROGRAMS / "factorial.asm", path)
+    return path
+
+# Stands in for the assembler script, which is only hashed
+@pytest.fixture
+def assembler(tmp_path):
+    path = tmp_path / "assembler.pl"
+    path.write_text("# version 1\n")
+    return path
+
+@pytest.fixture
+def cache(tmp_path, assembler):
+    return AssemblyCache(tmp_path / "asm_cache", assembler)
+
+def assemble(source, outdir, cache):
+    outdir.mkdir(parents=True, exist_ok=True)
+    return dlx_sim.assemble(source, outdir, quiet=True, cache=cache, assembler="python")
+
+def artifacts(outdir):
+    return {name: (outdir / name).read_bytes() for name in ARTIFACTS if (outdir / name).exists()}
+
+def test_hit_restores_the_artifacts_and_the_output(source, cache, tmp_path, capsys):
+    assert assemble(source, tmp_path / "first", cache) is not None
+    first_output = capsys.readouterr().out
+    assert (cache.hits, cache.misses) == (0, 1)
+
+    # Nothing is returned on a hit, as the program didn't get assembled
+    assert assemble(source, tmp_path / "second", cache) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert capsys.readouterr().out == first_output
+
+    assert set(artifacts(tmp_path / "first")) == set(ARTIFACTS)
+    assert artifacts(tmp_path / "second") == artifacts(tmp_path / "first")
+    assert len(list((tmp_path / "asm_cache").iterdir())) == 1
+
+def test_changes_miss(source, cache, assembler, tmp_path):
+    key = cache.key(source)
+    assemble(source, tmp_path / "out", cache)
+
+    source.write_text(source.read_text() + "; a comment\n")
+    changed_source = cache.key(source)
+    assert changed_source != key
+    assert assemble(source, tmp_path / "out", cache) is not None
+
+    assembler.write_text("# version 2\n")
+    changed_assembler = cache.key(source)
+    assert changed_assembler not in (key, changed_source)
+    assert assemble(source, tmp_path / "out", cache) is not None
+
+    # The name of the program goes in the artifacts, so it's part of the key
+    renamed = source.with_name("renamed.asm")
+    shutil.copy(source, renamed)
+    assert cache.key(renamed) != changed_assembler
+
+    assert (cache.hits, cache.misses) == (0, 3)
+    assert len(list((tmp_path / "asm_cache").iterdir())) == 3
+
+def test_store_keeps_the_first_entry(cache, tmp_path):
+    artifact = tmp_path / "program.mem"
+    artifact.write_text("first\n")
+    cache.store("key", [artifact], "output\n")
+    artifact.write_text("second\n")
+    cache.store("key", [artifact], "other output\n")
+
+    outdir = tmp_path / "restored"
+    outdir.mkdir()
+    assert cache.restore("key", outdir) == "output\n"
+    assert (outdir / "program.mem").read_text() == "first\n"
+    assert [path.name for path in (tmp_path / "asm_cache").iterdir()] == ["key"]
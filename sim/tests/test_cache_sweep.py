@@ -0,0 +1,62 @@
+import io
+import random
+
+import numpy as np
+import pytest
+
+from cache_sweep import SETS, WAYS, lru_hits, sweep_cache, write_csv
+from common import CacheSize
+from dlx_emu_cache import CacheModel
+
+# Hits of a LRU cache with the given sets and ways, one access at a time
+def brute_force_lru_hits(lines, sets, ways):
+    stacks = [[] for _ in range(sets)]
+    hits = 0
+    for line in lines:
+        stack = stacks[line % sets]
+        if line in stack:
+            hits += 1
+            stack.remove(line)
+        elif len(stack) == ways:
+            stack.pop()
+        stack.insert(0, line)
+    return hits
+
+# Few distinct lines, so that they get reused at every depth
+@pytest.fixture(params=[0, 1, 2])
+def lines(request):
+    rng = random.Random(request.param)
+    return np.array([rng.randrange(40) for _ in range(2000)], dtype=np.int64)
+
+@pytest.mark.parametrize("sets", [1, 2, 4, 8])
+def test_lru_hits_match_a_lru_cache(lines, sets):
+    hits = lru_hits(lines, sets, 16)
+    assert hits.tolist() == [brute_force_lru_hits(lines.tolist(), sets, ways) for ways in range(1, 17)]
+
+def test_no_reuse_never_hits():
+    assert lru_hits(np.arange(100, dtype=np.int64), 4, 8).tolist() == [0] * 8
+
+# With 2 ways the pseudo-LRU of the RTL is true LRU
+def test_sweep_with_two_ways_matches_the_cache_model(lines):
+    addresses = np.array(lines * 4 + 2, dtype=np.uint32).tobytes()
+    rows = sweep_cache("dcache", addresses)
+    assert len(rows) == len(SETS) * len(WAYS) * 6
+
+    for row in rows:
+        if row["ways"] != 2:
+            continue
+        cache = CacheModel(CacheSize(sets=row["sets"], ways=2, line_size=row["line_size"]))
+        for line in lines.tolist():
+            cache.access(line * 4 + 2)
+        assert (row["accesses"], row["misses"]) == (cache.accesses(), cache.misses)
+        assert row["size_words"] == row["sets"] * 2 * row["line_size"]
+
+# The first row has lines of two words, so 0 and 4 share one
+def test_csv():
+    rows = sweep_cache("icache", np.array([0, 4, 0, 64], dtype=np.uint32).tobytes())
+    output = io.StringIO()
+    write_csv(rows, output)
+
+    lines = output.getvalue().splitlines()
+    assert lines[0] == "cache,sets,ways,line_size,size_words,accesses,misses,hit_rate"
+    assert lines[1] == "icache,1,2,2,4,4,2,50.00"
@@ -0,0 +1,80 @@
+import zlib
+
+from pathlib import Path
+
+import pytest
+
+import dlx_sim
+
+from dlx_assembler import assemble_file
+from dlx_emu_checkpoint import HEADER, REGISTERS, load_checkpoint
+from dlx_emu_cpu import DLXCpu
+from dlx_emulator import EMULATOR_BACKENDS, emulate
+
+PROGRAM = Path(__file__).resolve().parents[1] / "programs" / "matrix_multiply.asm"
+
+MAX_CYCLES = 100_000
+CHECKPOINT_AT = 50
+
+@pytest.fixture(scope="module")
+def words():
+    return assemble_file(PROGRAM).words()
+
+def run(words, dump, **kwargs):
+    success, instructions, trace = emulate(None, 0, MAX_CYCLES, dump, program=words, **kwargs)
+    assert success
+    return instructions, trace
+
+@pytest.fixture
+def checkpoint(words, tmp_path):
+    path = tmp_path / "program.checkpoint"
+    run(words, "", checkpoint_at=CHECKPOINT_AT, checkpoint_path=path)
+    return path
+
+@pytest.mark.parametrize("backend", EMULATOR_BACKENDS)
+def test_resume_gives_the_same_run(words, checkpoint, backend, tmp_path):
+    instructions, trace = run(words, tmp_path / "whole.dump", backend=backend)
+    resumed_instructions, resumed = run(words, tmp_path / "resumed.dump", backend=backend, resume_from=checkpoint)
+
+    assert resumed_instructions == instructions
+    assert resumed.first_index == CHECKPOINT_AT
+    assert list(resumed.initial_registers) == list(trace.registers_at(CHECKPOINT_AT - 1))
+    assert resumed.pcs == trace.pcs[CHECKPOINT_AT:]
+    assert resumed.instructions == trace.instructions[CHECKPOINT_AT:]
+    assert resumed.dests == trace.dests[CHECKPOINT_AT:]
+    assert resumed.values == trace.values[CHECKPOINT_AT:]
+    assert (tmp_path / "resumed.dump").read_text() == (tmp_path / "whole.dump").read_text()
+
+# Each of them turns a valid checkpoint into one that isn't
+CORRUPTIONS = {
+    "empty": lambda data: b"",
+    "header only": lambda data: data[:HEADER.size],
+    "bad magic": lambda data: b"XXXX" + data[4:],
+    "bad version": lambda data: data[:4] + b"\xff\xff" + data[6:],
+    "truncated pages": lambda data: data[:-10],
+    "garbage pages": lambda data: data[:HEADER.size + REGISTERS.size] + b"garbage" * 10,
+    "missing page": lambda data: data[:HEADER.size + REGISTERS.size] + zlib.compress(
+        zlib.decompress(data[HEADER.size + REGISTERS.size:])[:-4]
+    ),
+}
+
+@pytest.fixture(params=CORRUPTIONS, ids=list(CORRUPTIONS))
+def corrupt_checkpoint(request, checkpoint):
+    checkpoint.write_bytes(CORRUPTIONS[request.param](checkpoint.read_bytes()))
+    return checkpoint
+
+def test_corrupt_checkpoint_raises(corrupt_checkpoint):
+    with pytest.raises(ValueError):
+        load_checkpoint(corrupt_checkpoint, DLXCpu)
+
+def test_corrupt_checkpoint_fails_emulation(words, corrupt_checkpoint, capsys):
+    result = emulate(None, 0, MAX_CYCLES, "", program=words, resume_from=corrupt_checkpoint)
+
+    assert result == (False, 0, [])
+    assert str(corrupt_checkpoint) in capsys.readouterr().out
+
+def test_corrupt_checkpoint_fails_run_program(corrupt_checkpoint, sim_dir, tmp_path):
+    result = dlx_sim.run_program(
+        PROGRAM, outdir=tmp_path / "build", should_emulate=True, quiet=True, resume_from=corrupt_checkpoint
+    )
+    assert result == (False, 0, 0, None)
@@ -0,0 +1,122 @@
+from pathlib import Path
+
+import pytest
+
+from dlx_assembler import assemble, assemble_file
+from dlx_emu_blocks import COMPILE_THRESHOLD, DLXBlockCpu
+from dlx_emu_bus import MemoryBus
+from dlx_emu_cpu import DLXCpu, STOP_FINISHED, STOP_MAX_INSTRUCTIONS
+from dlx_emu_trace import EmulatorTrace
+
+PROGRAMS = sorted((Path(__file__).resolve().parents[1] / "programs").glob("*.asm"))
+
+MAX_INSTRUCTIONS = 1_000_000
+
+# Loops 20 times over a block, which gets compiled, and halfway through
+# overwrites its second instruction, so that r5 is incremented by 1 the first
+# 10 times and by 3 after
+SELF_MODIFYING = """
+.text
+    addi r1, r0, 20
+    lw r6, replacement(r0)
+loop:
+    subi r1, r1, 1
+patch:
+    addi r5, r5, 1
+    seqi r3, r1, 10
+    beqz r3, next
+    sw patch(r0), r6
+next:
+    bnez r1, loop
+    sw result(r0), r5
+    lhi r1, #0xFFFF
+    sw 0(r1), r0
+replacement:
+    addi r5, r5, 3
+
+.data 0x400
+result:
+    .space 4
+"""
+
+# Runs the program to the end, in runs of up to chunk instructions, and
+# returns the cpu, its trace and the stop reason of the last run
+def run(cpu_class, words, tracing=True, chunk=MAX_INSTRUCTIONS):
+    cpu = cpu_class(MemoryBus(words), 0)
+    trace = EmulatorTrace(cpu) if tracing else None
+
+    while True:
+        stop_reason, _, _ = cpu.run(chunk, trace)
+        if stop_reason != STOP_MAX_INSTRUCTIONS or cpu.cycle >= MAX_INSTRUCTIONS:
+            return cpu, trace, stop_reason
+
+def dump(cpu, path):
+    cpu.bus.dump(path)
+    return path.read_text()
+
+def assert_same_run(words, tmp_path, tracing=True, chunk=MAX_INSTRUCTIONS):
+    expected_cpu, expected_trace, expected_stop = run(DLXCpu, words, tracing, chunk)
+    cpu, trace, stop = run(DLXBlockCpu, words, tracing, chunk)
+
+    assert stop == expected_stop
+    assert (cpu.pc, cpu.cycle, cpu.instructions_run) == (expected_cpu.pc, expected_cpu.cycle, expected_cpu.instructions_run)
+    assert list(cpu.registers) == list(expected_cpu.registers)
+    assert dump(cpu, tmp_path / "blocks.dump") == dump(expected_cpu, tmp_path / "interpreter.dump")
+
+    if tracing:
+        assert trace.pcs == expected_trace.pcs
+        assert trace.instructions == expected_trace.instructions
+        assert trace.dests == expected_trace.dests
+        assert trace.values == expected_trace.values
+
+    return cpu
+
+@pytest.mark.parametrize("source", PROGRAMS, ids=[path.stem for path in PROGRAMS])
+@pytest.mark.parametrize("tracing", [True, False], ids=["trace", "no-trace"])
+def test_same_as_interpreter(source, tracing, tmp_path):
+    assert_same_run(assemble_file(source).words(), tmp_path, tracing)
+
+# Runs that end in the middle of a block are finished by the interpreter
+@pytest.mark.parametrize("chunk", [1, 7, 100])
+def test_same_as_interpreter_in_chunks(chunk, tmp_path):
+    assert_same_run(assemble_file(PROGRAMS[0].parent / "factorial.asm").words(), tmp_path, chunk=chunk)
+
+@pytest.mark.parametrize("tracing", [True, False], ids=["trace", "no-trace"])
+def test_self_modifying_code(tracing, tmp_path):
+    program = assemble(SELF_MODIFYING)
+    cpu = assert_same_run(program.words(), tmp_path, tracing)
+
+    assert cpu.bus.read(program.symbols["result"]) == 10 * 1 + 10 * 3
+    assert 10 > COMPILE_THRESHOLD
+
+    # Only the blocks still in use are kept for every word they include
+    for word, blocks in cpu.blocks_by_word.items():
+        assert len(blocks) > 0
+        for block in blocks:
+            assert block.valid
+            assert block.start <= word < block.end
+            assert cpu.blocks[block.start] is block
+
+    for block in cpu.blocks.values():
+        for word in range(block.start, block.end, 4):
+            assert block in cpu.blocks_by_word[word]
+
+def test_invalidated_block_is_pruned():
+    program = assemble(SELF_MODIFYING)
+    cpu = DLXBlockCpu(MemoryBus(program.words()), 0)
+    cpu.run(10)
+
+    # The block from loop to beqz, and the first one, which goes on to it
+    patch = program.symbols["patch"]
+    stale = list(cpu.blocks_by_word[patch])
+    assert len(stale) == 2
+
+    cpu.bus.write(patch, cpu.bus.read(program.symbols["replacement"]))
+
+    assert all(not block.valid for block in stale)
+    assert patch not in cpu.blocks_by_word
+    for blocks in cpu.blocks_by_word.values():
+        assert not any(block in stale for block in blocks)
+
+    stop_reason, _, _ = cpu.run(MAX_INSTRUCTIONS)
+    assert stop_reason == STOP_FINISHED
@@ -0,0 +1,72 @@
+import argparse
+
+from pathlib import Path
+
+import pytest
+
+import dlx_sim
+
+from dlx_assembler import assemble_file
+from dlx_emu_btb import BTBModel, BranchRecorder, sweep_btb
+from dlx_emu_timing import PipelineTimingModel
+from dlx_emulator import emulate
+
+PROGRAMS = Path(__file__).resolve().parents[1] / "programs"
+
+# Branches as (pc, taken, target, mispredicted) on a BTB of two lines, whose
+# keys are the pc after the branch
+BRANCHES = [
+    # Not in the BTB, goes in line 0
+    (0x10, True, 0x40, True),
+    (0x10, True, 0x40, False),
+    # New target
+    (0x10, True, 0x80, True),
+    (0x20, False, 0x24, False),
+    # Goes in line 1, filling the BTB
+    (0x20, True, 0x60, True),
+    # Replaces line 0, the first one whose replace bit is clear, and then 1
+    (0x30, True, 0x70, True),
+    (0x10, True, 0x80, True),
+    # All the replace bits are set: they're cleared and line 0 gets replaced
+    (0x20, True, 0x60, True),
+    # Not taken while in the BTB, which invalidates it
+    (0x10, False, 0x14, True),
+    (0x10, False, 0x14, False),
+]
+
+def test_hits_and_mispredictions():
+    btb = BTBModel(lines_width=1)
+    for pc, taken, target, mispredicted in BRANCHES:
+        assert btb.resolve(pc, taken, target) == mispredicted, f"branch at {pc:08X}"
+
+    assert btb.keys == [0x24, 0x14]
+    assert btb.valid == [True, False]
+    assert btb.replaced == [True, False]
+    assert (btb.branches, btb.mispredictions) == (10, 7)
+    assert btb.accuracy() == 30
+
+# The row with the width of the BTB the branches were recorded with is the
+# same as the timing model's estimate
+def test_sweep_matches_the_timing_model():
+    recorder = BranchRecorder(BTBModel())
+    timing = PipelineTimingModel(predictor=recorder)
+    success, _, _ = emulate(None, 0, 100_000, "", program=assemble_file(PROGRAMS / "matrix_multiply.asm").words(), timing=timing)
+    assert success
+
+    rows = sweep_btb(recorder, timing, range(1, 9))
+    assert [row["lines"] for row in rows] == [2, 4, 8, 16, 32, 64, 128, 256]
+    assert all(row["branches"] == timing.branches for row in rows)
+
+    row = rows[3]
+    assert row["lines_width"] == 4
+    assert row["mispredictions"] == timing.mispredictions > 0
+    assert row["cpi"] == timing.cpi()
+
+@pytest.mark.parametrize("min_width, max_width", [(0, 4), (-1, 4), (3, 2)])
+def test_sweep_rejects_invalid_widths(min_width, max_width, monkeypatch, capsys):
+    monkeypatch.setattr(dlx_sim, "run_btb_sweep", lambda **kwargs: pytest.fail("the sweep ran"))
+    args = argparse.Namespace(program_source="programs/factorial.asm", outdir="build", start_address=0,
+        max_cycles=30_000, min_width=min_width, max_width=max_width)
+
+    dlx_sim.btb_sweep_simulation(args)
+    assert f"Invalid BTB width range {min_width}..{max_width}" in capsys.readouterr().out
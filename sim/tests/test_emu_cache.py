@@ -0,0 +1,72 @@
+from common import CacheSize
+from dlx_emu_cache import CacheModel, MemorySystemModel, WriteThroughCacheModel
+
+# A fully associative cache of four one-word lines, so that the address of
+# every word is its tag
+def one_set():
+    return CacheModel(CacheSize(sets=1, ways=4, line_size=1))
+
+def access_words(cache, words):
+    return [cache.access(word * 4) for word in words]
+
+# Misses take the last way whose MRU bit is clear, and once the bits are all
+# set, every one but the way just accessed gets cleared
+def test_pseudo_lru_victims():
+    cache = one_set()
+    A, B, C, D, E, F, G = range(7)
+
+    assert access_words(cache, [A, B, C, D]) == [False] * 4
+    assert cache.tags[0] == [D, C, B, A]
+    assert cache.mru_bits[0] == [True, False, False, False]
+
+    assert access_words(cache, [A]) == [True]
+    assert cache.mru_bits[0] == [True, False, False, True]
+
+    # E replaces B in way 2, F replaces C in way 1, setting all the bits
+    assert access_words(cache, [E, F]) == [False, False]
+    assert cache.tags[0] == [D, F, E, A]
+    assert cache.mru_bits[0] == [False, True, False, False]
+
+    # A got evicted even if it was hit more recently than D
+    assert access_words(cache, [G, D, B]) == [False, True, False]
+    assert cache.tags[0] == [D, F, B, G]
+    assert cache.mru_bits[0] == [False, False, True, False]
+
+    assert (cache.hits, cache.misses, cache.evictions) == (2, 8, 4)
+    assert cache.hit_rate() == 2 / 10 * 100
+
+# Address: | tag | set | word | byte |
+def test_sets_and_lines():
+    cache = WriteThroughCacheModel(CacheSize(sets=2, ways=1, line_size=2))
+
+    assert cache.access(0x00) is False
+    assert cache.access(0x04) is True
+    # Same set, different tag
+    assert cache.access(0x10) is False
+    assert cache.write(0x00) is False
+    # The other set
+    assert cache.write(0x08) is False
+    assert cache.access(0x0C) is True
+
+    assert cache.tags == [[0], [0]]
+    assert (cache.hits, cache.misses, cache.evictions, cache.writes) == (2, 4, 2, 2)
+
+# A word of the default memory takes 2 cycles of transfer, and 2 and 2 on
+# average of stall and wait, and a miss 2 cycles before the line fill starts
+def test_misses_wait_for_the_bus():
+    memory = MemorySystemModel()
+    line_fill = 2 + 8 * 6
+
+    assert memory.fetch(0x00, 0) == line_fill
+    assert memory.fetch(0x1C, line_fill) == 0
+
+    # The bus is still busy with the instruction cache
+    assert memory.load(0x400, 10) == line_fill + (line_fill - 12)
+    assert (memory.bus.contentions, memory.bus.contention_cycles) == (1, line_fill - 12)
+    assert memory.load(0x404, 200) == 0
+
+    # A store that hits still stalls a cycle, and its write-through goes on
+    # after it, until 207, holding up the next store
+    assert memory.store(0x408, 200) == 1
+    assert memory.store(0x40C, 202) == (207 - 202) + 1
+    assert memory.dcache.writes == 2
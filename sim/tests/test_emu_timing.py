@@ -0,0 +1,79 @@
+from pathlib import Path
+
+import pytest
+
+import dlx_emu_timing
+
+from dlx_assembler import assemble, assemble_file
+from dlx_emu_cache import MemorySystemModel
+from dlx_emu_timing import PipelineTimingModel
+from dlx_emulator import emulate
+
+PROGRAMS = Path(__file__).resolve().parents[1] / "programs"
+
+# The add waits a cycle for the lw, and the bnez is mispredicted twice: the
+# first time it's taken it's not in the BTB yet, and then it's not taken. The
+# loop starts with a nop, which only the branch goes to.
+KNOWN = """
+.text
+    addi r1, r0, #2
+    lw r2, value(r0)
+    add r3, r2, r2
+loop:
+    nop
+    subi r1, r1, #1
+    bnez r1, loop
+    lhi r4, #0xFFFF
+    sw 0(r4), r0
+.data 0x400
+value:
+    .word 5
+"""
+
+def counters(timing):
+    return (
+        timing.instructions,
+        timing.nops,
+        timing.execute_cycles,
+        timing.memory_stalls,
+        timing.load_use_stalls,
+        dict(timing.multicycle_stalls),
+        timing.branches,
+        timing.taken_branches,
+        timing.mispredictions,
+        timing.estimated_cycles(),
+    )
+
+def estimate(words, backend="interpreter", verbose=False, memory=None, keep_trace=True):
+    timing = PipelineTimingModel(memory=memory)
+    success, _, _ = emulate(None, 0, 1_000_000, "", verbose=verbose, backend=backend, keep_trace=keep_trace,
+        program=words, timing=timing)
+    assert success
+    return timing
+
+@pytest.mark.parametrize("backend", ["interpreter", "blocks"])
+def test_estimate_of_a_known_program(backend):
+    timing = estimate(assemble(KNOWN).words(), backend)
+
+    assert (timing.instructions, timing.nops) == (9, 2)
+    assert timing.load_use_stalls == 1
+    assert (timing.branches, timing.taken_branches, timing.mispredictions) == (2, 1, 2)
+    # 11 instructions, the load-use stall, two flushes and the pipeline fill
+    assert timing.estimated_cycles() == 11 + 1 + 2 * 3 + 3
+    assert timing.cpi() == 21 / 9
+
+# Going through the trace columns, whole or in chunks split anywhere when the
+# trace isn't kept, gives the same as going through the instructions one at a
+# time
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 65536])
+@pytest.mark.parametrize("program", ["factorial", "matrix_multiply", "multicycle", "jump_before_mult"])
+def test_trace_gives_the_same_as_one_at_a_time(program, chunk_size, monkeypatch, capsys):
+    words = assemble_file(PROGRAMS / f"{program}.asm").words()
+    one_at_a_time = estimate(words, verbose=True, memory=MemorySystemModel())
+    capsys.readouterr()
+
+    monkeypatch.setattr(dlx_emu_timing, "TIMING_CHUNK_SIZE", chunk_size)
+    for backend in ["interpreter", "blocks"]:
+        for keep_trace in [True, False]:
+            timing = estimate(words, backend, memory=MemorySystemModel(), keep_trace=keep_trace)
+            assert counters(timing) == counters(one_at_a_time)
@@ -0,0 +1,137 @@
+from pathlib import Path
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from dlx_assembler import assemble, assemble_file
+from dlx_emu_bus import MemoryBus
+from dlx_emu_cpu import DLXCpu
+from dlx_emu_vector import VectorDLXCpu
+
+PROGRAMS_DIR = Path(__file__).resolve().parents[1] / "programs"
+
+INSTANCES = 200
+
+# Goes around a loop a number of times that depends on the inputs, with most
+# instructions, branches that go different ways in every instance, a call,
+# byte and halfword accesses, and code that half of the instances overwrite.
+# The instances where input & 7 == 7 end at an invalid instruction.
+MIXED = """
+.text
+    lw r1, input(r0)
+    lw r2, input2(r0)
+    andi r3, r1, 31
+    addi r4, r0, 0
+    andi r20, r2, 1
+    beqz r20, loop
+    lw r21, replacement(r0)
+    sw patch(r0), r21
+loop:
+    beqz r3, done
+    subi r3, r3, 1
+    slt r5, r1, r2
+    sgtu r6, r1, r2
+    add r4, r4, r5
+    sub r4, r4, r6
+patch:
+    xor r1, r1, r2
+    slli r7, r1, 3
+    srai r8, r2, 2
+    sra r9, r1, r3
+    srl r10, r2, r3
+    or r2, r7, r8
+    add r2, r2, r9
+    sub r2, r2, r10
+    ori r11, r3, 1
+    idiv r12, r1, r11
+    imod r13, r2, r11
+    imul r4, r4, r11
+    add r4, r4, r12
+    xor r4, r4, r13
+    sb buffer(r3), r1
+    slli r14, r3, 1
+    sh halves(r14), r2
+    lb r15, buffer(r3)
+    lhu r16, halves(r14)
+    lbu r17, buffer(r3)
+    lh r18, halves(r14)
+    add r4, r4, r15
+    add r4, r4, r16
+    sub r4, r4, r17
+    xor r4, r4, r18
+    sgei r19, r4, -100
+    bnez r19, loop
+    jal bump
+    j loop
+bump:
+    addi r4, r4, 1000
+    jr r31
+done:
+    sw result(r0), r4
+    andi r20, r1, 7
+    seqi r20, r20, 7
+    bnez r20, invalid
+    lhi r1, #0xFFFF
+    sw 0(r1), r0
+invalid:
+    .word 0xFFFFFFFF
+replacement:
+    add r1, r1, r2
+
+.data 0x400
+input:
+    .space 4
+input2:
+    .space 4
+result:
+    .space 4
+buffer:
+    .space 32
+halves:
+    .space 64
+end:
+"""
+
+# Runs every instance on its own DLXCpu, with the same memory as in the
+# VectorDLXCpu, and checks that it ended the same way
+def assert_same_as_interpreter(vector, words, max_cycles):
+    stop_reasons = vector.run(max_cycles)
+
+    for i in range(vector.instances):
+        cpu = DLXCpu(MemoryBus(words[i].tolist()), 0)
+        stop_reason, _, _ = cpu.run(max_cycles)
+
+        assert stop_reasons[i] == stop_reason, i
+        assert (int(vector.pc[i]), int(vector.cycle[i]), int(vector.instructions_run[i])) == (cpu.pc, cpu.cycle, cpu.instructions_run), i
+        assert vector.registers[i].tolist() == list(cpu.registers), i
+        assert vector.memory[i].tolist() == [cpu.bus.read(addr) for addr in range(0, vector.memory_words * 4, 4)], i
+
+    return stop_reasons
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+@pytest.mark.parametrize("max_cycles", [100_000, 600, 50])
+def test_mixed_program(seed, max_cycles):
+    program = assemble(MIXED)
+    rng = np.random.default_rng(seed)
+
+    vector = VectorDLXCpu.from_words(program.words(), INSTANCES, memory_words=program.symbols["end"] // 4)
+    vector.write_words(program.symbols["input"], rng.integers(0, 1 << 32, size=(INSTANCES, 2), dtype=np.uint32))
+    words = vector.memory.copy()
+
+    stop_reasons = assert_same_as_interpreter(vector, words, max_cycles)
+
+    if max_cycles == 100_000:
+        assert set(stop_reasons) == {"finished", "invalid_instruction"}
+    elif max_cycles == 600:
+        assert "max_instructions" in stop_reasons and "finished" in stop_reasons
+
+def test_matrix_multiply():
+    program = assemble_file(PROGRAMS_DIR / "matrix_multiply.asm")
+    rng = np.random.default_rng(3)
+
+    vector = VectorDLXCpu.from_words(program.words(), INSTANCES, memory_words=0x440 // 4)
+    vector.write_words(program.symbols["mat_a"], rng.integers(-1000, 1000, size=(INSTANCES, 8)).astype(np.uint32))
+    words = vector.memory.copy()
+
+    assert set(assert_same_as_interpreter(vector, words, 30_000)) == {"finished"}
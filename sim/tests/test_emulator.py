@@ -0,0 +1,72 @@
+import pytest
+
+from dlx_assembler import assemble
+from dlx_emu_timing import PipelineTimingModel
+from dlx_emulator import emulate
+from trace_file import TextTraceSink
+
+# Runs three instructions and then an invalid one at 0000000C
+INVALID = """
+.text
+    addi r1, r0, 1
+    addi r2, r0, 2
+    add r3, r1, r2
+    .word 0xFFFFFFFF
+    lhi r1, #0xFFFF
+    sw 0(r1), r0
+"""
+
+# Never finishes
+ENDLESS = """
+.text
+loop:
+    addi r1, r1, 1
+    j loop
+"""
+
+FINISHES = """
+.text
+    addi r1, r0, 1
+    lhi r1, #0xFFFF
+    sw 0(r1), r0
+"""
+
+# The ways emulate can run the program, which all have their own loop
+MODES = {
+    "interpreter": lambda tmp_path: {},
+    "blocks": lambda tmp_path: {"backend": "blocks"},
+    "verbose": lambda tmp_path: {"verbose": True},
+    "timing": lambda tmp_path: {"timing": PipelineTimingModel()},
+    "streamed": lambda tmp_path: {"trace_sink": TextTraceSink(tmp_path / "emulator.trace")},
+    "streamed verbose": lambda tmp_path: {"verbose": True, "trace_sink": TextTraceSink(tmp_path / "emulator.trace")},
+}
+
+def run(source, tmp_path, mode, max_cycles=1000):
+    return emulate(None, 0, max_cycles, "", program=assemble(source).words(), **MODES[mode](tmp_path))
+
+@pytest.mark.parametrize("mode", MODES)
+def test_invalid_instruction(mode, tmp_path, capsys):
+    success, instructions, _ = run(INVALID, tmp_path, mode)
+
+    assert not success
+    assert instructions == 4
+    out = capsys.readouterr().out
+    assert "ERROR: The emulation stopped at an invalid instruction at pc 0000000C." in out
+    assert "went over" not in out
+
+@pytest.mark.parametrize("mode", MODES)
+def test_max_cycles(mode, tmp_path, capsys):
+    success, _, _ = run(ENDLESS, tmp_path, mode, max_cycles=100)
+
+    assert not success
+    out = capsys.readouterr().out
+    assert "ERROR: The simulation went over 100 cycles." in out
+    assert "invalid instruction" not in out
+
+# The last instruction is the store that finishes, not one past the cycles
+@pytest.mark.parametrize("mode", MODES)
+def test_finishes_on_the_last_cycle(mode, tmp_path):
+    success, instructions, _ = run(FINISHES, tmp_path, mode, max_cycles=3)
+
+    assert success
+    assert instructions == 3
@@ -0,0 +1,123 @@
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+import dlx_sim
+
+from dlx_assembler import assemble_file
+from dlx_emu_bus import MASK, WRITE_FLAG, RecordingMemoryBus
+from dlx_emu_cpu import DLXCpu
+from dlx_emulator import emulate
+from memory_profile import TERMINATION_ADDRESS
+
+PROGRAM = Path(__file__).resolve().parents[1] / "programs" / "matrix_multiply.asm"
+
+MAX_CYCLES = 100_000
+LINE_SIZE = 4
+CHECKPOINT_AT = 50
+
+@pytest.fixture(scope="module")
+def program():
+    return assemble_file(PROGRAM)
+
+@pytest.fixture
+def make_profile(program, tmp_path):
+    program.save(tmp_path, "program")
+    return lambda: dlx_sim.make_memory_profile(LINE_SIZE, tmp_path / "program.list", tmp_path / "program.mem")
+
+# Runs the program on a RecordingMemoryBus that passes every chunk_size
+# accesses to fold
+def record(program, fold, chunk_size):
+    bus = RecordingMemoryBus(program.words(), fold, chunk_size)
+    cpu = DLXCpu(bus, 0)
+    cpu.run(MAX_CYCLES)
+    assert bus.is_finished()
+    bus.flush()
+
+def counts_of(profile):
+    rows, other = profile.symbol_rows()
+    return (
+        profile.words.tolist(),
+        profile.word_reads.tolist(),
+        profile.word_writes.tolist(),
+        profile.lines.tolist(),
+        profile.line_reads.tolist(),
+        profile.line_writes.tolist(),
+        rows,
+        other,
+    )
+
+def test_chunks_never_grow_past_the_chunk_size(program):
+    sizes = []
+    record(program, lambda accesses: sizes.append(len(accesses)), 7)
+
+    assert len(sizes) > 1
+    assert max(sizes) == 7
+
+def test_counts_match_the_accesses(program, make_profile):
+    accesses = []
+    record(program, accesses.extend, 7)
+    profile = make_profile()
+    record(program, profile.add, 7)
+
+    addresses = [access & MASK for access in accesses if access & MASK < TERMINATION_ADDRESS]
+    writes = [access & WRITE_FLAG != 0 for access in accesses if access & MASK < TERMINATION_ADDRESS]
+    reads_of = Counter(address >> 2 for address, write in zip(addresses, writes) if not write)
+    writes_of = Counter(address >> 2 for address, write in zip(addresses, writes) if write)
+    words = sorted(set(reads_of) | set(writes_of))
+
+    assert profile.reads() == sum(reads_of.values())
+    assert profile.writes() == sum(writes_of.values())
+    assert profile.words.tolist() == words
+    assert profile.word_reads.tolist() == [reads_of[word] for word in words]
+    assert profile.word_writes.tolist() == [writes_of[word] for word in words]
+    assert profile.lines.tolist() == sorted({word // LINE_SIZE for word in words})
+
+    # The strides of every symbol, from its accesses in order
+    rows, other = profile.symbol_rows()
+    assert other is None
+    for row in rows:
+        end = row["start"] + row["size_words"] * 4
+        inside = [address for address in addresses if row["start"] <= address < end]
+        strides = Counter(b - a for a, b in zip(inside, inside[1:]))
+        assert row["stride_total"] == len(inside) - 1
+        assert row["strides"] == sorted(strides.items(), key=lambda item: (-item[1], item[0]))[:len(row["strides"])]
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1000])
+def test_chunks_give_the_same_profile(program, make_profile, chunk_size):
+    whole = make_profile()
+    success, _, _ = emulate(None, 0, MAX_CYCLES, "", program=program.words(), memory_profile=whole)
+    assert success
+    chunked = make_profile()
+    record(program, chunked.add, chunk_size)
+
+    assert whole.reads() > 0
+    assert counts_of(chunked) == counts_of(whole)
+
+def test_checkpoint_drops_the_accesses_before_it(program, make_profile, tmp_path):
+    checkpointed = make_profile()
+    emulate(None, 0, MAX_CYCLES, "", program=program.words(), checkpoint_at=CHECKPOINT_AT,
+        checkpoint_path=tmp_path / "program.checkpoint", memory_profile=checkpointed)
+    resumed = make_profile()
+    emulate(None, 0, MAX_CYCLES, "", program=program.words(), resume_from=tmp_path / "program.checkpoint",
+        memory_profile=resumed)
+    whole = make_profile()
+    emulate(None, 0, MAX_CYCLES, "", program=program.words(), memory_profile=whole)
+
+    assert counts_of(checkpointed) == counts_of(resumed)
+    assert checkpointed.reads() + checkpointed.writes() < whole.reads() + whole.writes()
+
+def test_report_and_csv_match_the_counts(program, make_profile, tmp_path, capsys):
+    profile = make_profile()
+    record(program, profile.add, 7)
+    profile.print_report()
+    profile.write_csv(tmp_path / "program.memory.csv")
+
+    assert f"Loads: {profile.reads()}, stores: {profile.writes()}" in capsys.readouterr().out
+    lines = (tmp_path / "program.memory.csv").read_text().splitlines()[1:]
+    assert len(lines) == len(profile.words)
+    assert sum(int(line.split(",")[3]) for line in lines) == profile.reads()
+    assert sum(int(line.split(",")[4]) for line in lines) == profile.writes()
+    assert np.array_equal(np.array([int(line.split(",")[0], 16) >> 2 for line in lines]), profile.words)
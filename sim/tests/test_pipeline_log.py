@@ -0,0 +1,98 @@
+import pytest
+
+from pipeline_log import PipelineCycle, PipelineTracker, StallHotSpots, process_pipeline_log
+
+# The lw at 00 feeds the instruction at 04, which waits a cycle in execute for
+# it. The branch at 08 is mispredicted, flushing the three instructions after
+# it, and the target at 40 is followed by a miss in the instruction cache.
+LOG = """
+0 . ..... 00000000 - - - -
+1 . ..... 00000004 00000000 - - -
+2 . ..... 00000008 00000004 00000000 - -
+3 L SSSF. 0000000C 00000008 00000004 00000000 -
+4 . ..... 0000000C 00000008 00000004 - 00000000
+5 . ..... 00000010 0000000C 00000008 00000004 -
+6 B FFF.. 00000014 00000010 0000000C 00000008 00000004
+7 . ..... 00000040 - - - 00000008
+8 I S.... 00000044 00000040 - - -
+9 . ..... 00000044 - 00000040 - -
+"""
+
+def cycles():
+    return [PipelineCycle.parse(line) for line in LOG.strip().splitlines()]
+
+@pytest.fixture
+def events():
+    events = []
+    tracker = PipelineTracker(lambda kind, instruction, cycle: events.append((kind, instruction.pc, instruction.stage, cycle)))
+    for current in cycles():
+        tracker.feed(current)
+    tracker.finish(10)
+    return events
+
+def test_parse():
+    current = PipelineCycle.parse("3 L SSSF. 0000000C 00000008 00000004 00000000 -")
+    assert (current.cycle, current.cause, current.flags) == (3, "L", "SSSF.")
+    assert current.pcs == [0x0C, 0x08, 0x04, 0x00, None]
+
+def test_instructions_retire_in_order(events):
+    assert [(pc, cycle) for kind, pc, _, cycle in events if kind == "retire"] == [
+        (0x00, 5),
+        (0x04, 7),
+        (0x08, 8),
+    ]
+
+def test_mispredict_flushes_the_instructions_after_the_branch(events):
+    flushed = [(pc, stage, cycle) for kind, pc, stage, cycle in events if kind == "flush"]
+    assert sorted(flushed[:3]) == [(0x0C, 2, 7), (0x10, 1, 7), (0x14, 0, 7)]
+    # Then the ones left in the pipeline at the end
+    assert sorted(flushed[3:]) == [(0x40, 2, 10), (0x44, 0, 10)]
+
+# A stalled instruction stays in its stage, and the load moves on leaving a
+# bubble behind it
+def test_stalls_keep_the_instruction_in_its_stage(events):
+    def stages(pc):
+        return [(stage, cycle) for kind, event_pc, stage, cycle in events if kind == "start" and event_pc == pc]
+
+    assert stages(0x00) == [(0, 0), (1, 1), (2, 2), (3, 3), (4, 4)]
+    assert stages(0x04) == [(0, 1), (1, 2), (2, 3), (3, 5), (4, 6)]
+    assert stages(0x40) == [(0, 7), (1, 8), (2, 9)]
+    assert stages(0x44) == [(0, 8)]
+    assert [kind for kind, pc, _, _ in events if pc == 0x44] == ["fetch", "start", "end", "flush"]
+
+def test_hot_spots_charge_the_stage_of_the_cause():
+    hot_spots = StallHotSpots()
+    for current in cycles():
+        hot_spots.feed(current)
+
+    assert hot_spots.cycles == 10
+    assert hot_spots.by_cause == {"L": 1, "B": 1, "I": 1}
+    assert hot_spots.by_pc == {0x04: {"L": 1}, 0x08: {"B": 1}, 0x44: {"I": 1}}
+
+def test_konata(tmp_path, capsys):
+    (tmp_path / "pipeline.log").write_text(LOG)
+    hot_spots = process_pipeline_log(tmp_path / "pipeline.log", tmp_path / "pipeline.kanata")
+
+    assert "Cycles: 10, stalled or flushed: 3 (30.00 %)" in capsys.readouterr().out
+    assert hot_spots.by_cause["B"] == 1
+
+    lines = (tmp_path / "pipeline.kanata").read_text().splitlines()
+    assert lines[:6] == [
+        "Kanata\t0004",
+        "C=\t0",
+        "I\t0\t0\t0",
+        "L\t0\t0\t00000000",
+        "S\t0\t0\tF",
+        "C\t1",
+    ]
+    # Retired instructions are numbered in order, flushed ones by their id
+    assert [line for line in lines if line.startswith("R")] == [
+        "R\t0\t0\t0",
+        "R\t5\t5\t1",
+        "R\t4\t4\t1",
+        "R\t3\t3\t1",
+        "R\t1\t1\t0",
+        "R\t2\t2\t0",
+        "R\t7\t7\t1",
+        "R\t6\t6\t1",
+    ]
@@ -0,0 +1,101 @@
+import pytest
+
+from dlx_assembler import assemble
+from dlx_emulator import emulate
+from listing import ProgramListing
+from profiler import Profile
+
+# main calls double twice, and double calls inc, then main ends the program
+CALLS = """
+.text
+main:
+    addi r1, r0, #1
+    jal double
+    jal double
+    lhi r2, #0xFFFF
+    sw 0(r2), r0
+double:
+    add r1, r1, r1
+    add r20, r31, r0
+    jal inc
+    add r31, r20, r0
+    jr r31
+inc:
+    addi r1, r1, #1
+    jr r31
+"""
+
+MAIN, DOUBLE, INC = 0x00, 0x14, 0x28
+
+@pytest.fixture
+def listing(tmp_path):
+    assemble(CALLS).save(tmp_path, "calls")
+    return ProgramListing.load(tmp_path / "calls.list")
+
+@pytest.fixture(params=["interpreter", "blocks"])
+def profile(request):
+    profile = Profile()
+    success, _, _ = emulate(None, 0, 1000, "", backend=request.param, program=assemble(CALLS).words(), profile=profile)
+    assert success
+    return profile
+
+def test_pc_counts(profile):
+    main = {MAIN: 1, MAIN + 4: 1, MAIN + 8: 1, MAIN + 12: 1, MAIN + 16: 1}
+    double = {DOUBLE + 4 * i: 2 for i in range(5)}
+    inc = {INC: 2, INC + 4: 2}
+    assert profile.pc_counts == {**main, **double, **inc}
+    assert profile.total() == 19
+    assert profile.instructions[INC + 4] == assemble("jr r31").words()[0]
+
+# Self counts go to the function on top of the stack, total ones to every
+# function in it
+def test_function_counts(profile):
+    assert profile.calls == {DOUBLE: 2, INC: 2}
+    assert profile.stack_counts == {
+        (MAIN,): 5,
+        (MAIN, DOUBLE): 10,
+        (MAIN, DOUBLE, INC): 4,
+    }
+
+    exclusive, inclusive = profile.function_counts()
+    assert exclusive == {MAIN: 5, DOUBLE: 10, INC: 4}
+    assert inclusive == {MAIN: 19, DOUBLE: 14, INC: 4}
+
+def test_collapsed_stacks(profile, listing, tmp_path):
+    profile.write_collapsed_stacks(tmp_path / "calls.stacks", listing)
+    assert (tmp_path / "calls.stacks").read_text().splitlines() == [
+        "main 5",
+        "main;double 10",
+        "main;double;inc 4",
+    ]
+
+# Every instruction gets its count in front of it, labels and directives none
+def test_annotated_listing(profile, listing, tmp_path):
+    profile.write_annotated_listing(tmp_path / "calls.list", tmp_path / "calls.profile.list", listing)
+
+    lines = (tmp_path / "calls.profile.list").read_text(encoding="latin-1").splitlines()
+    assert lines[0].startswith("     count      %  ")
+    assert lines[3] == "         1   5.26      4  00000000  20010001\taddi r1, r0, #1"
+    assert lines[8] == "                       9  00000014          \tdouble:"
+    assert lines[9] == "         2  10.53     10  00000014  00210820\tadd r1, r1, r1"
+
+    counted = [line for line in lines[1:] if line[:10].strip() != ""]
+    assert [int(line[:10]) for line in counted] == [profile.pc_counts[pc] for pc in sorted(profile.pc_counts)]
+
+def test_basic_blocks(profile, listing):
+    assert profile.basic_blocks(listing) == [
+        (MAIN, 2, 1),
+        (MAIN + 8, 1, 1),
+        (MAIN + 12, 2, 1),
+        (DOUBLE, 3, 2),
+        (DOUBLE + 12, 2, 2),
+        (INC, 2, 2),
+    ]
+
+def test_report(profile, listing, capsys):
+    profile.print_report(listing)
+    out = capsys.readouterr().out
+
+    assert "Instructions executed: 19" in out
+    assert "        10  52.63%         14  73.68%        2  double" in out
+    assert "         4  21.05%          4  21.05%        2  inc" in out
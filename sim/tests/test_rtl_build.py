@@ -0,0 +1,141 @@
+from pathlib import Path
+
+import pytest
+
+import rtl_build
+
+# consts <- alu <- top <- tb, with other on its own. The comment in other
+# mentions alu, which doesn't make it depend on it.
+SOURCES = {
+    "consts.vhd": """
+package consts is
+    constant NBIT: integer := 32;
+end package consts;
+
+package body consts is
+end package body consts;
+""",
+    "alu.vhd": """
+library ieee;
+use work.consts.all;
+
+entity ALU is
+end ALU;
+""",
+    "top.vhd": """
+entity top is
+end top;
+
+architecture Structural of top is
+    component ALU is
+    end component;
+begin
+end Structural;
+""",
+    "other.vhd": """
+-- Not the same as work.alu
+entity other is
+end other;
+""",
+}
+
+SOURCES_TB = {
+    "tb.vhd": """
+entity tb is
+end tb;
+
+architecture test of tb is
+begin
+    dut: entity work.top;
+end test;
+""",
+}
+
+class Tree:
+    def __init__(self, tmp_path):
+        self.dir = tmp_path
+        self.work_library = tmp_path / "work"
+        self.work_library.mkdir()
+
+        for name, source in {**SOURCES, **SOURCES_TB}.items():
+            (tmp_path / name).write_text(source)
+        (tmp_path / "sources.f").write_text("".join(f"{tmp_path / name}\n" for name in SOURCES))
+        (tmp_path / "sources_tb.f").write_text("".join(f"{tmp_path / name}\n" for name in SOURCES_TB))
+
+    def plan(self, enable_coverage=False):
+        return rtl_build.plan_compile(self.work_library, enable_coverage,
+            self.dir / "sources.f", self.dir / "sources_tb.f")
+
+    def compiled(self, enable_coverage=False):
+        self.plan(enable_coverage).mark_compiled()
+
+    def names(self, plan):
+        return [Path(path).name for path in plan.sources], [Path(path).name for path in plan.sources_tb]
+
+    def touch(self, name):
+        path = self.dir / name
+        path.write_text(path.read_text() + "-- changed\n")
+
+@pytest.fixture
+def tree(tmp_path):
+    return Tree(tmp_path)
+
+def test_design_units(tree):
+    assert rtl_build.design_units(tree.dir / "consts.vhd") == ({"consts"}, set())
+    assert rtl_build.design_units(tree.dir / "alu.vhd") == ({"alu"}, {"consts"})
+    assert rtl_build.design_units(tree.dir / "top.vhd") == ({"top"}, {"alu"})
+    assert rtl_build.design_units(tree.dir / "other.vhd") == ({"other"}, set())
+
+def test_everything_compiles_the_first_time(tree):
+    plan = tree.plan()
+    assert tree.names(plan) == (list(SOURCES), list(SOURCES_TB))
+    plan.mark_compiled()
+    assert tree.plan().is_empty()
+
+@pytest.mark.parametrize("name, expected", [
+    ("other.vhd", (["other.vhd"], [])),
+    ("tb.vhd", ([], ["tb.vhd"])),
+    ("top.vhd", (["top.vhd"], ["tb.vhd"])),
+    ("alu.vhd", (["alu.vhd", "top.vhd"], ["tb.vhd"])),
+    ("consts.vhd", (["consts.vhd", "alu.vhd", "top.vhd"], ["tb.vhd"])),
+])
+def test_a_change_recompiles_the_dependents(tree, name, expected):
+    tree.compiled()
+    tree.touch(name)
+
+    plan = tree.plan()
+    assert tree.names(plan) == expected
+    assert plan.file_count() == len(expected[0]) + len(expected[1])
+
+    plan.mark_compiled()
+    assert tree.plan().is_empty()
+
+def test_coverage_or_a_missing_library_recompiles_everything(tree):
+    tree.compiled()
+    assert tree.plan(enable_coverage=True).file_count() == 5
+
+    tree.compiled(enable_coverage=True)
+    assert tree.plan(enable_coverage=True).is_empty()
+    assert tree.plan(enable_coverage=False).file_count() == 5
+
+    tree.work_library.rmdir()
+    assert tree.plan(enable_coverage=True).file_count() == 5
+
+# A compilation that doesn't finish leaves its files to compile again
+def test_pending_files_compile_again(tree):
+    tree.compiled()
+    tree.touch("alu.vhd")
+    tree.plan().mark_pending()
+
+    assert tree.names(tree.plan()) == (["alu.vhd", "top.vhd"], ["tb.vhd"])
+    assert rtl_build.load_manifest(tree.work_library)["hashes"].keys() == {
+        str(tree.dir / name) for name in ["consts.vhd", "other.vhd"]
+    }
+
+def test_tcl_commands(tree):
+    tree.compiled()
+    tree.touch("top.vhd")
+    assert tree.plan().tcl_commands() == [
+        f"quietly set COMPILE_SOURCES {{{{{tree.dir / 'top.vhd'}}}}}",
+        f"quietly set COMPILE_SOURCES_TB {{{{{tree.dir / 'tb.vhd'}}}}}",
+    ]
@@ -0,0 +1,186 @@
+import re
+
+from pathlib import Path
+
+import pytest
+
+from dlx_assembler import assemble_file
+from dlx_emulator import emulate
+from simulator import PerformanceCounters, ReferenceTrace, SimulationOutput
+
+MAX_CYCLES = 10000
+
+@pytest.fixture(scope="module")
+def program():
+    return assemble_file(Path(__file__).resolve().parents[1] / "programs" / "factorial.asm").words()
+
+def run_emulator(program, **kwargs):
+    success, _, trace = emulate(None, 0, MAX_CYCLES, "", program=program, **kwargs)
+    assert success
+    return trace
+
+@pytest.fixture(scope="module")
+def emulator_trace(program):
+    return run_emulator(program)
+
+def instruction_lines(index, name):
+    return [f"# ** Note: [{index}] {name}_op\n", f"#    Time: {index * 10} ns  Iteration: 0  Instance: /tb_dlx\n"]
+
+def heartbeat_lines(cycle):
+    return [f"# ** Note: Heartbeat: {cycle}\n", f"#    Time: {cycle * 10} ns  Iteration: 0  Instance: /tb_dlx\n"]
+
+def trace_lines(names, diverge_at=None):
+    lines = []
+    for index, name in enumerate(names):
+        if index == diverge_at:
+            name = "sub" if name != "sub" else "add"
+        lines += instruction_lines(index, name)
+    return lines
+
+def names(trace):
+    return [instruction.get_name() for instruction in trace]
+
+# Feeds the lines until the output says to stop. Returns how many were fed.
+def feed(output, lines):
+    for i, line in enumerate(lines):
+        if not output.feed(line):
+            return i + 1
+    return len(lines)
+
+def test_matching_trace_runs_to_the_end(emulator_trace):
+    output = SimulationOutput(quiet=True, reference=ReferenceTrace(emulator_trace))
+    lines = trace_lines(names(emulator_trace)) + ["# Instructions ran: 10\n", "# Cycles taken: 20\n", "# Simulation Finished!\n"]
+
+    assert feed(output, lines) == len(lines)
+    assert output.abort_reason is None
+    assert output.result()[0]
+
+@pytest.mark.parametrize("diverge_at", [0, 7, 20])
+def test_divergence_stops_at_the_instruction(emulator_trace, diverge_at):
+    expected = names(emulator_trace)
+    output = SimulationOutput(quiet=True, reference=ReferenceTrace(emulator_trace))
+
+    assert feed(output, trace_lines(expected, diverge_at)) == 2 * diverge_at + 1
+    assert output.abort_reason.startswith(f"The cpu diverges from the emulator at instruction {diverge_at}:")
+    assert f"emulator = {expected[diverge_at]}" in output.abort_reason
+    assert len(output.execution_trace) == diverge_at + 1
+    assert output.result()[0] is False
+
+def test_final_instructions_are_not_checked(emulator_trace):
+    # The simulation stops at the final lhi and sw, which might not retire
+    output = SimulationOutput(quiet=True, reference=ReferenceTrace(emulator_trace))
+    last = len(emulator_trace) - 2
+    assert feed(output, trace_lines(names(emulator_trace), diverge_at=last)) == 2 * len(emulator_trace)
+    assert output.abort_reason is None
+
+def test_hang_across_two_heartbeats(emulator_trace):
+    reference = ReferenceTrace(emulator_trace, watchdog_cycles=100)
+    output = SimulationOutput(quiet=True, reference=reference)
+    lines = trace_lines(names(emulator_trace)[:4])
+
+    # A heartbeat after some instructions retired is fine, the second one
+    # without any in between isn't
+    assert feed(output, lines + heartbeat_lines(100)) == len(lines) + 2
+    assert output.abort_reason is None
+    assert not output.feed(heartbeat_lines(200)[0])
+    assert output.abort_reason == (
+        f"The cpu retired no instructions in the 100 cycles before cycle 200, while the emulator ran {reference.last_index - 4} more"
+    )
+
+def test_heartbeats_with_progress_or_after_the_end(emulator_trace):
+    output = SimulationOutput(quiet=True, reference=ReferenceTrace(emulator_trace, watchdog_cycles=100))
+
+    lines = []
+    for index, name in enumerate(names(emulator_trace)):
+        lines += instruction_lines(index, name) + heartbeat_lines((index + 1) * 100)
+    # Once it got to the end, the cpu has nothing left to retire
+    lines += heartbeat_lines(100000) + heartbeat_lines(100100)
+
+    assert feed(output, lines) == len(lines)
+    assert output.abort_reason is None
+
+def test_resume_from_checkpoint_checks_from_first_index(program, emulator_trace, tmp_path):
+    start = 10
+    checkpoint = tmp_path / "checkpoint"
+    resumed = run_emulator(program, checkpoint_at=start, checkpoint_path=checkpoint)
+    assert resumed.first_index == start
+    assert names(resumed) == names(emulator_trace)[start:]
+
+    reference = ReferenceTrace(resumed)
+    assert reference.name(start) == names(emulator_trace)[start]
+    assert reference.name(start - 1) == ""
+
+    # The cpu runs the whole program, but only what's after the checkpoint is
+    # compared
+    output = SimulationOutput(quiet=True, reference=reference)
+    assert feed(output, trace_lines(names(emulator_trace), diverge_at=start - 1)) == 2 * len(emulator_trace)
+    assert output.abort_reason is None
+
+    output = SimulationOutput(quiet=True, reference=ReferenceTrace(resumed))
+    assert feed(output, trace_lines(names(emulator_trace), diverge_at=start + 3)) == 2 * (start + 3) + 1
+    assert output.abort_reason.startswith(f"The cpu diverges from the emulator at instruction {start + 3}:")
+
+@pytest.mark.parametrize("report", [
+    "# ** Note: Heartbeat: 100\n",
+    "# ** Note: State hash: 8 0123ABCD r1=00000002\n",
+])
+def test_time_line_after_report_is_skipped(report, capsys):
+    output = SimulationOutput(show_vsim_output=True)
+
+    assert output.feed(report)
+    assert output.feed("#    Time: 1000 ns  Iteration: 0  Instance: /tb_dlx\n")
+    assert output.feed("#    Time: 1010 ns  Iteration: 0  Instance: /tb_dlx\n")
+    assert capsys.readouterr().out == "#    Time: 1010 ns  Iteration: 0  Instance: /tb_dlx\n"
+
+def test_instruction_right_after_report_is_not_skipped():
+    output = SimulationOutput(quiet=True)
+
+    for line in heartbeat_lines(100)[:1] + instruction_lines(0, "add") + ["# ** Note: State hash: 1 0123ABCD r1=00000002\n"] + instruction_lines(1, "sub"):
+        assert output.feed(line)
+    assert names(output.execution_trace) == ["add", "sub"]
+
+COUNTERS_LINE = (
+    "# ** Note: Performance counters: icache_hits=900 icache_misses=100 dcache_hits=30 dcache_misses=10"
+    " btb_hits=7 btb_mispredictions=3 dcache_stall_cycles=40 icache_stall_cycles=500 load_stall_cycles=6"
+    " multicycle_stall_cycles=16 multicycle_busy_cycles=17 bus_wait_cycles=2\n"
+)
+
+def test_counters_are_parsed():
+    counters = PerformanceCounters.parse(COUNTERS_LINE.split("Performance counters:")[1])
+
+    assert [getattr(counters, name) for name in PerformanceCounters.NAMES] == [900, 100, 30, 10, 7, 3, 40, 500, 6, 16, 17, 2]
+    assert counters.icache_miss_rate() == 0.1
+    assert counters.dcache_miss_rate() == 0.25
+    assert counters.stall_cycles() == 40 + 500 + 6 + 16
+
+# Unknown names are left out, and missing ones stay 0
+def test_counters_parse_what_they_know():
+    counters = PerformanceCounters.parse(" icache_hits=5 future_counter=3 dcache_misses=2")
+    assert (counters.icache_hits, counters.dcache_misses, counters.btb_hits) == (5, 2, 0)
+    assert not hasattr(counters, "future_counter")
+    assert PerformanceCounters.parse("").dcache_miss_rate() == 0
+
+# The names are the ones the DLX reports
+def test_counters_match_the_dlx_report():
+    source = (Path(__file__).resolve().parents[2] / "components" / "10-DLX.vhd").read_text()
+    report = source[source.index('report "Performance counters:"'):]
+    report = report[:report.index(";")]
+    assert re.findall(r'" (\w+)="', report) == PerformanceCounters.NAMES
+
+def test_counters_come_with_the_result(emulator_trace, capsys):
+    output = SimulationOutput()
+    lines = trace_lines(names(emulator_trace)) + [
+        COUNTERS_LINE,
+        "#    Time: 1000 ns  Iteration: 0  Instance: /tb_dlx\n",
+        "# Instructions ran: 10\n",
+        "# Cycles taken: 20\n",
+        "# Simulation Finished!\n",
+    ]
+    feed(output, lines)
+
+    success, _, _, _, counters = output.result()
+    assert success
+    assert counters.btb_mispredictions == 3
+    out = capsys.readouterr().out
+    assert "Time: 1000 ns" not in out
+    assert "BTB: 7 hits, 3 mispredictions" in out
@@ -0,0 +1,155 @@
+import pytest
+
+from dlx_assembler import assemble
+from dlx_emulator import emulate
+from state_hash import StateHashes, WriteStream, bisect
+
+# A register write of each kind, a write to r0, and a store of each size, with
+# values wider than the sb and sh. The final lhi is a write too, but not the sw
+# that ends the program.
+WRITES = """
+.text
+    addi r1, r0, #0x1234
+    lhi r2, #0xABCD
+    ori r2, r2, #0x5678
+    add r0, r0, r0
+    sw word(r1), r2
+    sh half(r1), r2
+    sb byte(r1), r2
+    lhi r1, #0xFFFF
+    sw 0(r1), r0
+.data
+word:
+    .space 4
+half:
+    .space 4
+byte:
+    .space 4
+"""
+
+# 602 writes, two for every iteration, the first addi and the final lhi
+LOOP = """
+.text
+    addi r1, r0, #300
+loop:
+    sw count(r0), r1
+    subi r1, r1, #1
+    bnez r1, loop
+    lhi r2, #0xFFFF
+    sw 0(r2), r0
+.data
+count:
+    .space 4
+"""
+
+def write_stream(source):
+    success, _, trace = emulate(None, 0, 10_000, "", program=assemble(source).words())
+    assert success
+    return WriteStream(trace)
+
+# 32 bit FNV-1a over the given words
+def fnv1a(words):
+    hash = 0x811C9DC5
+    hashes = [hash]
+    for word in words:
+        hash = ((hash ^ word) * 0x01000193) & 0xFFFFFFFF
+        hashes.append(hash)
+    return hashes
+
+def test_hashes_fold_the_tag_address_and_value_of_every_write():
+    stream = write_stream(WRITES)
+
+    base = 0x1234
+    words = [
+        0x101, 0x00001234,
+        0x102, 0xABCD0000,
+        0x102, 0xABCD5678,
+        0x204, base, 0xABCD5678,
+        0x202, base + 4, 0x5678,
+        0x201, base + 8, 0x78,
+        0x101, 0xFFFF0000,
+    ]
+    hashes = fnv1a(words)
+
+    # A hash for each write, after its last word
+    assert list(stream.hashes) == [hashes[i] for i in (0, 2, 4, 6, 9, 12, 15, 17)]
+    assert list(stream.hashes) == [0x811C9DC5, 0x15164FA8, 0x3BC047BA, 0x6E4F2670, 0xBA500A00, 0xE3ADCBE6, 0x62E73499, 0xD4066B58]
+    assert list(stream.write_positions) == [0, 1, 2, 4, 5, 6, 7]
+    assert [stream.describe(n) for n in range(1, len(stream) + 1)] == [
+        "r1=00001234",
+        "r2=ABCD0000",
+        "r2=ABCD5678",
+        "m4[00001234]=ABCD5678",
+        "m2[00001238]=00005678",
+        "m1[0000123C]=00000078",
+        "r1=FFFF0000",
+    ]
+
+# Simulates a cpu whose k-th write differs from the emulator's, reporting a
+# hash every interval writes after the start and once more at the end, until
+# one doesn't match
+def diverging_cpu(stream, k):
+    hashes = [hash if n < k else hash ^ 1 for n, hash in enumerate(stream.hashes)]
+    runs = []
+
+    def simulate(state_hashes):
+        runs.append(state_hashes)
+        for n in range(state_hashes.start + state_hashes.interval, len(stream) + 1, state_hashes.interval):
+            if state_hashes.check(n, hashes[n], f"write {n}") is not None:
+                return
+        n = len(stream)
+        if n > state_hashes.start:
+            state_hashes.check(n, hashes[n], f"write {n}")
+
+    return simulate, runs
+
+@pytest.fixture(scope="module")
+def loop_stream():
+    return write_stream(LOOP)
+
+def test_loop_writes(loop_stream):
+    assert len(loop_stream) == 602
+
+@pytest.mark.parametrize("interval", [1, 7, 64, 500])
+@pytest.mark.parametrize("k", [1, 2, 63, 64, 65, 300, 600, 601, 602])
+def test_bisect_finds_the_first_write_that_differs(loop_stream, interval, k, capsys):
+    simulate, runs = diverging_cpu(loop_stream, k)
+    state_hashes = StateHashes(loop_stream, interval)
+    simulate(state_hashes)
+
+    # Past the last multiple of the interval, the report at the end finds it
+    assert state_hashes.last_match < k <= state_hashes.mismatch
+    bisect(simulate, state_hashes)
+
+    last = runs[-1]
+    assert last.mismatch == k
+    assert last.last_match == k - 1
+    assert last.mismatch_description == f"write {k}"
+    assert f"First write that differs: write {k}," in capsys.readouterr().out
+
+def test_check_reports_the_writes_between_the_last_match_and_the_mismatch(loop_stream):
+    state_hashes = StateHashes(loop_stream, 10)
+    assert state_hashes.check(10, loop_stream.hashes[10], "") is None
+    assert state_hashes.check(20, 0, "r1=00000000") == "The state hash of the cpu diverges from the emulator's between writes 11 and 20"
+    assert (state_hashes.last_match, state_hashes.mismatch) == (10, 20)
+
+    state_hashes = StateHashes(loop_stream, 1, 10)
+    assert state_hashes.check(11, 0, "") == "The state hash of the cpu diverges from the emulator's at write 11"
+
+    # The cpu goes on after the final writes, which aren't hashed
+    assert StateHashes(loop_stream, 1).check(len(loop_stream) + 1, 0, "") is None
+
+def test_refine_splits_the_writes_left(loop_stream):
+    state_hashes = StateHashes(loop_stream, 600)
+    assert state_hashes.refine() is None
+    state_hashes.check(600, 0, "")
+
+    finer = state_hashes.refine()
+    assert (finer.start, finer.interval, finer.last_match) == (0, 600 // 64, 0)
+
+    finer.last_match, finer.mismatch = 100, 110
+    finest = finer.refine()
+    assert (finest.start, finest.interval) == (100, 1)
+
+    finest.last_match, finest.mismatch = 104, 105
+    assert finest.refine() is None
@@ -0,0 +1,73 @@
+import os
+
+from pathlib import Path
+
+import pytest
+
+import dlx_sim
+
+MOCK_VSIM_DIR = Path(__file__).resolve().parent / "mock_vsim"
+
+@pytest.fixture
+def tests_file(sim_dir, tmp_path, monkeypatch):
+    monkeypatch.setenv("PATH", f"{MOCK_VSIM_DIR}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.delenv("MOCK_VSIM_LOG", raising=False)
+    monkeypatch.delenv("MOCK_VSIM_DIVERGE", raising=False)
+    monkeypatch.delenv("MOCK_VSIM_DIE", raising=False)
+
+    path = tmp_path / "tests.list"
+    path.write_text("./programs/factorial.asm\n# A comment\n./programs/matrix_multiply.asm\n")
+    return path
+
+# The options get to the tests the same way, in this process or in the workers
+@pytest.mark.parametrize("jobs", [1, 2])
+@pytest.mark.parametrize("use_vsim_session", [False, True], ids=["vsim", "session"])
+def test_suite_runs_with_options(tests_file, tmp_path, jobs, use_vsim_session, capsys):
+    options = dlx_sim.SuiteOptions(
+        tmp_path / "build",
+        emulator_backend="blocks",
+        estimate_timing=True,
+        jobs=jobs,
+        use_vsim_session=use_vsim_session,
+    )
+    dlx_sim.run_test_suite(tests_file, options)
+
+    out = capsys.readouterr().out
+    assert "Tests Passed: 2/2 (100.00 %)." in out
+    assert "### TIMING MODEL ERROR ###" in out
+    assert (tmp_path / "build" / "factorial" / "factorial_emu_dump.mem").exists()
+    assert (tmp_path / "build" / "vsim").exists() == (jobs > 1 or use_vsim_session)
+
+# A test that raises fails on its own, and the rest of the suite still runs
+# and gets summarized
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_suite_goes_on_after_a_test_raises(tests_file, tmp_path, jobs, capsys):
+    tests_file.write_text("./programs\n./programs/factorial.asm\n")
+    dlx_sim.run_test_suite(tests_file, dlx_sim.SuiteOptions(tmp_path / "build", jobs=jobs))
+
+    out = capsys.readouterr().out
+    assert "IsADirectoryError" in out
+    assert "Tests Passed: 1/2 (50.00 %)." in out
+    assert "Failing tests:" in out
+
+# So does a worker that can't set up its work directory
+def test_suite_goes_on_after_a_worker_fails(tests_file, tmp_path, capsys):
+    (tmp_path / "build").mkdir()
+    (tmp_path / "build" / "vsim").write_text("")
+    dlx_sim.run_test_suite(tests_file, dlx_sim.SuiteOptions(tmp_path / "build", jobs=2))
+
+    out = capsys.readouterr().out
+    assert "NotADirectoryError" in out
+    assert "Tests Passed: 0/2 (0.00 %)." in out
+
+# Every vsim session gets closed at the end, in this process or in the workers
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_suite_closes_the_vsim_sessions(tests_file, tmp_path, jobs, monkeypatch):
+    log = tmp_path / "vsim.log"
+    monkeypatch.setenv("MOCK_VSIM_LOG", str(log))
+    dlx_sim.run_test_suite(tests_file, dlx_sim.SuiteOptions(tmp_path / "build", jobs=jobs, use_vsim_session=True))
+
+    sent = log.read_text().splitlines()
+    started = sum(1 for command in sent if command.startswith("quietly set WORK_LIBRARY"))
+    assert started >= 1
+    assert sent.count("quit -f") == started
@@ -0,0 +1,136 @@
+import io
+
+from pathlib import Path
+
+import pytest
+
+import dlx_sim
+
+from common import write_trace
+from dlx_assembler import assemble_file
+from dlx_emulator import emulate
+from trace_file import TraceFile, TraceFileWriter, write_binary_trace
+
+PROGRAMS = Path(__file__).resolve().parents[1] / "programs"
+
+MAX_CYCLES = 100_000
+
+# Small enough for testrom to take a few index entries
+INDEX_INTERVAL = 32
+
+def emulator_trace(name):
+    success, _, trace = emulate(None, 0, MAX_CYCLES, "", program=assemble_file(PROGRAMS / f"{name}.asm").words())
+    assert success
+    return trace
+
+def fields(instruction):
+    registers = tuple(instruction.registers) if instruction.registers is not None else None
+    return instruction.instruction_index, instruction.opcode, instruction.func, instruction.pc, registers
+
+def text(instructions):
+    output = io.StringIO()
+    write_trace(instructions, output)
+    return output.getvalue()
+
+@pytest.fixture(scope="module")
+def testrom():
+    return emulator_trace("testrom")
+
+# testrom written with an index entry every INDEX_INTERVAL records, either
+# closed or still being written, in which case the index gets rebuilt
+@pytest.fixture(params=["closed", "open"])
+def trace_file(testrom, tmp_path, request):
+    path = tmp_path / "testrom.trace.bin"
+    writer = TraceFileWriter(path, testrom.first_index, testrom.initial_registers, index_interval=INDEX_INTERVAL)
+    # In two chunks, the first one ending in the middle of an index entry
+    middle = INDEX_INTERVAL * 3 + 5
+    writer.extend(testrom.pcs[:middle], testrom.instructions[:middle], testrom.dests[:middle], testrom.values[:middle])
+    writer.extend(testrom.pcs[middle:], testrom.instructions[middle:], testrom.dests[middle:], testrom.values[middle:])
+
+    if request.param == "closed":
+        writer.close()
+    else:
+        writer.flush()
+
+    with TraceFile(path) as trace:
+        yield trace
+
+    if request.param == "open":
+        writer.close()
+
+def test_records_match_the_emulator(trace_file, testrom):
+    assert len(trace_file) == len(testrom)
+    assert len(testrom) > INDEX_INTERVAL * 10
+    assert list(trace_file.initial_registers) == list(testrom.initial_registers)
+    assert [fields(instruction) for instruction in trace_file] == [fields(instruction) for instruction in testrom]
+    assert list(trace_file.iter_opcodes()) == list(testrom.iter_opcodes())
+
+def test_index_matches_the_one_rebuilt(trace_file):
+    assert list(trace_file.index) == list(trace_file.build_index())
+
+# Any instruction can be read on its own, starting from the index entry before
+# it, with the registers it left
+@pytest.mark.parametrize("i", [0, 1, INDEX_INTERVAL - 1, INDEX_INTERVAL, INDEX_INTERVAL * 5 + 7, -1])
+def test_jump_to_an_instruction(trace_file, testrom, i):
+    assert fields(trace_file[i]) == fields(testrom[i])
+    start = i % len(testrom)
+    assert trace_file.registers_at(start) == list(testrom.registers_at(start))
+    assert [fields(instruction) for instruction in trace_file.iter_range(start, start + 3)] == [
+        fields(testrom[j]) for j in range(start, min(start + 3, len(testrom)))
+    ]
+
+def test_jump_to_instruction_in_a_long_trace(tmp_path):
+    trace = emulator_trace("matrix_multiply_9x9")
+    write_binary_trace(trace, tmp_path / "trace.bin")
+
+    with TraceFile(tmp_path / "trace.bin") as trace_file:
+        assert len(trace_file) > 10_000
+        assert fields(trace_file[10_000]) == fields(trace[10_000])
+        assert text(trace_file.iter_range(10_000, 10_010)) == text(trace[10_000:10_010])
+
+# The start and stop fall in the middle of index entries, and the pc range
+# only has some of the records of the entries it's in
+@pytest.mark.parametrize("start, stop", [
+    (0, None),
+    (INDEX_INTERVAL + 3, INDEX_INTERVAL * 4 + 17),
+    (INDEX_INTERVAL * 2 - 1, INDEX_INTERVAL * 2 + 1),
+    (5, 5),
+])
+def test_pc_range_within_start_and_stop(trace_file, testrom, start, stop):
+    min_pc, max_pc = 0x40, 0x400
+    expected = [
+        fields(instruction) for instruction in testrom[start:stop]
+        if min_pc <= instruction.pc <= max_pc
+    ]
+
+    found = [fields(instruction) for instruction in trace_file.iter_pc_range(min_pc, max_pc, start, stop)]
+    assert found == expected
+    if stop is None:
+        assert 0 < len(found) < len(testrom)
+
+def test_close_while_iterating(trace_file):
+    opcodes = trace_file.iter_opcodes()
+    next(opcodes)
+    pcs = trace_file.iter_pc_range(0, 0xFFFF_FFFF)
+    next(pcs)
+    trace_file.close()
+
+# The text trace converted from the binary one is the same the emulator would
+# write, with its format unchanged
+def test_convert_trace_gives_the_text_trace(testrom, tmp_path):
+    save_trace_path = tmp_path / "testrom.trace"
+    dlx_sim.save_trace(testrom, save_trace_path, "text")
+    dlx_sim.save_trace(testrom, save_trace_path, "binary")
+
+    assert dlx_sim.convert_trace(tmp_path / "testrom.trace.bin", tmp_path / "converted.trace")
+    converted = (tmp_path / "converted.trace").read_text()
+    assert converted == save_trace_path.read_text()
+    assert converted.splitlines()[:2] == [
+        "[0]: addi  r3[0000000F], r0[00000000], 0000000F (pc = 00000000)",
+        "[1]: sw    r3[0000000F], r0[00000000], 00001140 (pc = 00000004)",
+    ]
+
+    assert dlx_sim.convert_trace(tmp_path / "testrom.trace.bin", tmp_path / "part.trace", start=100, stop=110, min_pc=0x40, max_pc=0x400)
+    assert (tmp_path / "part.trace").read_text() == text(
+        instruction for instruction in testrom[100:110] if 0x40 <= instruction.pc <= 0x400
+    )
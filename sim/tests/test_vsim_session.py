@@ -0,0 +1,145 @@
+import os
+import re
+
+from pathlib import Path
+
+import pytest
+
+import rtl_build
+
+from dlx_assembler import assemble_file
+from dlx_emulator import emulate
+from simulator import ReferenceTrace
+from vsim_session import VsimSession
+
+MOCK_VSIM_DIR = Path(__file__).resolve().parent / "mock_vsim"
+
+MAX_CYCLES = 10000
+
+# The program assembled in tmp_path, and what the emulator does with it
+class Program:
+    def __init__(self, tmp_path, name):
+        self.mem = tmp_path / f"{name}.mem"
+        self.mem.write_text(assemble_file(Path("programs") / f"{name}.asm").mem_text())
+
+        self.dump = tmp_path / f"{name}.emu.dump"
+        success, self.instructions, self.trace = emulate(self.mem, 0, MAX_CYCLES, self.dump)
+        assert success
+
+@pytest.fixture
+def mock_vsim(sim_dir, tmp_path, monkeypatch):
+    monkeypatch.setenv("PATH", f"{MOCK_VSIM_DIR}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("MOCK_VSIM_LOG", str(tmp_path / "vsim.log"))
+    monkeypatch.delenv("MOCK_VSIM_DIVERGE", raising=False)
+    monkeypatch.delenv("MOCK_VSIM_DIE", raising=False)
+    return tmp_path / "vsim.log"
+
+@pytest.fixture
+def session(tmp_path, mock_vsim):
+    with VsimSession(tmp_path / "session") as session:
+        yield session
+
+@pytest.fixture
+def factorial(tmp_path, sim_dir):
+    return Program(tmp_path, "factorial")
+
+def commands(log):
+    return log.read_text().splitlines()
+
+def start_sims(log):
+    return [command for command in commands(log) if command.startswith("start_sim")]
+
+def simulate(session, program, tmp_path, max_cycles=MAX_CYCLES, reference=None):
+    dump = tmp_path / "sim.dump"
+    if dump.exists():
+        dump.unlink()
+    result = session.simulate_cpu(program.mem, dump, max_cycles, quiet=True, reference=reference)
+    return result, dump
+
+def assert_matches_emulator(result, dump, program):
+    success, instructions, trace, cycles, _ = result
+    assert success
+    assert instructions == program.instructions
+    assert cycles > 0
+    assert [instruction.get_name() for instruction in trace] == [instruction.get_name() for instruction in program.trace]
+    assert dump.read_text() == program.dump.read_text()
+
+def is_compiled(session):
+    return rtl_build.plan_compile(session.work_library).is_empty()
+
+def test_same_generics_restart(session, factorial, tmp_path, mock_vsim):
+    first = simulate(session, factorial, tmp_path)
+    process = session.process
+    second = simulate(session, factorial, tmp_path)
+
+    assert_matches_emulator(*first, factorial)
+    assert_matches_emulator(*second, factorial)
+    assert session.process is process
+    assert len(start_sims(mock_vsim)) == 1
+    assert commands(mock_vsim).count("restart -f") == 1
+    assert is_compiled(session)
+
+# The generics name the same program.mem for every program, so the next one
+# only needs restart -f
+def test_restart_runs_the_new_program(session, factorial, tmp_path, mock_vsim):
+    matrix_multiply = Program(tmp_path, "matrix_multiply")
+    assert_matches_emulator(*simulate(session, factorial, tmp_path), factorial)
+    assert_matches_emulator(*simulate(session, matrix_multiply, tmp_path), matrix_multiply)
+    assert commands(mock_vsim).count("restart -f") == 1
+
+# restart -f only reloads program.mem because the memory of tb_DLX reads it in
+# its process, every time it's reset, which tb_DLX does first thing, rather than
+# when the design is elaborated
+def test_tb_dlx_reads_the_program_on_reset(sim_dir):
+    testbench = (sim_dir.parent / "testbenches" / "tb_DLX.vhd").read_text()
+    memory = (sim_dir.parent / "testbenches" / "00-tb-utils" / "02-WishboneMemory.vhd").read_text()
+
+    assert re.search(r"INSTRUCTIONS_FILENAME\s*=>\s*PROGRAM\b", testbench)
+    assert re.search(r"i_wb_rst\s*=>\s*wb_rst\b", testbench)
+    assert re.search(r"TestProcess: process.*?\bbegin\b.*?wb_rst <= '1';", testbench, re.DOTALL)
+
+    assert "impure function" not in memory
+    assert memory.count("file_open(mem_fp, INSTRUCTIONS_FILENAME") == 1
+    # In the statements of the process, not in its declarations
+    process = re.search(r"FakeMemory: process(.*?)end process", memory, re.DOTALL).group(1)
+    statements = re.split(r"\n\s*begin\n", process, maxsplit=1)[1]
+    assert re.search(r"if i_wb_rst = '1' then\s+.*?file_open\(mem_fp, INSTRUCTIONS_FILENAME", statements, re.DOTALL)
+
+def test_changed_generics_reload_without_compiling(session, factorial, tmp_path, mock_vsim):
+    first = simulate(session, factorial, tmp_path)
+    second = simulate(session, factorial, tmp_path, max_cycles=MAX_CYCLES + 1)
+
+    assert_matches_emulator(*first, factorial)
+    assert_matches_emulator(*second, factorial)
+
+    sent = commands(mock_vsim)
+    assert "restart -f" not in sent
+    assert sent.index("quit -sim") == sent.index(start_sims(mock_vsim)[1]) - 1
+    assert [command.endswith("-compile false") for command in start_sims(mock_vsim)] == [False, True]
+
+def test_abort_kills_vsim(session, factorial, tmp_path, mock_vsim, monkeypatch):
+    monkeypatch.setenv("MOCK_VSIM_DIVERGE", "5")
+    (success, _, trace, _, _), _ = simulate(session, factorial, tmp_path, reference=ReferenceTrace(factorial.trace))
+
+    assert not success
+    assert trace == []
+    assert not session.is_running()
+    # The design compiled before the simulation diverged
+    assert is_compiled(session)
+
+    # The next simulation starts a new vsim, which doesn't need to compile
+    monkeypatch.delenv("MOCK_VSIM_DIVERGE")
+    assert_matches_emulator(*simulate(session, factorial, tmp_path), factorial)
+    assert session.is_running()
+    assert [command.endswith("-compile false") for command in start_sims(mock_vsim)] == [False, False]
+
+def test_vsim_dies_during_command(session, factorial, tmp_path, mock_vsim, monkeypatch):
+    monkeypatch.setenv("MOCK_VSIM_DIE", "3")
+    (success, _, _, _, _), dump = simulate(session, factorial, tmp_path)
+
+    assert not success
+    assert not dump.exists()
+    assert session.process is None
+
+    monkeypatch.delenv("MOCK_VSIM_DIE")
+    assert_matches_emulator(*simulate(session, factorial, tmp_path), factorial)
@@ -19,6 +19,19 @@ entity TB_DLX is
 
         RESET_ADDR: std_logic_vector(31 downto 0) := (others => '0');
 
+        -- If not 0, the cycles between "Heartbeat" reports, which let the
+        -- scripts notice when the CPU stops retiring instructions
+        HEARTBEAT_CYCLES: integer := 0;
+
+        -- If not 0, the architectural writes between "State hash" reports,
+        -- starting after the first STATE_HASH_START ones, which let the
+        -- scripts find the first write where the CPU and the emulator differ
+        STATE_HASH_INTERVAL: integer := 0;
+        STATE_HASH_START: integer := 0;
+
+        -- If not empty, the file where the DLX writes its pipeline log
+        PIPELINE_LOG: string := "";
+
         MIN_STALL_CYCLES: integer := 1;
         MAX_STALL_CYCLES: integer := 3;
         MIN_WAIT_CYCLES: integer := 1;
@@ -37,6 +50,10 @@ end TB_DLX;
 architecture tb of TB_DLX is
     component DLX is
         generic (
+            STATE_HASH_INTERVAL: integer := 0;
+            STATE_HASH_START: integer := 0;
+            PIPELINE_LOG: string := "";
+
             NBIT: integer := 32;
             ADDR_WIDTH: integer := 32;
             RESET_ADDR: std_logic_vector(31 downto 0) := (others => '0');
@@ -126,6 +143,10 @@ begin
 
     DUT: DLX
         generic map(
+            STATE_HASH_INTERVAL => STATE_HASH_INTERVAL,
+            STATE_HASH_START => STATE_HASH_START,
+            PIPELINE_LOG => PIPELINE_LOG,
+
             NBIT => 32,
             ADDR_WIDTH => 32,
             RESET_ADDR => (others => '0'),
@@ -213,6 +234,10 @@ begin
             if i = MAX_CYCLES then
                 report "Cycle Limit reached, stopping early...";
             end if;
+
+            if HEARTBEAT_CYCLES > 0 and cycles mod HEARTBEAT_CYCLES = 0 then
+                report "Heartbeat: " & integer'image(cycles);
+            end if;
         end loop;
 
         wait until rising_edge(wb_clk);